@@ -0,0 +1,223 @@
+import sys
+from pathlib import Path
+
+# Ook als script te starten (python benchmark/draai_benchmark.py vanuit de map Python), dan staat de
+# map Python nog niet op het pad
+sys.path.insert(1, str(Path(__file__).resolve().parents[1]))
+
+import logsetup
+import logging
+
+import argparse
+import json
+import platform
+import subprocess
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from benchmark.synthetische_mutaties import (
+    STANDAARD_POLIS,
+    genereer_mutaties,
+    patienten_voor_rijen,
+)
+from featurebuilding.feature_afspraken import feature_afspraken
+from featurebuilding.filter_afspraken import filter_afspraken
+from preprocess.ingest_afspraken import ingest_afspraken
+from preprocess.preprocess_afspraken import preprocess_afspraken
+from utilities.instrumentatie import RUN, meet_stap
+
+# Standaard groottes (aantal mutaties) van de benchmark
+STANDAARD_RIJEN = [10_000, 100_000, 1_000_000, 10_000_000]
+
+# Vaste datum van vandaag, zodat elke run dezelfde data verwerkt
+BENCHMARK_VANDAAG = "2024-06-03"
+
+# De features uit de template model settings
+BENCHMARK_FEATURES = [
+    "distance",
+    "LEEFTIJD",
+    "afspraken_dag",
+    "rolling_min_op_tijd",
+    "dagen_tot_afspraak",
+    "dagen_sinds_afspraak",
+    "verplaatst_door_pat",
+    "rolling_count_no_show",
+    "rolling_count_verplaatsing_door_pat",
+    "rolling_count_show",
+    "vorige_voldaan",
+    "dagen_sinds_noshow",
+    "weekdag",
+    "maand",
+    "constype_code",
+]
+
+# Hier worden de resultaten van alle runs bewaard, zodat versies vergeleken kunnen worden
+RESULTATEN_PAD = Path(__file__).with_name("resultaten.jsonl")
+
+
+def git_versie():
+    """
+    Doel: de huidige git commit, None als die niet bepaald kan worden
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def train_en_voorspel(df, features):
+    """
+    Doel: train een model op de afspraken met een uitkomst en voorspel de afspraken zonder, zoals
+            train_model en voorspelling_voor_bellijst dat doen
+    """
+    # sklearn en xgboost zijn alleen nodig voor deze stappen
+    from modelling.define_pipeline import define_pipeline
+    from modelling.voorspel import test_controle_split
+
+    train = df[df["voldaan_af"].notna()]
+    with meet_stap("train", train) as stap:
+        X = train[features]
+        pipeline = define_pipeline(X, {"n_estimators": 100, "max_depth": 4})
+        pipeline.fit(X, train["voldaan_af"].astype(int))
+        stap["rijen_uit"] = len(train)
+
+    toekomst = df[df["voldaan_af"].isna()].copy()
+    with meet_stap("voorspel", toekomst) as stap:
+        toekomst["predict_proba"] = pipeline.predict_proba(toekomst[features])[:, 1]
+        toekomst = test_controle_split(toekomst, prop_pos=0.2, test_group_fraction=0.65)
+        stap["rijen_uit"] = 0 if toekomst is None else len(toekomst)
+
+
+def draai_benchmark(rijen, met_afstand=False, met_model=True, seed=0):
+    """
+    Doel: draai de pipeline op een synthetische dataset en meet elke stap
+    Input:
+        - rijen: gewenst aantal mutaties, het werkelijke aantal ligt er dichtbij
+        - met_afstand: ook de afstand tot het ziekenhuis bepalen, daarvoor is de postcodetabel nodig
+        - met_model: ook trainen en voorspellen, daarvoor zijn sklearn en xgboost nodig
+        - seed: seed voor de synthetische data
+    Output:
+        - n_mutaties: het werkelijke aantal mutaties
+        - metingen: lijst met per stap de meting (zie meet_stap)
+    """
+    logger = logging.getLogger()
+
+    features = [f for f in BENCHMARK_FEATURES if met_afstand or f != "distance"]
+    n_patienten = patienten_voor_rijen(rijen, seed=seed, vandaag=BENCHMARK_VANDAAG)
+    df = genereer_mutaties(
+        n_patienten=n_patienten, seed=seed, vandaag=BENCHMARK_VANDAAG
+    )
+    n_mutaties = len(df)
+    logger.info(f"Benchmark met {n_mutaties} mutaties van {n_patienten} patienten")
+
+    eerste_meting = len(RUN["stappen"])
+    with meet_stap("ingest_afspraken", df) as stap:
+        df = ingest_afspraken(df)
+        stap["rijen_uit"] = len(df)
+    df = preprocess_afspraken(df, vandaag=BENCHMARK_VANDAAG)
+    df = feature_afspraken(df, afspr_gesch=365, features=features)
+    # Alles vanaf een jaar terug, zodat er zowel afspraken met als zonder uitkomst overblijven
+    vandaag = pd.Timestamp(BENCHMARK_VANDAAG)
+    df = filter_afspraken(
+        df,
+        datum_range=[
+            f"{vandaag - timedelta(365):%Y-%m-%d}",
+            f"{vandaag + timedelta(120):%Y-%m-%d}",
+        ],
+        polis=list(STANDAARD_POLIS),
+        afspraakcodes={},
+        subagendas_exclude={},
+    )
+    if met_model:
+        try:
+            train_en_voorspel(df, features)
+        except ImportError as fout:
+            logger.warning(f"Train en voorspel overgeslagen: {fout}")
+
+    return n_mutaties, RUN["stappen"][eerste_meting:]
+
+
+def vorige_resultaten(versie):
+    """
+    Doel: de laatste opgeslagen meting per stap en grootte van een andere versie dan de huidige
+    """
+    if not RESULTATEN_PAD.is_file():
+        return {}
+    vorige = {}
+    with open(RESULTATEN_PAD, "r", encoding="utf-8") as f:
+        for regel in f:
+            resultaat = json.loads(regel)
+            if resultaat["versie"] != versie:
+                vorige[(resultaat["stap"], resultaat["rijen"])] = resultaat
+    return vorige
+
+
+if __name__ == "__main__":
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark van de pipeline op synthetische data"
+    )
+    parser.add_argument("--rijen", type=int, nargs="+", default=STANDAARD_RIJEN)
+    parser.add_argument("--met_afstand", action="store_true")
+    parser.add_argument("--zonder_model", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--niet_opslaan", action="store_true", help="resultaten niet bewaren"
+    )
+    args = parser.parse_args()
+
+    versie = git_versie()
+    vorige = vorige_resultaten(versie)
+    resultaten = []
+    for rijen in args.rijen:
+        n_mutaties, metingen = draai_benchmark(
+            rijen,
+            met_afstand=args.met_afstand,
+            met_model=not args.zonder_model,
+            seed=args.seed,
+        )
+        for meting in metingen:
+            resultaat = {
+                "versie": versie,
+                "datum": datetime.now().isoformat(),
+                "rijen": rijen,
+                "mutaties": n_mutaties,
+                "stap": meting["naam"],
+                "wandtijd_s": meting["wandtijd_s"],
+                "cpu_s": meting["cpu_s"],
+                "rijen_in": meting["rijen_in"],
+                "rijen_uit": meting["rijen_uit"],
+                "rss_start_mb": meting["rss_start_mb"],
+                "rss_eind_mb": meting["rss_eind_mb"],
+                "piek_rss_mb": meting["piek_rss_mb"],
+                "cpu_kinderen_s": meting.get("cpu_kinderen_s"),
+                "piek_rss_kinderen_mb": meting.get("piek_rss_kinderen_mb"),
+                "python": platform.python_version(),
+                "pandas": pd.__version__,
+            }
+            resultaten.append(resultaat)
+
+            # Vergelijk met de vorige versie, zodat een regressie direct opvalt
+            eerder = vorige.get((resultaat["stap"], rijen))
+            vergelijking = ""
+            if eerder is not None and eerder["wandtijd_s"]:
+                factor = resultaat["wandtijd_s"] / eerder["wandtijd_s"]
+                vergelijking = f" ({factor:.2f}x t.o.v. {eerder['versie']})"
+            logger.info(
+                f"{rijen:>10} {resultaat['stap']:<60} {resultaat['wandtijd_s']:>8.2f} s{vergelijking}"
+            )
+
+    if not args.niet_opslaan:
+        with open(RESULTATEN_PAD, "a", encoding="utf-8") as f:
+            for resultaat in resultaten:
+                f.write(json.dumps(resultaat) + "\n")
+        logger.info(f"Resultaten toegevoegd aan {RESULTATEN_PAD}")
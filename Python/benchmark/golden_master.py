@@ -0,0 +1,199 @@
+import sys
+from pathlib import Path
+
+# Ook als script te starten (python benchmark/golden_master.py vanuit de map Python), dan staat de
+# map Python nog niet op het pad
+sys.path.insert(1, str(Path(__file__).resolve().parents[1]))
+
+import logsetup
+import logging
+
+import argparse
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+
+from benchmark.synthetische_mutaties import genereer_mutaties
+from featurebuilding.feature_afspraken import FEATURE_PRODUCENTEN, feature_afspraken
+from featurebuilding.filter_afspraken import compileer_regels, vergelijk_regels_sql
+from preprocess.ingest_afspraken import ingest_afspraken
+from preprocess.preprocess_afspraken import preprocess_afspraken
+
+# De synthetische dataset waarop de golden master bepaald wordt. Met een vaste datum van vandaag
+# is de output elke dag hetzelfde
+GOLDEN_INSTELLINGEN = {"n_patienten": 2000, "seed": 42, "vandaag": "2024-06-03"}
+
+# De afstand heeft de postcodetabel uit de database nodig, die doet niet mee
+GOLDEN_FEATURES = [
+    kolom
+    for naam, producent in FEATURE_PRODUCENTEN.items()
+    if naam != "afstand"
+    for kolom in producent["maakt"]
+]
+
+# Een rij in de output is uniek per afspraak, actie_moment en volgnummer
+GOLDEN_SLEUTEL = ["patientnr", "afspraaknr", "actie_moment", "volgnummer"]
+
+GOLDEN_PAD = Path(__file__).with_name("golden_master.json")
+
+# Uitsluitregels om regels_als_sql mee te controleren, met beide soorten regels en een poli zonder
+# toegestane codes
+GOLDEN_REGELS = {
+    "afspraakcodes": {
+        "Dermatologie": {"include": "False", "codes": ["EC", "VR"]},
+        "Cardiologie": {"include": "True", "codes": ["HC", "TC"]},
+    },
+    "subagendas_exclude": {
+        "Neurologie": {"include": "False", "subagendas": ["SA2"]},
+        "Oogheelkunde": {"include": "True", "subagendas": ["SA1", "SA3"]},
+        "KNO": {"include": "True", "subagendas": []},
+    },
+}
+
+
+def bereken_output(n_workers=1):
+    """
+    Doel: draai ingest, preprocessing en feature building op de golden master dataset
+    Input:
+        - n_workers: met meer dan 1 worker via verwerk_per_patient, om ook die route te controleren
+    Output:
+        - df: output van feature_afspraken
+    """
+    df = genereer_mutaties(**GOLDEN_INSTELLINGEN)
+    df = ingest_afspraken(df)
+    vandaag = GOLDEN_INSTELLINGEN["vandaag"]
+    if n_workers == 1:
+        df = preprocess_afspraken(df, vandaag=vandaag)
+        return feature_afspraken(df, afspr_gesch=365, features=GOLDEN_FEATURES)
+
+    from utilities.sharding import verwerk_per_patient
+
+    return verwerk_per_patient(
+        df,
+        stappen=[
+            (preprocess_afspraken, {"vandaag": vandaag}),
+            (feature_afspraken, {"afspr_gesch": 365, "features": GOLDEN_FEATURES}),
+        ],
+        n_workers=n_workers,
+    )
+
+
+def kolom_hash(kolom):
+    """
+    Doel: hash van de waardes in een kolom, onafhankelijk van het datatype. Getallen worden eerst
+            afgerond op 9 decimalen, zodat afrondingsverschillen in de laatste bits niet meetellen
+    """
+    if pd.api.types.is_bool_dtype(kolom):
+        tekst = kolom.astype(object).astype(str)
+    elif pd.api.types.is_numeric_dtype(kolom):
+        waardes = np.round(kolom.to_numpy(dtype=float), 9) + 0.0
+        tekst = pd.Series(waardes).map(repr)
+    elif pd.api.types.is_datetime64_any_dtype(kolom):
+        tekst = pd.Series(kolom.to_numpy(dtype="datetime64[ns]").view("int64")).map(str)
+    else:
+        tekst = kolom.astype(object).map(str)
+    tekst = tekst.where(kolom.notna().to_numpy(), "NaN")
+    return hashlib.sha1("\n".join(tekst).encode("utf-8")).hexdigest()
+
+
+def output_hashes(df):
+    """
+    Doel: vingerafdruk van de output: het aantal rijen en per kolom een hash, met de rijen
+            gesorteerd op GOLDEN_SLEUTEL
+    """
+    df = df.copy()
+    for kolom in GOLDEN_SLEUTEL:
+        df[kolom] = df[kolom].astype(str)
+    df = df.sort_values(GOLDEN_SLEUTEL).reset_index(drop=True)
+    return {
+        "rijen": len(df),
+        "kolommen": {kolom: kolom_hash(df[kolom]) for kolom in sorted(df.columns)},
+    }
+
+
+def maak_golden_master(pad=GOLDEN_PAD):
+    """
+    Doel: leg de output van de huidige code vast als golden master
+    """
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    golden = {"instellingen": GOLDEN_INSTELLINGEN, **output_hashes(bereken_output())}
+    with open(pad, "w", encoding="utf-8") as f:
+        json.dump(golden, f, indent=4)
+    logger.info(f"Golden master weggeschreven naar {pad}")
+
+
+def vergelijk_met_golden_master(pad=GOLDEN_PAD, n_workers=1):
+    """
+    Doel: vergelijk de output van de huidige code met de golden master
+    Output:
+        - None als de output gelijk is, anders een beschrijving van het verschil
+    """
+    with open(pad, "r", encoding="utf-8") as f:
+        golden = json.load(f)
+    if golden["instellingen"] != GOLDEN_INSTELLINGEN:
+        return "De golden master is met andere instellingen gemaakt"
+
+    huidig = output_hashes(bereken_output(n_workers=n_workers))
+    verschillen = []
+    if huidig["rijen"] != golden["rijen"]:
+        verschillen.append(f"rijen: {golden['rijen']} -> {huidig['rijen']}")
+    for kolom in sorted(set(golden["kolommen"]) | set(huidig["kolommen"])):
+        if kolom not in huidig["kolommen"]:
+            verschillen.append(f"{kolom}: ontbreekt")
+        elif kolom not in golden["kolommen"]:
+            verschillen.append(f"{kolom}: nieuw")
+        elif huidig["kolommen"][kolom] != golden["kolommen"][kolom]:
+            verschillen.append(f"{kolom}: andere waardes")
+    return "; ".join(verschillen) or None
+
+
+def controleer_regels_sql():
+    """
+    Doel: controleer op de golden master dataset of regels_als_sql dezelfde afspraken uitsluit als
+            regels_mask. Een deel van de poli's en codes wordt leeg gemaakt, om ook de NULL
+            afhandeling te controleren
+    Output:
+        - None als beide gelijk zijn, anders een beschrijving van het verschil
+    """
+    df = genereer_mutaties(**GOLDEN_INSTELLINGEN)
+    for stap, kolom in enumerate(["polikliniek", "CODE", "subagenda"]):
+        df.loc[df.index % (7 + stap) == 0, kolom] = ""
+    df = ingest_afspraken(df)
+    return vergelijk_regels_sql(
+        df,
+        compileer_regels(
+            GOLDEN_REGELS["afspraakcodes"], GOLDEN_REGELS["subagendas_exclude"]
+        ),
+    )
+
+
+if __name__ == "__main__":
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    parser = argparse.ArgumentParser(
+        description="Golden master van preprocessing en feature building op synthetische data"
+    )
+    parser.add_argument("actie", choices=["maak", "vergelijk"])
+    parser.add_argument("--n_workers", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.actie == "maak":
+        maak_golden_master()
+    else:
+        verschil = vergelijk_met_golden_master(n_workers=args.n_workers)
+        if verschil is None:
+            logger.info("Output gelijk aan de golden master")
+        else:
+            logger.error(f"Output wijkt af van de golden master: {verschil}")
+            raise SystemExit(1)
+        verschil = controleer_regels_sql()
+        if verschil is None:
+            logger.info("regels_als_sql gelijk aan regels_mask")
+        else:
+            logger.error(f"regels_als_sql wijkt af van regels_mask: {verschil}")
+            raise SystemExit(1)
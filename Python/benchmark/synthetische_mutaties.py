@@ -0,0 +1,227 @@
+import numpy as np
+import pandas as pd
+from datetime import date
+
+# Standaard verdeling van de afspraken over de poliklinieken
+STANDAARD_POLIS = {
+    "Dermatologie": 0.3,
+    "Cardiologie": 0.25,
+    "Neurologie": 0.2,
+    "Oogheelkunde": 0.15,
+    "KNO": 0.1,
+}
+
+# Redenen van verplaatsen/annuleren, een deel daarvan is op initiatief van de patient
+REDENEN = np.array(["CS00000002", "N", "P", "Z", "", "A1", "ZH", "Q"])
+
+
+def synthetische_postcodes(n_postcodes, rng):
+    """
+    Doel: maak een lijst met unieke postcodes in het Nederlandse formaat (1234 AB)
+    """
+    letters = np.array(list("ABCDEFGHJKLMNPRSTVWXZ"))
+    cijfers = rng.integers(1000, 10000, n_postcodes * 2)
+    eerste = letters[rng.integers(0, len(letters), n_postcodes * 2)]
+    tweede = letters[rng.integers(0, len(letters), n_postcodes * 2)]
+    postcodes = pd.unique(
+        pd.Series(cijfers).astype(str) + " " + pd.Series(eerste) + pd.Series(tweede)
+    )
+    return postcodes[:n_postcodes]
+
+
+def als_tijd(minuten):
+    """
+    Doel: zet minuten sinds middernacht om in een tijd als "HH:MM" string
+    """
+    minuten = pd.Series(minuten)
+    return (
+        (minuten // 60).astype(str).str.zfill(2)
+        + ":"
+        + (minuten % 60).astype(str).str.zfill(2)
+    ).to_numpy()
+
+
+def genereer_mutaties(
+    n_patienten=1000,
+    afspraken_per_patient=4,
+    p_verplaatsing=0.25,
+    p_annulering=0.08,
+    p_noshow=0.07,
+    polis=None,
+    n_postcodes=500,
+    seed=0,
+    vandaag=None,
+):
+    """
+    Doel: genereer synthetische afspraakmutaties in het formaat van create_dataset, zodat de pipeline
+            getest en gebenchmarkt kan worden zonder patientdata. Elke afspraak krijgt een rij bij het
+            maken, een aantal verplaatsingen, wat wijzigingen zonder nieuwe datum en (als de afspraak
+            in het verleden ligt) een uitkomst: show, no-show of annulering
+    Input:
+        - n_patienten: aantal patienten
+        - afspraken_per_patient: gemiddeld aantal afspraken per patient (minimaal 1)
+        - p_verplaatsing: gemiddeld aantal verplaatsingen per afspraak (maximaal 3 per afspraak)
+        - p_annulering: kans dat een afspraak in het verleden geannuleerd is
+        - p_noshow: kans dat een afspraak in het verleden een no-show is
+        - polis: optioneel, dict met per polikliniek het aandeel van de afspraken, standaard STANDAARD_POLIS
+        - n_postcodes: aantal verschillende postcodes
+        - seed: seed voor de random generator, dezelfde seed geeft dezelfde data
+        - vandaag: optioneel, de datum van vandaag. De afspraken liggen tussen 2 jaar terug en 4
+                maanden vooruit. Standaard date.today()
+    Output:
+        - df: mutaties met dezelfde kolommen als create_dataset, in willekeurige volgorde
+    """
+    rng = np.random.default_rng(seed)
+    vandaag = pd.Timestamp(vandaag or date.today())
+    polis = polis or STANDAARD_POLIS
+
+    ############################################################################
+    # Afspraken
+    ############################################################################
+
+    n_afspr_pat = rng.poisson(afspraken_per_patient - 1, n_patienten) + 1
+    n = int(n_afspr_pat.sum())
+    pat_afspr = np.repeat(np.arange(n_patienten), n_afspr_pat)
+    patientnr = pat_afspr + 1_000_000
+    afspraaknr = np.arange(n) + 50_000_000
+
+    # Moment waarop de afspraak gemaakt is en de eerste geplande datum en tijd (tussen 8:00 en 16:45)
+    invoer = (
+        vandaag
+        - pd.Timedelta(730, "D")
+        + pd.to_timedelta(rng.integers(0, 760 * 24 * 60, n), unit="min")
+    )
+    lead = rng.integers(1, 120, n)
+    slot = rng.integers(32, 68, n) * 15
+    basis = invoer.normalize() + pd.to_timedelta(lead, unit="D")
+
+    # Per afspraak het aantal verplaatsingen en de verschuiving van de datum per verplaatsing. Een
+    # deel van de verplaatsingen is naar een andere tijd op dezelfde dag
+    n_verpl = rng.binomial(3, min(p_verplaatsing / 3 * 2, 1), n)
+    n_ruis = rng.binomial(2, 0.3, n)
+    shifts = rng.integers(-3, 30, (n, 4))
+    shifts[:, 0] = 0
+    zelfde_dag = rng.random((n, 4)) < 0.1
+    shifts[zelfde_dag] = 0
+    cum_shift = np.cumsum(shifts, axis=1)
+    slot_v = np.where(
+        zelfde_dag,
+        np.where(slot[:, None] < 960, slot[:, None] + 60, slot[:, None] - 60),
+        slot[:, None],
+    )
+    slot_v[:, 0] = slot
+
+    # Afspraken in het verleden hebben een uitkomst
+    laatste_datum = basis + pd.to_timedelta(cum_shift[np.arange(n), n_verpl], "D")
+    verleden = laatste_datum <= vandaag
+    annul = verleden & (rng.random(n) < p_annulering)
+    uitkomst = verleden & ~annul
+    n_rijen = 1 + n_verpl + n_ruis + verleden.astype(int)
+
+    ############################################################################
+    # Mutaties
+    ############################################################################
+
+    # Per mutatie: de afspraak en het volgnummer binnen de afspraak
+    rij_afspr = np.repeat(np.arange(n), n_rijen)
+    start = np.r_[0, np.cumsum(n_rijen)[:-1]]
+    j = np.arange(len(rij_afspr)) - np.repeat(start, n_rijen)
+    nv = n_verpl[rij_afspr]
+    nr = n_ruis[rij_afspr]
+    is_verpl = (j >= 1) & (j <= nv)
+    is_ruis = (j > nv) & (j <= nv + nr)
+    is_fin = j == nv + nr + 1
+    stap = np.minimum(j, nv)
+
+    datum = basis[rij_afspr] + pd.to_timedelta(cum_shift[rij_afspr, stap], "D")
+    minuten = slot_v[rij_afspr, stap]
+    datumtijd = datum + pd.to_timedelta(minuten, unit="min")
+    vorige_stap = np.maximum(stap - 1, 0)
+    vorige_dt = (
+        basis[rij_afspr]
+        + pd.to_timedelta(cum_shift[rij_afspr, vorige_stap], "D")
+        + pd.to_timedelta(slot_v[rij_afspr, vorige_stap], unit="min")
+    )
+
+    # Het moment van de mutatie: verplaatsingen en annuleringen een paar dagen voor de afspraak,
+    # uitkomsten kort na de afspraak. Binnen een afspraak altijd oplopend
+    mut = pd.Series(invoer[rij_afspr])
+    terug = pd.to_timedelta(rng.exponential(4 * 24 * 60, len(j)), unit="min")
+    mut = mut.where(~is_verpl, pd.Series(vorige_dt) - terug)
+    mut = mut.where(
+        ~is_ruis, pd.Series(invoer[rij_afspr]) + pd.to_timedelta(j, unit="h")
+    )
+    annul_r = is_fin & annul[rij_afspr]
+    uitk_r = is_fin & uitkomst[rij_afspr]
+    mut = mut.where(~annul_r, pd.Series(datumtijd) - terug)
+    mut = mut.where(~uitk_r, pd.Series(datumtijd) + pd.Timedelta(2, "h"))
+    mut = mut.groupby(rij_afspr).cummax() + pd.to_timedelta(j, unit="s")
+    mut = mut.dt.floor("s")
+
+    noshow = uitk_r & (rng.random(len(j)) < p_noshow)
+    voldaan = np.where(uitk_r, np.where(noshow, "N", "J"), "")
+    aankomst = np.where(
+        uitk_r & ~noshow, als_tijd(minuten - rng.integers(-10, 30, len(j))), ""
+    )
+    tijd = als_tijd(minuten)
+    mutatietype = np.select(
+        [j == 0, is_verpl, annul_r], ["Nieuw", "Verplaatst", "Geannuleerd"], "Gewijzigd"
+    )
+    verplreden = np.where(
+        is_verpl | annul_r | noshow, REDENEN[rng.integers(0, len(REDENEN), len(j))], ""
+    )
+
+    ############################################################################
+    # Kenmerken van patient en afspraak
+    ############################################################################
+
+    namen = np.array(list(polis))
+    kansen = np.array(list(polis.values()), dtype=float)
+    poli_afspr = namen[rng.choice(len(namen), n, p=kansen / kansen.sum())]
+    postcodes = synthetische_postcodes(n_postcodes, rng)
+    postcode_pat = postcodes[rng.integers(0, len(postcodes), n_patienten)]
+    leeftijd_pat = rng.integers(0, 95, n_patienten)
+    contact = np.where(rng.random(n) < 0.9, "F", "T")
+    codes = np.array(["EC", "HC", "VR", "TC"])
+    constypes = np.array(["eerste consult", "herhaal consult", "verrichting", "geen"])
+
+    df = pd.DataFrame(
+        {
+            "patientnr": patientnr[rij_afspr].astype(str),
+            "afspraaknr": afspraaknr[rij_afspr].astype(str),
+            "volgnummer": (np.arange(len(j)) + 7_000_000).astype(str),
+            "mutatie_moment": mut.to_numpy(),
+            "MUTATIETYPE": mutatietype,
+            "DATUM": pd.Series(datum).where(~annul_r),
+            "TIJD": np.where(annul_r, "", tijd),
+            "datum_am": pd.Series(datum).dt.strftime("%Y-%m-%d"),
+            "tijd_am": tijd,
+            "datum_tijd_am": pd.Series(datumtijd).dt.strftime("%Y-%m-%d %H:%M:%S"),
+            "DUUR": rng.choice([10, 15, 20, 30], len(j)),
+            "CODE": codes[rng.integers(0, len(codes), n)][rij_afspr],
+            "verplreden": verplreden,
+            "voldaan_af": voldaan,
+            "contacttype": contact[rij_afspr],
+            "zonder_patient": (rng.random(n) < 0.02).astype(int)[rij_afspr],
+            "aankomst": aankomst,
+            "INVOERDAT": invoer.normalize()[rij_afspr],
+            "postcode": postcode_pat[pat_afspr][rij_afspr],
+            "polikliniek": poli_afspr[rij_afspr],
+            "subagenda": np.array(["SA1", "SA2", "SA3"])[rng.integers(0, 3, n)][
+                rij_afspr
+            ],
+            "LEEFTIJD": leeftijd_pat[pat_afspr][rij_afspr],
+            "constype_code": constypes[rng.integers(0, len(constypes), n)][rij_afspr],
+        }
+    )
+    return df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def patienten_voor_rijen(rijen, **kwargs):
+    """
+    Doel: schat hoeveel patienten nodig zijn voor ongeveer een gegeven aantal mutaties, met een
+            kleine proefgeneratie met dezelfde instellingen
+    """
+    proef = 2000
+    rijen_per_patient = len(genereer_mutaties(n_patienten=proef, **kwargs)) / proef
+    return max(1, int(round(rijen / rijen_per_patient)))
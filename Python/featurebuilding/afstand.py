@@ -0,0 +1,204 @@
+import logsetup
+import logging
+
+import hashlib
+import json
+import os
+import pickle
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from A_readwrite.load_data import load_dataset
+from Z_utilities.unify_cwd import unify_cwd
+from utilities.referentie_cache import haal_referentie, referentie_metadata
+
+# Locaties (lon, lat) waar de afstand naartoe bepaald wordt. De eerste locatie komt in de kolom distance
+ZIEKENHUIS_LOCATIES = {"EMC": (4.5301190909178, 51.955118652773)}
+
+# WGS-84 ellipsoide, dezelfde als die geopy gebruikt
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+
+
+def geodetische_afstand(lon1, lat1, lon2, lat2, max_iteraties=200):
+    """
+    Doel: afstand in meters over de WGS-84 ellipsoide (Vincenty), voor hele arrays tegelijk. Voor
+            afstanden binnen Nederland verschilt dit minder dan een millimeter met geopy.distance.distance
+    Input:
+        - lon1, lat1, lon2, lat2: coordinaten in graden, arrays of getallen
+    Output:
+        - array met afstanden in meters
+    """
+    lon1, lat1, lon2, lat2 = np.broadcast_arrays(
+        *(np.asarray(x, dtype=float) for x in (lon1, lat1, lon2, lat2))
+    )
+    L = np.radians(lon2 - lon1)
+    U1 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat2)))
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    lam = L
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for _ in range(max_iteraties):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(
+                cosU2 * sin_lam, cosU1 * sinU2 - sinU1 * cosU2 * cos_lam
+            )
+            cos_sigma = sinU1 * sinU2 + cosU1 * cosU2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            # Bij samenvallende punten is sin_sigma 0, de afstand wordt dan ook 0
+            sin_alpha = np.where(
+                sin_sigma == 0, 0.0, cosU1 * cosU2 * sin_lam / sin_sigma
+            )
+            cos2_alpha = 1 - sin_alpha**2
+            # Op de evenaar is cos2_alpha 0
+            cos_2sigma_m = np.where(
+                cos2_alpha == 0, 0.0, cos_sigma - 2 * sinU1 * sinU2 / cos2_alpha
+            )
+            C = WGS84_F / 16 * cos2_alpha * (4 + WGS84_F * (4 - 3 * cos2_alpha))
+            lam_vorige = lam
+            lam = L + (1 - C) * WGS84_F * sin_alpha * (
+                sigma
+                + C
+                * sin_sigma
+                * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m**2))
+            )
+            if np.all(np.abs(lam - lam_vorige)[~np.isnan(lam)] < 1e-12):
+                break
+
+    u2 = cos2_alpha * (WGS84_A**2 - WGS84_B**2) / WGS84_B**2
+    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    delta_sigma = (
+        B
+        * sin_sigma
+        * (
+            cos_2sigma_m
+            + B
+            / 4
+            * (
+                cos_sigma * (-1 + 2 * cos_2sigma_m**2)
+                - B
+                / 6
+                * cos_2sigma_m
+                * (-3 + 4 * sin_sigma**2)
+                * (-3 + 4 * cos_2sigma_m**2)
+            )
+        )
+    )
+    return WGS84_B * A * (sigma - delta_sigma)
+
+
+def laad_postcodes_bron():
+    """
+    Doel: laad de tabel met alle postcodes (postcode, lon, lat) uit de database
+    """
+    logger = logging.getLogger()
+
+    cwd = Path.cwd()
+    cwd = unify_cwd(cwd)
+    postcodetabel_pkl = cwd / "Python" / "postcodes.pkl"
+    # Een eerder opgeslagen pickle wordt nog gebruikt om de cache de eerste keer te vullen
+    if postcodetabel_pkl.is_file():
+        logger.info("Postcodes uit oude pickle overnemen in de referentie cache")
+        return pickle.load(open(postcodetabel_pkl, "rb"))
+
+    logger.info("Postcodes inladen uit database")
+    df_postcodes = load_dataset(
+        readserver="Annemarie",
+        database="dena",
+        schema="dbo",
+        table="REF_Postcode_NL",
+    )
+    df_postcodes = (
+        df_postcodes[["postcode", "lon", "lat"]]
+        .sort_values(["postcode", "lon"])
+        .drop_duplicates(subset=["postcode"], keep="first")
+    )
+    df_postcodes["postcode"] = df_postcodes["postcode"].apply(
+        lambda x: x[:4] + " " + x[-2:]
+    )
+    return df_postcodes
+
+
+def laad_postcodes():
+    """
+    Doel: de tabel met alle postcodes (postcode, lon, lat). De lijst is best flink en staat in de
+            database, daarom komt die uit de referentie cache
+    """
+    return haal_referentie("postcodes", laad_postcodes_bron)
+
+
+def locaties_versie(locaties, postcodes_hash):
+    """
+    Doel: korte hash van de locaties en de postcodes, een andere (of verschoven) locatie of een
+            nieuwe postcodetabel geeft een nieuwe tabel
+    """
+    inhoud = json.dumps(
+        [[naam, float(lon), float(lat)] for naam, (lon, lat) in locaties.items()]
+        + [postcodes_hash]
+    )
+    return hashlib.sha1(inhoud.encode("utf-8")).hexdigest()[:12]
+
+
+def sla_npy_op(array, pad):
+    """
+    Doel: schrijf een array weg via een tijdelijk bestand, zodat er nooit een half bestand staat
+    """
+    tijdelijk = pad.with_name(pad.name + ".tmp")
+    with open(tijdelijk, "wb") as f:
+        np.save(f, array)
+    os.replace(tijdelijk, pad)
+
+
+def afstanden_tabel(locaties):
+    """
+    Doel: tabel met voor elke postcode de afstand tot elke locatie. De tabel wordt 1 keer berekend en
+            als .npy opgeslagen per versie van de locaties en de postcodes, daarna wordt die alleen
+            memory mapped ingelezen.
+    Input:
+        - locaties: dict met naam: (lon, lat)
+    Output:
+        - postcodes: gesorteerde array met postcodes
+        - afstanden: array (postcodes x locaties) met afstanden in meters
+    """
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    cwd = Path.cwd()
+    cwd = unify_cwd(cwd)
+    map_tabel = cwd / "Python" / "cache" / "afstanden"
+    # Zorg dat de postcodes in de cache staan, de tabel hangt af van de versie daarvan
+    df_postcodes = None
+    if referentie_metadata("postcodes") is None:
+        df_postcodes = laad_postcodes()
+    versie = locaties_versie(locaties, referentie_metadata("postcodes")["inhoud_hash"])
+    postcodes_pad = map_tabel / f"postcodes_{versie}.npy"
+    afstanden_pad = map_tabel / f"afstanden_{versie}.npy"
+
+    if not (afstanden_pad.is_file() and postcodes_pad.is_file()):
+        logger.info(f"Afstanden tabel {versie} berekenen voor {', '.join(locaties)}")
+        if df_postcodes is None:
+            df_postcodes = laad_postcodes()
+        df_postcodes = df_postcodes.dropna(subset=["postcode"]).sort_values("postcode")
+        lon = pd.to_numeric(df_postcodes["lon"], errors="coerce").to_numpy()
+        lat = pd.to_numeric(df_postcodes["lat"], errors="coerce").to_numpy()
+        afstanden = np.column_stack(
+            [
+                geodetische_afstand(lon, lat, locatie_lon, locatie_lat)
+                for locatie_lon, locatie_lat in locaties.values()
+            ]
+        )
+        map_tabel.mkdir(parents=True, exist_ok=True)
+        # Fixed width strings, zodat ook de postcodes memory mapped gelezen kunnen worden
+        sla_npy_op(df_postcodes["postcode"].to_numpy(dtype=str), postcodes_pad)
+        sla_npy_op(afstanden, afstanden_pad)
+
+    return (
+        np.load(postcodes_pad, mmap_mode="r"),
+        np.load(afstanden_pad, mmap_mode="r"),
+    )
@@ -1,5 +1,5 @@
-from datetime import datetime, timedelta
-from workalendar.europe import NetherlandsWithSchoolHolidays as NL
+from datetime import timedelta
+import re
 import pandas as pd
 import numpy as np
 
@@ -7,255 +7,281 @@ import numpy as np
 import logsetup
 import logging
 
-import geopy.distance
-from A_readwrite.load_data import load_dataset
-import pickle
-from pathlib import Path
-from Z_utilities.unify_cwd import unify_cwd
-
-
-def afstand_tot_ziekenhuis(df):
+from preprocess.tijdvelden import HULPKOLOMMEN
+from featurebuilding.rolling_vensters import (
+    BEL_VERTRAGING,
+    rolling_sommen,
+    rolling_kwantielen,
+)
+from featurebuilding.afstand import ZIEKENHUIS_LOCATIES, afstanden_tabel
+from featurebuilding.filter_afspraken import doel_mask
+from featurebuilding.laatste_gebeurtenis import laatste_gebeurtenissen
+from utilities.referentie_cache import haal_referentie, bron_versie
+from utilities.instrumentatie import gemeten
+
+# Een rij in de output van de preprocessing is uniek per afspraaknr, actie_moment en volgnummer
+HISTORIE_SLEUTEL = ["afspraaknr", "actie_moment", "volgnummer"]
+
+# De feature producenten, in een volgorde waarin ze uitgevoerd kunnen worden. Per producent de
+# kolommen die die maakt (een kolom met een _(iets) erachter, zoals distance_(locatie), hoort ook bij
+# de producent) en de kolommen van andere producenten die die nodig heeft
+FEATURE_PRODUCENTEN = {
+    "rolling_counts": {
+        "maakt": [
+            "rolling_count_gepland",
+            "rolling_count_show",
+            "rolling_count_no_show",
+            "rolling_count_verplaatsing",
+            "rolling_count_verplaatsing_door_pat",
+        ],
+        "nodig": [],
+    },
+    "vorige": {
+        "maakt": ["vorige_show", "vorige_noshow", "vorige_voldaan"],
+        "nodig": [],
+    },
+    "stiptheid": {"maakt": ["rolling_min_op_tijd"], "nodig": []},
+    "no_show_perc": {
+        "maakt": ["no_show_perc"],
+        "nodig": ["rolling_count_no_show", "rolling_count_gepland"],
+    },
+    "dagen_sinds": {
+        "maakt": ["dagen_sinds_afspraak", "dagen_sinds_noshow"],
+        "nodig": ["vorige_show", "vorige_noshow"],
+    },
+    "afstand": {"maakt": ["distance"], "nodig": []},
+    "verpl_door_arts": {"maakt": ["verpl_door_arts"], "nodig": []},
+    "Nieuwe_patient": {"maakt": ["Nieuwe_patient"], "nodig": ["rolling_count_show"]},
+    "afspraken_dag": {"maakt": ["afspraken_dag"], "nodig": []},
+    "vakantie": {"maakt": ["vakantie"], "nodig": []},
+    "maand": {"maakt": ["maand"], "nodig": []},
+}
+# De producenten die van de afspraakgeschiedenis afhangen (zie historie_features)
+HISTORIE_PRODUCENTEN = ["rolling_counts", "vorige", "stiptheid"]
+
+# Kolom die tijdens de feature building aangeeft welke rijen doelrijen zijn (zie feature_afspraken)
+DOEL_KOLOM = "doelrij"
+
+# Jaren waarvoor de vakantiedagen tabel in ieder geval gemaakt wordt
+VAKANTIE_JAREN = (2000, 2050)
+
+
+@gemeten()
+def afstand_tot_ziekenhuis(df, locaties=None):
     """
     Functie die de afstand bepaald tussen de geregistreerde postcode van de patient
-    en het ziekenhuis
+    en het ziekenhuis. De afstand tot de eerste locatie komt in de kolom distance, die
+    tot eventuele andere locaties in distance_(naam)
     """
     logsetup.setup_logging()
     logger = logging.getLogger()
 
-    logger.info("Postcodes inladen")
-    cwd = Path.cwd()
-    cwd = unify_cwd(cwd)
-    postcodetabel_pkl = cwd / "Python" / "postcodes.pkl"
-    # De lijst met alle postcodes is best flink, staat in de database maar als de
-    # code een keer correct is doorlopen wordt het ook al pickle opgeslagen, dat
-    # maakt de code een stuk sneller
-    if postcodetabel_pkl.is_file():
-        df_postcodes = pickle.load(open(postcodetabel_pkl, "rb"))
-    else:
-        logger.info("Postcodes pickle niet gevonden, laadt in uit database")
-        df_postcodes = load_dataset(
-            readserver="Annemarie",
-            database="dena",
-            schema="dbo",
-            table="REF_Postcode_NL",
-        )
-        df_postcodes = (
-            df_postcodes[["postcode", "lon", "lat"]]
-            .sort_values(["postcode", "lon"])
-            .drop_duplicates(subset=["postcode"], keep="first")
-        )
-        df_postcodes["postcode"] = df_postcodes["postcode"].apply(
-            lambda x: x[:4] + " " + x[-2:]
-        )
-        pickle.dump(df_postcodes, open(postcodetabel_pkl, "wb"))
-
-    # Pak alleen de postcodes uit de lijst die in het dataframe voorkomen
-    df_postcodes = df_postcodes[df_postcodes["postcode"].isin(df["postcode"].unique())]
-    # Bepaal de afstand
-    coords_EMC = geopy.distance.lonlat("4.5301190909178", "51.955118652773")
-    df_postcodes["distance"] = df_postcodes[["lon", "lat"]].apply(
-        lambda x: geopy.distance.distance(
-            geopy.distance.lonlat(x["lon"], x["lat"]), coords_EMC
-        ).m,
-        axis=1,
-    )
-    # lat en lon kolommen kunnen nu weg
-    df_postcodes = df_postcodes.drop(columns=["lon", "lat"])
-    # Merge op originele dataframe
-    df = df.merge(df_postcodes, how="left", left_on="postcode", right_on="postcode")
+    locaties = locaties or ZIEKENHUIS_LOCATIES
+    logger.info("Afstanden per postcode opzoeken")
+    postcodes, afstanden = afstanden_tabel(locaties)
+
+    # Zoek alleen de unieke postcodes op, postcodes die niet in de tabel staan krijgen geen afstand
+    codes, uniek = pd.factorize(df["postcode"])
+    uniek = np.asarray(uniek, dtype=str)
+    positie = np.minimum(np.searchsorted(postcodes, uniek), len(postcodes) - 1)
+    gevonden = postcodes[positie] == uniek
+    for i, naam in enumerate(locaties):
+        afstand_uniek = np.where(gevonden, afstanden[positie, i], np.nan)
+        kolom = "distance" if i == 0 else f"distance_{naam}"
+        df[kolom] = np.append(afstand_uniek, np.nan)[codes]
 
     return df
 
 
-def vakantie_check(df):
+def vakantiedagen(jaren):
     """
-    Deze functie genereert voor elk jaar de lijst met vakantiedagen en voegt toe
-    of een afspraak op een vakantie dag valt
+    Deze functie genereert voor elk jaar de lijst met vakantiedagen, als dagnummer
+    (aantal dagen sinds 1970-01-01)
     """
+    # workalendar is traag om te importeren en alleen nodig om de tabel te maken
+    from workalendar.europe import NetherlandsWithSchoolHolidays as NL
+
     logger = logging.getLogger()
 
     # lijst met alle relevantie vakantiedatums aanmaken
     calendar = NL(region="middle", carnival_instead_of_spring=False)
 
-    # De jaren waar overheen geloopt moet worden
-    jaren = sorted(pd.DatetimeIndex(df["DATUM"]).year.unique().tolist())
-
     # Haal per jaar alle vakantiedagen op en maak er 1 grote lijst van
+    holiday_list = []
     for jaar in jaren:
         try:
             holiday_list_jaar = np.array(calendar.holidays(jaar))
 
             # Voeg een paar feestdagen toe die er niet in stonden
-            extra1 = np.array(
-                [
-                    (
-                        holiday_list_jaar[
-                            holiday_list_jaar[:, 1] == "Ascension Thursday"
-                        ][0, 0]
-                        + timedelta(1),
-                        "Ascension Friday",
-                    )
-                ]
-            )
-            extra2 = np.array(
-                [
-                    (
-                        holiday_list_jaar[holiday_list_jaar[:, 1] == "Boxing Day"][0, 0]
-                        - timedelta(21),
-                        "Sinterklaas",
-                    )
-                ]
-            )
-            holiday_list_jaar = np.append(holiday_list_jaar, extra1, axis=0)
-            holiday_list_jaar = np.append(holiday_list_jaar, extra2, axis=0)
-
-            if jaar == min(jaren):
-                holiday_list = holiday_list_jaar
-            else:
-                holiday_list = np.append(holiday_list, holiday_list_jaar, axis=0)
+            extra1 = holiday_list_jaar[holiday_list_jaar[:, 1] == "Ascension Thursday"][
+                0, 0
+            ] + timedelta(1)
+            extra2 = holiday_list_jaar[holiday_list_jaar[:, 1] == "Boxing Day"][
+                0, 0
+            ] - timedelta(21)
+            holiday_list += list(holiday_list_jaar[:, 0]) + [extra1, extra2]
         except:
             logger.info(f"Voor jaar {jaar} de vakantiedagen niet kunnen ophalen")
-    # Zet in dataframe
-    df_holiday = pd.DataFrame({"DATUM": pd.to_datetime(holiday_list[:, 0])})
-    df_holiday = df_holiday.drop_duplicates(subset=["DATUM"])
+
+    dagen = np.array(holiday_list, dtype="datetime64[D]").astype("int64")
+    return pd.DataFrame({"dag": np.unique(dagen)})
+
+
+@gemeten()
+def vakantie_check(df):
+    """
+    Deze functie voegt toe of een afspraak op een vakantie dag valt. De vakantiedagen
+    van VAKANTIE_JAREN (of meer, als de data daarbuiten valt) worden 1 keer berekend en
+    in de referentie cache opgeslagen, daarna is het alleen een opzoeking op dagnummer
+    """
+    # De jaren waar de tabel minimaal voor nodig is
+    jaren = pd.DatetimeIndex(df["DATUM"]).year.dropna()
+    eerste_jaar, laatste_jaar = VAKANTIE_JAREN
+    if len(jaren):
+        eerste_jaar = min(eerste_jaar, int(jaren.min()))
+        laatste_jaar = max(laatste_jaar, int(jaren.max()))
+    dagen = haal_referentie(
+        "vakantiedagen",
+        lambda: vakantiedagen(range(eerste_jaar, laatste_jaar + 1)),
+        bron=bron_versie(eerste_jaar, laatste_jaar),
+    )["dag"].to_numpy()
+
+    # Bitmap met voor elke dag tussen de eerste en laatste vakantiedag of het een vakantiedag is
+    bitmap = np.zeros(dagen.max() - dagen.min() + 1, dtype=bool)
+    bitmap[dagen - dagen.min()] = True
+
+    # Alleen datums zonder tijd (om middernacht) kunnen een vakantiedag zijn, net als bij een merge op DATUM
+    datum = df["DATUM"].to_numpy(dtype="datetime64[ns]")
+    dag = datum.astype("datetime64[D]")
+    positie = dag.astype("int64") - dagen.min()
+    geldig = (
+        ~np.isnat(datum) & (dag == datum) & (positie >= 0) & (positie < len(bitmap))
+    )
     # Feature maken of de datum in een vakantie valt
-    df_holiday["vakantie"] = True
-    df = df.merge(df_holiday, how="left", on="DATUM")
-    df["vakantie"] = df["vakantie"].fillna(False)
+    df["vakantie"] = False
+    df.loc[geldig, "vakantie"] = bitmap[positie[geldig]]
 
     return df
 
 
-def rolling_count_time_window(df_join, window_size, time_col, count_cols):
+def rolling_count_time_window(
+    df_join, window_size, time_col, count_cols, extra_windows=()
+):
     """
-    Functie om een kolom op te tellen binnen een tijdsraam, rekening houdend met de vertragin
+    Functie om een kolom op te tellen binnen een tijdsraam, rekening houdend met de vertraging
     van de beldienst
     Input
     - df_join: dataframe waar de telling over gedaan moet worden
     - window_size: grootte van het tijdsraam in aantal dagen
     - time_col: de tijdskolom waar de telling op gebaseerd is
-    - count_col: de kolom waar de telling over gedaan moet worden
+    - count_cols: de kolommen waar de telling over gedaan moet worden
+    - extra_windows: optioneel, extra tijdsramen in dagen (bijv. 30 en 90) voor extra features
 
     Output:
-    - df_join met een extra kolom (rolling_count_(count_col)) met de telling binnen het tijdsraam
+    - df_join met een extra kolom (rolling_count_(count_col)) met de telling binnen het tijdsraam,
+        en per extra tijdsraam een kolom rolling_count_(window)_(count_col)
     """
 
-    # Maak een kopie van het dataframe waar we de tellingen op gaan doen en
-    # daarna terug-joinen op het originele dataframe
-    df_rol = df_join[["patientnr", "afspraaknr", time_col] + count_cols].copy()
-
-    # Bepaal de rolling count over 1 jaar
-    df_rol_year = (
-        df_rol.drop(columns=["afspraaknr"])
-        .groupby("patientnr", as_index=False)
-        .rolling(window=f"{window_size}D", on=time_col)
-        .sum()
+    # Sorteer (stabiel) op patient en tijd, alle tijdsramen worden dan in 1 keer bepaald met
+    # prefix sommen per patient
+    groep = pd.factorize(df_join["patientnr"])[0]
+    tijden = df_join[time_col].to_numpy(dtype="datetime64[ns]")
+    volgorde = np.lexsort((tijden, groep))
+    tijden = tijden[volgorde]
+
+    # Om de dagen uit te sluiten tussen bellen en plaatsvinden tellen we alleen rijen tot 3/4/5
+    # dagen voor de rij zelf mee (afhankelijk van de weekdag)
+    weekdag = df_join[time_col].dt.weekday.to_numpy()[volgorde]
+    vertraging = pd.Series(weekdag).map(BEL_VERTRAGING).to_numpy()
+
+    vensters = [window_size] + [w for w in extra_windows if w != window_size]
+    sommen = rolling_sommen(
+        groep[volgorde],
+        tijden,
+        df_join[count_cols].to_numpy(dtype="int64")[volgorde],
+        vensters,
+        vertraging=vertraging,
     )
-    # Om de dagen uit te sluiten tussen bellen en plaatsvinden kunnen we de rolling
-    # counts van 3/4/5 dagen van de grotere rolling count aftrekken (afhankelijk van de weekdag)
-    df_rol_3 = (
-        df_rol.drop(columns=["afspraaknr"])
-        .groupby("patientnr", as_index=False)
-        .rolling(window="3D", on=time_col)
-        .sum()
-    )
-    df_rol_4 = (
-        df_rol.drop(columns=["afspraaknr"])
-        .groupby("patientnr", as_index=False)
-        .rolling(window="4D", on=time_col)
-        .sum()
-    )
-    df_rol_5 = (
-        df_rol.drop(columns=["afspraaknr"])
-        .groupby("patientnr", as_index=False)
-        .rolling(window="5D", on=time_col)
-        .sum()
-    )
-
-    # Zet de counts in hetzelfde dataframe
-    df_rol[[f"rolling_count_365_{x}" for x in count_cols]] = df_rol_year[count_cols]
-    df_rol[[f"rolling_count_3_{x}" for x in count_cols]] = df_rol_3[count_cols]
-    df_rol[[f"rolling_count_4_{x}" for x in count_cols]] = df_rol_4[count_cols]
-    df_rol[[f"rolling_count_5_{x}" for x in count_cols]] = df_rol_5[count_cols]
-
-    # Join de count terug
-    df_join = df_join.merge(
-        df_rol.drop(columns=count_cols),
-        how="left",
-        on=["patientnr", "afspraaknr", time_col],
-    )
-
-    # Bepaal, afhankelijk van de weekdag, welke kolommen gebruikt moeten worden om de uiteindelijke
-    # count te bepalen
-    for count_col in count_cols:
-        df_join.loc[
-            df_join[time_col].apply(datetime.weekday).isin([0, 1, 2]),
-            f"rolling_count_{count_col}",
-        ] = (
-            df_join[f"rolling_count_365_{count_col}"]
-            - df_join[f"rolling_count_5_{count_col}"]
-        )
-        df_join.loc[
-            df_join[time_col].apply(datetime.weekday).isin([3, 4, 5]),
-            f"rolling_count_{count_col}",
-        ] = (
-            df_join[f"rolling_count_365_{count_col}"]
-            - df_join[f"rolling_count_3_{count_col}"]
-        )
-        df_join.loc[
-            df_join[time_col].apply(datetime.weekday).isin([6]),
-            f"rolling_count_{count_col}",
-        ] = (
-            df_join[f"rolling_count_365_{count_col}"]
-            - df_join[f"rolling_count_4_{count_col}"]
-        )
 
-        # Gooi de kolommen weg die in deze functie gemaakt zijn maar hierna niet meer relevant
-        df_join = df_join.drop(
-            columns=[
-                f"rolling_count_365_{count_col}",
-                f"rolling_count_3_{count_col}",
-                f"rolling_count_4_{count_col}",
-                f"rolling_count_5_{count_col}",
-            ]
-        )
+    # Zet de tellingen terug in de originele volgorde
+    terug = np.empty_like(volgorde)
+    terug[volgorde] = np.arange(len(volgorde))
+    for venster in vensters:
+        for i, count_col in enumerate(count_cols):
+            naam = (
+                f"rolling_count_{count_col}"
+                if venster == window_size
+                else f"rolling_count_{venster}_{count_col}"
+            )
+            df_join[naam] = sommen[venster][terug, i].astype(float)
 
     return df_join
 
 
-def feature_afspraken(df, afspr_gesch):
+def benodigde_producenten(features=None):
     """
-    Doel: Maak features aan voor no show model
+    Doel: bepaal welke feature producenten uitgevoerd moeten worden voor een lijst met features,
+            inclusief de producenten waar die weer van afhangen
     Input:
-        - df: dataframe met output van preproces. Elke rij staat voor een 'gereserveerd tijdslot', een geblokkeerd moment die uiteindelijk een show/no show/verplaatsing/annulering werd
+        - features: lijst met kolommen (bijv. de feature_list uit de model settings). Kolommen die
+                geen producent hebben (zoals LEEFTIJD) zitten al in de data. None = alle producenten
     Output:
-        - df: dezelfde dataframe als input maar nu met extra kolommen (features) erbij
-
+        - set met namen uit FEATURE_PRODUCENTEN
+    """
+    if features is None:
+        return set(FEATURE_PRODUCENTEN)
+    producenten = set()
+    te_doen = list(features)
+    while te_doen:
+        kolom = te_doen.pop()
+        for naam, producent in FEATURE_PRODUCENTEN.items():
+            if naam not in producenten and any(
+                kolom == maakt or kolom.startswith(f"{maakt}_")
+                for maakt in producent["maakt"]
+            ):
+                producenten.add(naam)
+                te_doen += producent["nodig"]
+    return producenten
+
+
+def kwantielen_uit_features(features=None):
+    """
+    Doel: haal de extra kwantielen van de stiptheid uit een lijst met features, zodat bijv.
+            rolling_min_op_tijd_p25 in de feature_list genoeg is om die kolom te maken
+    Output:
+        - tuple met de kwantielen (bijv. 0.25)
+    """
+    if features is None:
+        return ()
+    kwantielen = []
+    for kolom in features:
+        gevonden = re.fullmatch(r"rolling_min_op_tijd_p(\d+)", kolom)
+        if gevonden:
+            kwantielen.append(int(gevonden.group(1)) / 100)
+    return tuple(kwantielen)
+
+
+@gemeten()
+def markeer_gebeurtenissen(df):
+    """
+    Doel: bepaal per rij de beldatum en wat voor gebeurtenis de rij is (verplaatsing, show, no show),
+            dat is de basis voor de historische features
+    Input:
+        - df: dataframe met output van preproces
+    Output:
+        - df: gesorteerd op patientnr en actie_moment, met de kolommen weekdag, Beldatum, verplaatsing,
+                no_show, show, verplaatsing_door_pat, verplaatst en verplaatst_door_pat erbij
     """
-
-    logsetup.setup_logging()
-    logger = logging.getLogger()
-
-    ############################################################################
-    # Rolling count features
-    ############################################################################
-
-    logger.info("Bepaal rolling count features")
-
     # Maak de kolom 'beldag' aan. Om de train set zo eerlijk mogelijk op te zetten kunnen we
     # bij het aanmaken van de features alleen informatie mee van voor de beldag
     terugkijkdagen = {1: -5, 2: -5, 3: -5, 4: -3, 5: -3, 6: -3, 7: -4}
-    df["weekdag"] = df["DATUM"].apply(datetime.weekday) + 1
+    df["weekdag"] = df["DATUM"].dt.weekday + 1
     df["Beldatum"] = (
         df["DATUM"]
         + pd.to_timedelta(df["weekdag"].replace(terugkijkdagen), unit="d")
         + pd.to_timedelta(17, "h")
     )
 
-    # Om de rolling counts (afspraken en no shows) te bepalen willen we
-    # per afspraak alleen maar afspraken optellen die minder dan 1 jaar geleden
-    # hebben plaatsgevonden
-
     # Check of een afspraak al een keer verplaatst is of niet. Sorteer eerst de dataframe
     df = df.sort_values(["patientnr", "afspraaknr", "actie_moment"])
 
@@ -269,11 +295,6 @@ def feature_afspraken(df, afspr_gesch):
     # Sorteer op actie_moment, die geeft goed chronologisch weer wat er is gebeurd tijdens de afspraak mutaties
     df = df.sort_values(["patientnr", "actie_moment"])
 
-    # Rolling count op het aantal geplande momenten, dus aantal rijen
-    # De functie rolling_count_time_window telt de waardes in een specifieke kolom op. Als
-    # we de rijen willen tellen is elke kolom waarde 1
-
-    df["gepland"] = 1
     df["no_show"] = (df["voldaan_af"] == "N").astype(int)
     df["show"] = ((df["voldaan_af"] == "J") & (df["verplaatsing"] == 0)).astype(int)
     # Rolling count op het aantal verplaatsingen door de patient.
@@ -291,6 +312,61 @@ def feature_afspraken(df, afspr_gesch):
         (df["verplaatsing"] == 1) & (df["verplreden"].isin(door_pat))
     ).astype(int)
 
+    # Tel het totaal aantal verplaatsingen
+    df[["verplaatst", "verplaatst_door_pat"]] = (
+        df[["afspraaknr", "verplaatsing", "verplaatsing_door_pat"]]
+        .groupby(["afspraaknr"])[["verplaatsing", "verplaatsing_door_pat"]]
+        .cumsum()
+    )
+
+    return df
+
+
+@gemeten()
+def historie_features(df, afspr_gesch, op_tijd_kwantielen=(), producenten=None):
+    """
+    Doel: maak de features die van de afspraakgeschiedenis van de patient afhangen: de rolling counts,
+            de vorige show/no show/uitkomst en de stiptheid
+    Input:
+        - df: output van markeer_gebeurtenissen, met de volledige geschiedenis van de patienten
+        - afspr_gesch: aantal dagen geschiedenis voor de rolling features
+        - op_tijd_kwantielen: zie feature_afspraken
+        - producenten: optioneel, welke van HISTORIE_PRODUCENTEN uitgevoerd worden (zie
+                benodigde_producenten), standaard allemaal
+    Output:
+        - df: gesorteerd op patientnr, DATUM en TIJD, met de historische features erbij
+    """
+    if producenten is None:
+        producenten = set(HISTORIE_PRODUCENTEN)
+
+    if "rolling_counts" in producenten:
+        df = rolling_count_features(df, afspr_gesch)
+    if "vorige" in producenten:
+        df = vorige_features(df)
+
+    # Voor de stiptheid kijken we alleen naar de vroegste afspraak per datum. Ook zonder stiptheid
+    # wordt hierop gesorteerd, de volgorde bepaalt verderop de cumsum van verpl_door_arts
+    df = df.sort_values(["patientnr", "DATUM", "TIJD"])
+    if "stiptheid" in producenten:
+        df = stiptheid_features(df, afspr_gesch, op_tijd_kwantielen)
+
+    return df
+
+
+@gemeten()
+def rolling_count_features(df, afspr_gesch):
+    """
+    Doel: tel per rij het aantal geplande momenten, shows, no shows en verplaatsingen in de
+            afgelopen afspr_gesch dagen (tot de beldag)
+    """
+    # Om de rolling counts (afspraken en no shows) te bepalen willen we
+    # per afspraak alleen maar afspraken optellen die minder dan 1 jaar geleden
+    # hebben plaatsgevonden
+
+    # Rolling count op het aantal geplande momenten, dus aantal rijen
+    # De functie rolling_count_time_window telt de waardes in een specifieke kolom op. Als
+    # we de rijen willen tellen is elke kolom waarde 1
+    df["gepland"] = 1
     count_columns = [
         "gepland",
         "show",
@@ -301,177 +377,300 @@ def feature_afspraken(df, afspr_gesch):
     df = rolling_count_time_window(
         df, window_size=afspr_gesch, time_col="actie_moment", count_cols=count_columns
     )
-    df = df.drop(columns="gepland")
-
-    # Tel het totaal aantal verplaatsingen
-    df[["verplaatst", "verplaatst_door_pat"]] = (
-        df[["afspraaknr", "verplaatsing", "verplaatsing_door_pat"]]
-        .groupby(["afspraaknr"])[["verplaatsing", "verplaatsing_door_pat"]]
-        .cumsum()
-    )
-    # Het percentage van het aantal geplande momenten die in een no-show is geeindigd
-    df["no_show_perc"] = df["rolling_count_no_show"] / df["rolling_count_gepland"]
-    df["no_show_perc"] = df["no_show_perc"].fillna(0)
+    return df.drop(columns="gepland")
 
-    ############################################################################
-    # Tijd sinds vorige show
-    ############################################################################
 
+@gemeten()
+def vorige_features(df):
+    """
+    Doel: bepaal per rij wanneer de vorige show en no show van de patient was en wat de uitkomst van
+            de vorige afspraak was, op of voor de beldatum. Als df een DOEL_KOLOM heeft wordt dat alleen
+            voor de doelrijen opgezocht, de overige rijen blijven leeg
+    """
     # Bepaal het aantal dagen sinds de patient voor het laatst gezien is, oftewel
     # wanneer de vorige show was.
 
-    # Om de tijd tot de vorige show te berekenen nemen we eerst de shows zelf apart
+    # Om de tijd tot de vorige show te berekenen nemen we eerst de shows zelf apart, de laatste
+    # (op datum) van elke afspraak
     df_af = (
         df[
             ((df["voldaan_af"] == "J") | (df["voldaan_af"].isna()))
             & (df["verplaatsing"] == 0)
         ]
-        .sort_values(["patientnr", "DATUM"])
+        .sort_values("DATUM", kind="stable")
         .drop_duplicates(subset=["patientnr", "afspraaknr"], keep="last")
     )
-
-    # Sorteren is nodig voor de merge_asof functie
-    df = df.sort_values("Beldatum")
-    df_af = df_af.sort_values("DATUMTIJD")
-    # Merge_asof doet een left join maar dan op basis van de dichtsbijzijnde match
-    # ipv dat een exacte match geeist wordt. De merge op beldatum en de datum van shows
-    # pakt deze functie dus de eerste show voor de beldatum
-    df = pd.merge_asof(
-        df,
-        df_af[["patientnr", "DATUMTIJD"]].rename(columns={"DATUMTIJD": "vorige_show"}),
-        by="patientnr",
-        left_on="Beldatum",
-        right_on="vorige_show",
-        direction="backward",
-    )
-
     # Bepaal op eenzelfde manier de tijd sinds de vorige noshow
     df_ns = (
         df[(df["voldaan_af"] == "N")]
-        .sort_values(["patientnr", "DATUM"])
+        .sort_values("DATUM", kind="stable")
         .drop_duplicates(subset=["patientnr", "afspraaknr"], keep="last")
     )
 
-    # Sorteren is nodig voor de merge_asof functie
-    df = df.sort_values("Beldatum")
-    df_ns = df_ns.sort_values("DATUMTIJD")
-    df = pd.merge_asof(
-        df,
-        df_ns[["patientnr", "DATUMTIJD"]].rename(
-            columns={"DATUMTIJD": "vorige_noshow"}
-        ),
-        by="patientnr",
-        left_on="Beldatum",
-        right_on="vorige_noshow",
-        direction="backward",
-    )
-
-    # Bepaal op eenzelfde manier de uitkomst van de vorige afspraak
-    df_prev = df.sort_values(["patientnr", "DATUMTIJD"]).drop_duplicates(
-        subset=["patientnr", "DATUM"], keep="last"
-    )
-    # Sorteren is nodig voor de merge_asof functie
-    df = df.sort_values("Beldatum")
-    df_prev = df_prev.sort_values("DATUM")
-    # Merge_asof doet een left join maar dan op basis van de dichtsbijzijnde match
-    # ipv dat een exact match geeist wordt. De merge op beldatum en de datum van shows
-    # pakt deze functie dus de eerst show voor de beldatum
-    df = pd.merge_asof(
-        df,
-        df_prev[["patientnr", "DATUM", "voldaan_af"]].rename(
-            columns={"voldaan_af": "vorige_voldaan"}
-        ),
-        by="patientnr",
-        left_on="Beldatum",
-        right_on="DATUM",
-        direction="backward",
-    )
-    df = df.drop(columns="DATUM_y").rename(columns={"DATUM_x": "DATUM"})
-    # Bepaald dagen sinds vorige show
-    df["dagen_sinds_afspraak"] = (df["DATUMTIJD"] - df["vorige_show"]) / timedelta(
-        days=1
+    # Per patient de laatste show, de laatste no-show en de uitkomst van de vorige afspraak (de laatste
+    # afspraak op de laatste datum) op of voor de beldatum, in 1 keer. Voor een extra 'laatste X voor
+    # de beldatum' feature is een extra soort gebeurtenis genoeg
+    doel = (
+        df[DOEL_KOLOM].to_numpy()
+        if DOEL_KOLOM in df.columns
+        else np.ones(len(df), dtype=bool)
     )
-    df["dagen_sinds_noshow"] = (df["DATUMTIJD"] - df["vorige_noshow"]) / timedelta(
-        days=1
+    vorige = laatste_gebeurtenissen(
+        df["patientnr"].to_numpy()[doel],
+        df["Beldatum"].to_numpy()[doel],
+        {
+            "vorige_show": (
+                df_af["patientnr"],
+                df_af["DATUMTIJD"],
+                df_af["DATUMTIJD"],
+                None,
+            ),
+            "vorige_noshow": (
+                df_ns["patientnr"],
+                df_ns["DATUMTIJD"],
+                df_ns["DATUMTIJD"],
+                None,
+            ),
+            "vorige_voldaan": (
+                df["patientnr"],
+                df["DATUM"],
+                df["voldaan_af"],
+                df["DATUMTIJD"],
+            ),
+        },
     )
+    # Rijen die geen doelrij zijn krijgen via reindex een lege waarde, met behoud van het datatype
+    positie = np.where(doel, np.cumsum(doel) - 1, -1)
+    for kolom, waarde in vorige.items():
+        df[kolom] = waarde.reindex(positie).to_numpy()
 
-    # Zet dagen tot afspraak om in een integer aantal dagen
-    df["dagen_tot_afspraak"] = df["dagen_tot_afspraak"].round("D").dt.days
+    return df
 
-    ############################################################################
-    # Stiptheid patient
-    ############################################################################
 
+@gemeten()
+def stiptheid_features(df, afspr_gesch, op_tijd_kwantielen=()):
+    """
+    Doel: rolling median (en eventueel andere kwantielen) van het aantal minuten dat de patient op tijd
+            was, over de afgelopen afspr_gesch dagen
+    Input:
+        - df: gesorteerd op patientnr, DATUM en TIJD
+    """
     # Voor de stiptheid kijken we alleen naar de vroegste afspraak per datum. Verplaatsingen
     # nemen we hiervoor niet mee (mochten ze toche en aankomsttijd hebben om een of andere reden)
-    df = df.sort_values(["patientnr", "DATUM", "TIJD"])
-
     df_aankomst = df[(df["verplaatsing"] == 0)].drop_duplicates(["patientnr", "DATUM"])
-    # Hoeveel minuten was de patient op tijd
+    # Hoeveel minuten was de patient op tijd, de tijden zijn in de preprocessing al omgezet in minuten
     df_aankomst["min_op_tijd"] = (
-        pd.to_datetime(df_aankomst["TIJDMIN"]) - pd.to_datetime(df_aankomst["aankomst"])
-    ) / np.timedelta64(1, "m")
-    # Rolling median op min_op_tijd, we nemen maar 1 jaar geschiedenis mee van de patient
-    df_aankomst["rolling_min_op_tijd"] = df_aankomst.groupby("patientnr")[
-        ["min_op_tijd", "DATUM"]
-    ].apply(lambda x: x.rolling(f"{afspr_gesch}D", on="DATUM").median())["min_op_tijd"]
-    # Verschuif de kolom in rij omlaag, voor de afspraak zelf weet je nog niet wanneer de patient aankomt
-    df_aankomst["rolling_min_op_tijd"] = df_aankomst.groupby("patientnr")[
-        "rolling_min_op_tijd"
-    ].transform("shift")
+        df_aankomst["tijd_minuut"] - df_aankomst["aankomst_minuut"]
+    )
+    # Rolling median (en eventueel andere kwantielen) op min_op_tijd, we nemen maar 1 jaar geschiedenis
+    # mee van de patient. Het venster is dat van de vorige afspraak, want voor de afspraak zelf weet je
+    # nog niet wanneer de patient aankomt
+    kwantiel_kolommen = {0.5: "rolling_min_op_tijd"}
+    for kwantiel in op_tijd_kwantielen:
+        if kwantiel != 0.5:
+            kwantiel_kolommen[kwantiel] = (
+                f"rolling_min_op_tijd_p{round(kwantiel * 100)}"
+            )
+    kwantielen = rolling_kwantielen(
+        pd.factorize(df_aankomst["patientnr"])[0],
+        df_aankomst["DATUM"],
+        df_aankomst["min_op_tijd"],
+        afspr_gesch,
+        kwantielen=list(kwantiel_kolommen),
+    )
+    for kwantiel, kolom in kwantiel_kolommen.items():
+        df_aankomst[kolom] = kwantielen[kwantiel]
 
     # Join terug op originele dataframe
     df = pd.merge(
         df,
-        df_aankomst[["afspraaknr", "rolling_min_op_tijd", "DATUMTIJD"]],
+        df_aankomst[["afspraaknr", "DATUMTIJD"] + list(kwantiel_kolommen.values())],
         how="left",
         on=["afspraaknr", "DATUMTIJD"],
     )
     # Forward fill mochten er nog gaatjes zijn
-    df["rolling_min_op_tijd"] = (
-        df[["patientnr", "rolling_min_op_tijd"]]
-        .groupby(["patientnr"])["rolling_min_op_tijd"]
-        .ffill()
+    for kolom in kwantiel_kolommen.values():
+        df[kolom] = df[["patientnr", kolom]].groupby(["patientnr"])[kolom].ffill()
+
+    return df
+
+
+def neem_historie_over(df, historie):
+    """
+    Doel: neem de historische features over uit de op de geschiedenis bepaalde features, per rij
+            (afspraaknr, actie_moment, volgnummer)
+    Input:
+        - df: output van markeer_gebeurtenissen
+        - historie: output van historie_features, met in ieder geval alle rijen van df
+    Output:
+        - df: in dezelfde volgorde als na historie_features, met de historische features erbij
+    """
+    kolommen = [kolom for kolom in historie.columns if kolom not in df.columns]
+    df = df.sort_values(["patientnr", "DATUM", "TIJD"])
+    return pd.merge(
+        df,
+        historie[HISTORIE_SLEUTEL + kolommen],
+        how="left",
+        on=HISTORIE_SLEUTEL,
     )
 
+
+@gemeten()
+def feature_afspraken(
+    df,
+    afspr_gesch,
+    locaties=None,
+    op_tijd_kwantielen=(),
+    historie=None,
+    features=None,
+    doelen=None,
+):
+    """
+    Doel: Maak features aan voor no show model
+    Input:
+        - df: dataframe met output van preproces. Elke rij staat voor een 'gereserveerd tijdslot', een geblokkeerd moment die uiteindelijk een show/no show/verplaatsing/annulering werd
+        - afspr_gesch: aantal dagen geschiedenis voor de rolling features
+        - locaties: optioneel, dict met naam: (lon, lat) van de ziekenhuislocaties voor de afstand features
+        - op_tijd_kwantielen: optioneel, extra kwantielen (bijv. 0.25 en 0.75) van de stiptheid naast de
+                mediaan, als kolommen rolling_min_op_tijd_p(percentiel). Kolommen
+                rolling_min_op_tijd_p(percentiel) in features worden hier altijd aan toegevoegd
+        - historie: optioneel, gemarkeerde geschiedenis van de patienten uit de feature state (zie
+                feature_state.historie_voor). De historische features worden dan daarop bepaald in
+                plaats van op df, zodat df alleen de recente mutaties hoeft te bevatten
+        - features: optioneel, lijst met features die nodig zijn (bijv. de feature_list). Alleen de
+                feature producenten die daarvoor nodig zijn worden uitgevoerd (zie FEATURE_PRODUCENTEN),
+                standaard alle
+        - doelen: optioneel, dict met de argumenten van filter_afspraken (datum_range, polis,
+                afspraakcodes, subagendas_exclude en eventueel alle_polis en regels). De overige rijen
+                zijn dan alleen geschiedenis: ze tellen mee in de historische features, maar de
+                per rij features (zoals de afstand en de vakantie) worden alleen voor de doelrijen bepaald
+    Output:
+        - df: dezelfde dataframe als input maar nu met extra kolommen (features) erbij. Met doelen
+            alleen de doelrijen, verder gelijk aan de output zonder doelen na filter_afspraken
+
+    """
+
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    producenten = benodigde_producenten(features)
+    logger.info(f"Feature producenten: {', '.join(sorted(producenten))}")
+    op_tijd_kwantielen = tuple(op_tijd_kwantielen) + kwantielen_uit_features(features)
+
+    # Patienten zonder doelrijen zijn niet nodig, de features zijn per patient onafhankelijk
+    if doelen is not None:
+        doel = doel_mask(df, **doelen)
+        patienten = df["patientnr"].isin(df.loc[doel, "patientnr"]).to_numpy()
+        logger.info(
+            f"{doel.sum()} van de {len(df)} rijen zijn doelrijen, {patienten.sum()} rijen van patienten met een doelrij"
+        )
+        df = df[patienten].copy()
+        df[DOEL_KOLOM] = doel[patienten]
+        if historie is not None:
+            historie = historie[historie["patientnr"].isin(df["patientnr"])]
+
+    logger.info("Bepaal historische features")
+    df = markeer_gebeurtenissen(df)
+    historie_producenten = producenten.intersection(HISTORIE_PRODUCENTEN)
+    if historie is None:
+        df = historie_features(
+            df,
+            afspr_gesch,
+            op_tijd_kwantielen=op_tijd_kwantielen,
+            producenten=historie_producenten,
+        )
+    else:
+        df = neem_historie_over(
+            df,
+            historie_features(
+                historie,
+                afspr_gesch,
+                op_tijd_kwantielen=op_tijd_kwantielen,
+                producenten=historie_producenten,
+            ),
+        )
+
+    # Het percentage van het aantal geplande momenten die in een no-show is geeindigd
+    if "no_show_perc" in producenten:
+        df["no_show_perc"] = df["rolling_count_no_show"] / df["rolling_count_gepland"]
+        df["no_show_perc"] = df["no_show_perc"].fillna(0)
+
+    # Bepaald dagen sinds vorige show
+    if "dagen_sinds" in producenten:
+        df["dagen_sinds_afspraak"] = (df["DATUMTIJD"] - df["vorige_show"]) / timedelta(
+            days=1
+        )
+        df["dagen_sinds_noshow"] = (df["DATUMTIJD"] - df["vorige_noshow"]) / timedelta(
+            days=1
+        )
+
+    # Zet dagen tot afspraak om in een integer aantal dagen
+    df["dagen_tot_afspraak"] = df["dagen_tot_afspraak"].round("D").dt.days
+
+    # Vanaf hier zijn alleen de doelrijen nodig, plus de rijen van dezelfde afspraak (voor
+    # verpl_door_arts) en van dezelfde patient en datum (voor afspraken_dag)
+    if doelen is not None:
+        doel = df[DOEL_KOLOM].to_numpy()
+        patient_datum = pd.MultiIndex.from_arrays([df["patientnr"], df["DATUM"]])
+        context = df["afspraaknr"].isin(df.loc[doel, "afspraaknr"]).to_numpy() | (
+            patient_datum.isin(patient_datum[doel])
+        )
+        df = df[context].copy()
+
     ############################################################################
     # Overige features
     ############################################################################
     logger.info("Bepaal overige features")
 
     # Afstand tot ziekenhuis
-    df = afstand_tot_ziekenhuis(df)
+    if "afstand" in producenten:
+        df = afstand_tot_ziekenhuis(df, locaties=locaties)
 
     # Check of de afspraak een keer door de arts is verplaatst of niet
-    df["verpl_door_arts"] = (df["voldaan_af"] == "Door Arts").astype(int)
-    # Forward fill op deze kolom binnen elke afspraak, zodat onthouden wordt dat de afspraak een keer door de arts gemuteerd is
-    df["verpl_door_arts"] = (
-        df[["afspraaknr", "verpl_door_arts"]]
-        .groupby(["afspraaknr"])["verpl_door_arts"]
-        .cumsum()
-    )
+    if "verpl_door_arts" in producenten:
+        df["verpl_door_arts"] = (df["voldaan_af"] == "Door Arts").astype(int)
+        # Forward fill op deze kolom binnen elke afspraak, zodat onthouden wordt dat de afspraak een keer door de arts gemuteerd is
+        df["verpl_door_arts"] = (
+            df[["afspraaknr", "verpl_door_arts"]]
+            .groupby(["afspraaknr"])["verpl_door_arts"]
+            .cumsum()
+        )
 
     # Patient is nieuw als die nog nooit een show is geweest.
-    df["Nieuwe_patient"] = df["rolling_count_show"] < 1
+    if "Nieuwe_patient" in producenten:
+        df["Nieuwe_patient"] = df["rolling_count_show"] < 1
 
-    df["TIJD"] = df["TIJD"].str.split(":").str[0]
-    df["TIJD"] = df["TIJD"].astype(float)
+    # Het uur van de afspraak
+    df["TIJD"] = np.floor(df["tijd_minuut"] / 60)
 
     # Eerst sorteren op patient, en datum zodat de feature creatie goed gaat
     # df.sort_values(by=['patientnr','JAAR','MAAND', 'DAG', 'TIJD'], ascending=True, inplace=True)
     df = df.sort_values(["patientnr", "DATUM", "TIJDMIN"])
     # Groepeer per datum en maak een kolom voor het aantal afspraken op die dag
-    df["afspraken_dag"] = (
-        df[df["actie_moment"] > df["Beldatum"]]
-        .groupby(["patientnr", "DATUM"])["afspraaknr"]
-        .transform("nunique")
-    )
+    if "afspraken_dag" in producenten:
+        df["afspraken_dag"] = (
+            df[df["actie_moment"] > df["Beldatum"]]
+            .groupby(["patientnr", "DATUM"])["afspraaknr"]
+            .transform("nunique")
+            # Altijd float, ook als elke rij een waarde heeft (bijv. met alleen doelrijen)
+            .astype(float)
+        )
 
-    df = vakantie_check(df)
+    if doelen is not None:
+        df = df[df[DOEL_KOLOM]].drop(columns=DOEL_KOLOM)
 
-    df["maand"] = df["DATUM"].dt.month_name()
+    if "vakantie" in producenten:
+        df = vakantie_check(df)
+    # Nummer de rijen opnieuw, de volgorde is nu op patient, datum en tijd
+    df = df.reset_index(drop=True)
+
+    if "maand" in producenten:
+        df["maand"] = df["DATUM"].dt.month_name()
     df["weekdag"] = df["weekdag"].astype(str)
 
+    # De geparste tijdvelden zijn alleen voor intern gebruik
+    df = df.drop(columns=HULPKOLOMMEN)
+
     logger.info("Eind feature building")
 
     return df
@@ -0,0 +1,292 @@
+import logsetup
+import logging
+
+import json
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pandas as pd
+
+from featurebuilding.feature_afspraken import (
+    HISTORIE_SLEUTEL,
+    feature_afspraken,
+    markeer_gebeurtenissen,
+)
+from preprocess.preprocess_incrementeel import (
+    herstel_categories,
+    lees_parquet,
+    schrijf_parquet,
+)
+from utilities.unify_cwd import unify_cwd
+from utilities.instrumentatie import gemeten
+
+# Verhoog bij een wijziging in STATE_KOLOMMEN, in markeer_gebeurtenissen of in de datatypes van
+# ingest_afspraken, een state met een andere versie wordt dan opnieuw opgebouwd
+STATE_VERSIE = 3
+
+# Per rij de gemarkeerde gebeurtenis, dat is alles wat historie_features nodig heeft
+STATE_KOLOMMEN = HISTORIE_SLEUTEL + [
+    "patientnr",
+    "DATUM",
+    "TIJD",
+    "DATUMTIJD",
+    "Beldatum",
+    "tijd_minuut",
+    "aankomst_minuut",
+    "voldaan_af",
+    "verplaatsing",
+    "verplaatsing_door_pat",
+    "show",
+    "no_show",
+]
+
+
+def feature_state_pad(submodus):
+    """
+    Doel: de map waar de feature state voor een submodus bewaard wordt
+    """
+    cwd = Path.cwd()
+    cwd = unify_cwd(cwd)
+    return cwd / "Python" / "cache" / f"feature_state_{submodus}"
+
+
+def lees_state_metadata(pad):
+    """
+    Doel: lees de metadata van de feature state
+    Output:
+        - dict met versie, afspr_gesch, watermark, dekking_vanaf, bijgewerkt en rijen, of None als er
+            nog geen (complete) state met de huidige versie is
+    """
+    pad = Path(pad)
+    if not (
+        (pad / "state.json").is_file() and (pad / "gebeurtenissen.parquet").is_file()
+    ):
+        return None
+    with open(pad / "state.json", "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+    if metadata.get("versie") != STATE_VERSIE:
+        return None
+    return metadata
+
+
+def state_laadbereik(afspr_gesch, bijwerk_dagen, datum_range, pad):
+    """
+    Doel: bepaal welke mutaties ingeladen moeten worden om de feature state bij te werken, als
+            datum_range en afspr_gesch voor create_dataset
+    Input:
+        - afspr_gesch: aantal dagen geschiedenis voor de rolling features
+        - bijwerk_dagen: aantal dagen na de datum van een afspraak waarin nog mutaties (zoals de
+                uitkomst) kunnen binnenkomen
+        - datum_range: datum range van de run
+        - pad: map van de state
+    Output:
+        - datum_range en afspr_gesch om in te laden
+    Zonder bruikbare state wordt de volledige geschiedenis van de run ingeladen. Anders alle
+    patienten met een afspraak vanaf bijwerk_dagen voor de watermark, met bijwerk_dagen geschiedenis:
+    zo komen de nieuwe mutaties van elke patient in de state, ook van patienten die vandaag niet
+    voorspeld worden. De state bevat alle afspraken vanaf dekking_vanaf, zolang dat niet
+    afspr_gesch dagen voor de datum range ligt worden nog alle patienten met hun volledige
+    geschiedenis ingeladen (aanvullen).
+    """
+    metadata = lees_state_metadata(pad)
+    if (
+        metadata is None
+        or metadata["afspr_gesch"] != afspr_gesch
+        or metadata.get("dekking_vanaf") is None
+    ):
+        return datum_range, afspr_gesch
+    ondergrens = pd.to_datetime(datum_range[0], format="%Y-%m-%d")
+    watermark = pd.Timestamp(metadata["watermark"]).normalize()
+    start = min(ondergrens, watermark - timedelta(bijwerk_dagen))
+    laadbereik = [f"{start:%Y-%m-%d}", datum_range[1]]
+    if pd.Timestamp(metadata["dekking_vanaf"]) > ondergrens - timedelta(afspr_gesch):
+        return laadbereik, afspr_gesch
+    return laadbereik, bijwerk_dagen
+
+
+@gemeten()
+def werk_feature_state_bij(df, afspr_gesch, datum_range=None, pad=None):
+    """
+    Doel: werk de feature state bij met de voorbewerkte afspraken van vandaag. De state bevat per
+            rij de gemarkeerde gebeurtenis (zie markeer_gebeurtenissen) van alle afspraken die nog
+            binnen de afspraakgeschiedenis vallen. Afspraken die in df zitten vervangen die in de
+            state, zodat nieuwe mutaties van een bestaande afspraak goed verwerkt worden
+    Input:
+        - df: output van de preprocessing op de mutaties uit state_laadbereik
+        - afspr_gesch: aantal dagen geschiedenis voor de rolling features
+        - datum_range: optioneel, datum range van de run. Afspraken waarvan de laatste datum meer
+                dan afspr_gesch dagen voor de datum range ligt worden uit de state verwijderd
+        - pad: map van de state, standaard Python/cache/feature_state_voorspel
+    Output:
+        - state: dataframe met de gemarkeerde gebeurtenissen
+    Naast de state wordt de watermark (het laatste mutatie_moment in de state) bewaard en vanaf welke
+    datum alle afspraken in de state zitten, zie state_laadbereik.
+    """
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    pad = Path(pad) if pad is not None else feature_state_pad("voorspel")
+    nieuw = markeer_gebeurtenissen(df.copy())[STATE_KOLOMMEN]
+    watermark = df["mutatie_moment"].max()
+
+    metadata = lees_state_metadata(pad)
+    if metadata is None or metadata["afspr_gesch"] != afspr_gesch:
+        logger.info("Geen bruikbare feature state gevonden, nieuwe state opbouwen")
+        state = nieuw
+        # Van alle patienten met een afspraak in de datum range zit de hele geschiedenis erin
+        dekking_vanaf = datum_range[0] if datum_range is not None else None
+    else:
+        state = lees_parquet(pad / "gebeurtenissen.parquet")
+        bestaand = state[~state["afspraaknr"].isin(nieuw["afspraaknr"])]
+        state = herstel_categories(
+            pd.concat([bestaand, nieuw], ignore_index=True), nieuw
+        )
+        dekking_vanaf = metadata.get("dekking_vanaf")
+        if not pd.isna(pd.Timestamp(metadata["watermark"])):
+            watermark = max(pd.Timestamp(metadata["watermark"]), watermark)
+        logger.info(
+            f"Feature state bijgewerkt: {len(bestaand)} bestaande en {len(nieuw)} nieuwe rijen"
+        )
+
+    # Afspraken die buiten de afspraakgeschiedenis vallen zijn niet meer nodig
+    if datum_range is not None:
+        ondergrens = pd.to_datetime(datum_range[0], errors="coerce")
+        if not pd.isna(ondergrens):
+            laatste_datum = state.groupby("afspraaknr", observed=True)["DATUM"].max()
+            oud = laatste_datum.index[
+                laatste_datum < ondergrens - timedelta(afspr_gesch)
+            ]
+            state = state[~state["afspraaknr"].isin(oud)]
+            logger.info(
+                f"{len(oud)} verlopen afspraken uit de feature state verwijderd"
+            )
+
+    state = state.reset_index(drop=True)
+    pad.mkdir(parents=True, exist_ok=True)
+    schrijf_parquet(state, pad / "gebeurtenissen.parquet")
+    tijdelijk = pad / "state.json.tmp"
+    with open(tijdelijk, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "versie": STATE_VERSIE,
+                "afspr_gesch": afspr_gesch,
+                "watermark": pd.Timestamp(watermark).isoformat(),
+                "dekking_vanaf": dekking_vanaf,
+                "bijgewerkt": datetime.now().isoformat(),
+                "rijen": len(state),
+            },
+            f,
+            indent=4,
+        )
+    os.replace(tijdelijk, pad / "state.json")
+    logger.info(f"Feature state bijgewerkt tot mutatie_moment {watermark}")
+
+    return state
+
+
+def historie_voor(state, df):
+    """
+    Doel: de geschiedenis uit de feature state van de patienten in df, in dezelfde volgorde als
+            markeer_gebeurtenissen oplevert, als input voor feature_afspraken(historie=...)
+    """
+    historie = state[state["patientnr"].isin(df["patientnr"])]
+    return historie.sort_values(
+        ["patientnr", "afspraaknr", "actie_moment"]
+    ).sort_values(["patientnr", "actie_moment"])
+
+
+def vergelijk_met_batch(df_state, df_batch):
+    """
+    Doel: vergelijk de features uit de feature state met die van feature_afspraken op de volledige
+            geschiedenis. Eerst moeten dezelfde rijen in beide zitten
+    Output:
+        - None als de features gelijk zijn, anders een beschrijving van het verschil
+    """
+    kolommen = [
+        kolom
+        for kolom in df_state.columns
+        if kolom in df_batch.columns and kolom not in HISTORIE_SLEUTEL
+    ]
+    samen = pd.merge(
+        df_state[HISTORIE_SLEUTEL + kolommen],
+        df_batch[HISTORIE_SLEUTEL + kolommen],
+        how="outer",
+        on=HISTORIE_SLEUTEL,
+        indicator=True,
+    )
+    alleen_state = int((samen["_merge"] == "left_only").sum())
+    alleen_batch = int((samen["_merge"] == "right_only").sum())
+    if alleen_state or alleen_batch:
+        return (
+            f"{alleen_state} rijen alleen in de features uit de state, "
+            f"{alleen_batch} alleen in de batch features"
+        )
+    verschillen = []
+    for kolom in kolommen:
+        a = samen[f"{kolom}_x"].astype(object)
+        b = samen[f"{kolom}_y"].astype(object)
+        anders = ~((a == b) | (a.isna() & b.isna()))
+        if anders.any():
+            verschillen.append(f"{kolom}: {int(anders.sum())} rijen verschillen")
+    return "; ".join(verschillen) or None
+
+
+def feature_afspraken_met_state(
+    df,
+    afspr_gesch,
+    datum_range=None,
+    locaties=None,
+    features=None,
+    volledig=None,
+    pad=None,
+    doelen=None,
+):
+    """
+    Doel: feature building voor de dagelijkse voorspelling met de feature state. De state wordt
+            bijgewerkt met de afspraken in df, daarna worden de historische features uit de state
+            gehaald en de overige features uit df zelf
+    Input:
+        - df: output van de preprocessing op de mutaties uit state_laadbereik
+        - afspr_gesch, locaties, features, doelen: zie feature_afspraken. Met doelen krijgen alleen de
+                afspraken van de run features, df bevat ook patienten die alleen voor de state nodig zijn
+        - datum_range: datum range van de run, voor het opruimen van de state
+        - volledig: optioneel, output van de preprocessing op de volledige geschiedenis van de run
+                (create_dataset met datum_range en afspr_gesch). De features uit de state worden
+                vergeleken met feature_afspraken daarop, bij een verschil wordt dat resultaat teruggegeven
+        - pad: map van de state, standaard Python/cache/feature_state_voorspel
+    Output:
+        - df: zie feature_afspraken
+    """
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    state = werk_feature_state_bij(
+        df, afspr_gesch=afspr_gesch, datum_range=datum_range, pad=pad
+    )
+    df_state = feature_afspraken(
+        df,
+        afspr_gesch=afspr_gesch,
+        locaties=locaties,
+        historie=historie_voor(state, df),
+        features=features,
+        doelen=doelen,
+    )
+    if volledig is None:
+        return df_state
+
+    df_batch = feature_afspraken(
+        volledig,
+        afspr_gesch=afspr_gesch,
+        locaties=locaties,
+        features=features,
+        doelen=doelen,
+    )
+    verschil = vergelijk_met_batch(df_state, df_batch)
+    if verschil is not None:
+        logger.warning(
+            f"Features uit de feature state wijken af van de batch features, batch features gebruikt: {verschil}"
+        )
+        return df_batch
+    logger.info("Features uit de feature state gelijk aan de batch features")
+    return df_state
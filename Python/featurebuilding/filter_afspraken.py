@@ -1,57 +1,239 @@
+import sqlite3
+from contextlib import closing
+
+import numpy as np
 import pandas as pd
 
+from utilities.instrumentatie import gemeten
 
-def filter_afspraken(
-    df, datum_range, polis, afspraakcodes, subagendas_exclude, alle_polis=False
+# Per soort regel uit de model_settings de kolom in de dataframe en de key met de lijst codes
+REGEL_KOLOMMEN = {
+    "afspraakcodes": ("CODE", "codes"),
+    "subagendas_exclude": ("subagenda", "subagendas"),
+}
+
+
+def compileer_regels(afspraakcodes, subagendas_exclude):
+    """
+    Doel: zet de uitsluitregels uit de model_settings om in een index die in een keer op de hele
+            dataframe toegepast kan worden. Per kolom (CODE en subagenda) komen er twee soorten regels:
+                - uitsluiten: (poli, code) paren die eruit moeten (include "False")
+                - alleen: per poli de (poli, code) paren die over mogen blijven (include "True")
+    Input:
+        - afspraakcodes: dict met per poli include en codes
+        - subagendas_exclude: dict met per poli include en subagendas
+    Output:
+        - regels: dict met per kolom een dict met "uitsluiten" (set met paren), "alleen" (set met
+            paren) en "alleen_polis" (set met de polis waar een alleen regel voor geldt)
+    """
+    regels = {}
+    for soort, regels_soort in (
+        ("afspraakcodes", afspraakcodes),
+        ("subagendas_exclude", subagendas_exclude),
+    ):
+        kolom, key = REGEL_KOLOMMEN[soort]
+        regel = regels.setdefault(
+            kolom, {"uitsluiten": set(), "alleen": set(), "alleen_polis": set()}
+        )
+        for poli, code_dict in regels_soort.items():
+            codes = code_dict.get(key) or []
+            include = code_dict.get("include")
+            if include == "False":
+                regel["uitsluiten"].update((poli, code) for code in codes)
+            if include == "True":
+                regel["alleen"].update((poli, code) for code in codes)
+                regel["alleen_polis"].add(poli)
+    return regels
+
+
+def regels_mask(df, regels):
+    """
+    Doel: bepaal per rij of die door de uitsluitregels (zie compileer_regels) eruit gaat
+    Output:
+        - boolean array, True voor de rijen die eruit moeten
+    """
+    mask = np.zeros(len(df), dtype=bool)
+    for kolom, regel in regels.items():
+        if not (regel["uitsluiten"] or regel["alleen_polis"]):
+            continue
+        paren = pd.MultiIndex.from_arrays(
+            [df["polikliniek"].astype(object), df[kolom].astype(object)]
+        )
+        if regel["uitsluiten"]:
+            mask |= paren.isin(list(regel["uitsluiten"]))
+        if regel["alleen_polis"]:
+            mask |= df["polikliniek"].isin(list(regel["alleen_polis"])).to_numpy() & (
+                ~paren.isin(list(regel["alleen"]))
+            )
+    return mask
+
+
+def sql_tekst(waarde):
+    """
+    Doel: een waarde als SQL string literal
+    """
+    return "'" + str(waarde).replace("'", "''") + "'"
+
+
+def regels_als_sql(regels, kolommen=None):
+    """
+    Doel: de uitsluitregels (zie compileer_regels) als SQL predicaat, voor in de WHERE van een query
+    Input:
+        - regels: output van compileer_regels
+        - kolommen: optioneel, dict van kolomnaam in de dataframe (polikliniek, CODE, subagenda) naar
+                de kolom in de query, standaard dezelfde naam
+    Output:
+        - predicaat dat waar is voor de rijen die blijven, "1 = 1" als er geen regels zijn
+    Let op: het predicaat geldt alleen voor de doelrijen, de afspraken in de datum range zelf.
+    Afspraken die met de regels uitgesloten worden tellen wel mee als geschiedenis voor de features,
+    in een query hoort het dus in een conditie als "DATUM < begin OR (predicaat)". Zie
+    vergelijk_regels_sql voor een controle dat het predicaat dezelfde rijen uitsluit als regels_mask.
+    """
+    kolommen = kolommen or {}
+    poli_kolom = kolommen.get("polikliniek", "polikliniek")
+    condities = []
+    for kolom, regel in regels.items():
+        sql_kolom = kolommen.get(kolom, kolom)
+        uitsluiten = {}
+        for poli, code in regel["uitsluiten"]:
+            uitsluiten.setdefault(poli, []).append(code)
+        alleen = {poli: [] for poli in regel["alleen_polis"]}
+        for poli, code in regel["alleen"]:
+            alleen[poli].append(code)
+
+        # Met IS NOT NULL blijft een rij met een lege poli of code net als in regels_mask staan, in
+        # plaats van dat de hele conditie NULL wordt (en de rij uit de WHERE valt)
+        for poli, codes in sorted(uitsluiten.items()):
+            lijst = ", ".join(sql_tekst(code) for code in sorted(codes))
+            condities.append(
+                f"({poli_kolom} IS NOT NULL AND {poli_kolom} = {sql_tekst(poli)} AND {sql_kolom} IS NOT NULL AND {sql_kolom} IN ({lijst}))"
+            )
+        for poli, codes in sorted(alleen.items()):
+            # Zonder toegestane codes gaat de hele poli eruit. Een lege code telt net als in
+            # regels_mask niet als toegestaan
+            conditie = f"{poli_kolom} IS NOT NULL AND {poli_kolom} = {sql_tekst(poli)}"
+            if codes:
+                lijst = ", ".join(sql_tekst(code) for code in sorted(codes))
+                conditie += (
+                    f" AND ({sql_kolom} IS NULL OR {sql_kolom} NOT IN ({lijst}))"
+                )
+            condities.append(f"({conditie})")
+
+    if not condities:
+        return "1 = 1"
+    return "NOT (" + " OR ".join(condities) + ")"
+
+
+def vergelijk_regels_sql(df, regels):
+    """
+    Doel: controleer of regels_als_sql dezelfde rijen uitsluit als regels_mask, door het predicaat
+            in een sqlite database in het geheugen op de rijen van df uit te voeren
+    Input:
+        - df: dataframe met polikliniek en de kolommen van de regels, lege waardes worden NULL
+        - regels: output van compileer_regels
+    Output:
+        - None als beide dezelfde rijen uitsluiten, anders een beschrijving van het verschil
+    """
+    tabel = pd.DataFrame({"rij": np.arange(len(df))})
+    for kolom in ["polikliniek", *regels]:
+        waardes = df[kolom].astype(object)
+        tabel[kolom] = waardes.where(waardes.notna(), None).to_numpy()
+    with closing(sqlite3.connect(":memory:")) as verbinding:
+        tabel.to_sql("afspraken", verbinding, index=False)
+        blijft_sql = pd.read_sql(
+            f"SELECT rij FROM afspraken WHERE {regels_als_sql(regels)}", verbinding
+        )["rij"]
+    blijft_sql = np.isin(tabel["rij"].to_numpy(), blijft_sql.to_numpy())
+    verschil = blijft_sql != ~regels_mask(df, regels)
+    if not verschil.any():
+        return None
+    voorbeelden = tabel.loc[verschil, ["polikliniek", *regels]].head(5)
+    return f"{int(verschil.sum())} rijen verschillen, bijv. {voorbeelden.to_dict('records')}"
+
+
+def doel_mask(
+    df,
+    datum_range,
+    polis,
+    afspraakcodes,
+    subagendas_exclude,
+    alle_polis=False,
+    regels=None,
 ):
     """
-    Doel: in de originele dataframe zit de afspraakgeschiedenis nog in. Filter hier
-            naar alleen de afspraken in de opgegeven tijdsperiode
+    Doel: bepaal welke rijen doelrijen zijn: de afspraken die na filter_afspraken overblijven. Werkt
+            ook al voor de feature building, dan is dagen_tot_afspraak nog een timedelta
     Input:
-        - df: dataframe waar alle features bij zijn aangemaakt
-        - datum_range: datum range waar we eerder in de query hadden ingevuld waar we naar willen kijken
-        - polis_dict: dict met alle poliklinieken/agenda codes
+        - zie filter_afspraken
     Output:
-        - df: dataframe gefilterd zodat alleen de relevante rijen nog over zijn
-    df kan gebruikt worden om een model op te trainen of een voorspelling over te doen
+        - boolean array, True voor de doelrijen
     """
     # Als de arts (of het ziekenhuis) de reden is dan willen we er niet op trainen
-    df = df[(df["voldaan_af"].isna()) | (df["voldaan_af"].isin(["J", "N"]))]
-    df["voldaan_af"] = df["voldaan_af"].replace({"J": 0, "N": 1})
+    mask = ((df["voldaan_af"].isna()) | (df["voldaan_af"].isin(["J", "N"]))).to_numpy()
 
     # Filter op tijdsperiode waar we naar kijken
     lower_bound = pd.to_datetime(datum_range[0], format="%Y-%m-%d")
     upper_bound = pd.to_datetime(datum_range[1], format="%Y-%m-%d")
-    date_mask = (df["DATUM"] >= lower_bound) & (df["DATUM"] <= upper_bound)
-    df = df.loc[date_mask]
+    mask &= ((df["DATUM"] >= lower_bound) & (df["DATUM"] <= upper_bound)).to_numpy()
     # Filter op de poliklinieken waar we naar willen kijken
     if not alle_polis:
-        df = df.loc[df["polikliniek"].isin(polis)]
+        mask &= df["polikliniek"].isin(polis).to_numpy()
+    # Voor de feature building is dagen_tot_afspraak nog niet omgezet in een aantal dagen
+    dagen_tot_afspraak = df["dagen_tot_afspraak"]
+    if pd.api.types.is_timedelta64_dtype(dagen_tot_afspraak):
+        dagen_tot_afspraak = dagen_tot_afspraak.round("D").dt.days
     # Afspraken die minder dan een week vooruit zijn gepland willen we niet voor bellen
-    df = df[df["dagen_tot_afspraak"] >= 7]
+    mask &= (dagen_tot_afspraak >= 7).to_numpy()
     # Afspraakhorizon van 3 maanden
-    df = df[df["dagen_tot_afspraak"] < 90]
+    mask &= (dagen_tot_afspraak < 90).to_numpy()
 
-    df = df[(df["contacttype"] == "F") & (df["zonder_patient"] == 0)]
+    mask &= ((df["contacttype"] == "F") & (df["zonder_patient"] == 0)).to_numpy()
     # In de model_settings.json staat een lijst met agenda en bijbehorden afspraakcodes (geleverd door poliklinieken zelf)
     # waar met geen herinnering over wil. Deze zijn dus wel meegenomen in de preprocess en featurebuilding,
     # maar moeten uit de dataset
-    for poli, code_dict in afspraakcodes.items():
-        codes = code_dict.get("codes")
-        include = code_dict.get("include")
-        if include == "False":
-            mask = (df["polikliniek"] == poli) & (df["CODE"].isin(codes))
-        if include == "True":
-            mask = (df["polikliniek"] == poli) & (~df["CODE"].isin(codes))
-        df = df[~mask]
-
-    for poli, code_dict in subagendas_exclude.items():
-        codes = code_dict.get("subagendas")
-        include = code_dict.get("include")
-        if include == "False":
-            mask = (df["polikliniek"] == poli) & (df["subagenda"].isin(codes))
-        if include == "True":
-            mask = (df["polikliniek"] == poli) & (~df["subagenda"].isin(codes))
-        df = df[~mask]
+    if regels is None:
+        regels = compileer_regels(afspraakcodes, subagendas_exclude)
+    mask &= ~regels_mask(df, regels)
+
+    return mask
+
+
+@gemeten()
+def filter_afspraken(
+    df,
+    datum_range,
+    polis,
+    afspraakcodes,
+    subagendas_exclude,
+    alle_polis=False,
+    regels=None,
+):
+    """
+    Doel: in de originele dataframe zit de afspraakgeschiedenis nog in. Filter hier
+            naar alleen de afspraken in de opgegeven tijdsperiode
+    Input:
+        - df: dataframe waar alle features bij zijn aangemaakt
+        - datum_range: datum range waar we eerder in de query hadden ingevuld waar we naar willen kijken
+        - polis_dict: dict met alle poliklinieken/agenda codes
+        - regels: optioneel, de al gecompileerde afspraakcodes en subagendas_exclude (zie
+                compileer_regels), om dat niet bij elke aanroep opnieuw te doen
+    Output:
+        - df: dataframe gefilterd zodat alleen de relevante rijen nog over zijn
+    df kan gebruikt worden om een model op te trainen of een voorspelling over te doen
+    Alle voorwaarden worden in een mask gecombineerd (zie doel_mask), zodat de dataframe maar een keer
+    gekopieerd wordt.
+    """
+    mask = doel_mask(
+        df,
+        datum_range,
+        polis,
+        afspraakcodes,
+        subagendas_exclude,
+        alle_polis=alle_polis,
+        regels=regels,
+    )
+
+    df = df.loc[mask].copy()
+    df["voldaan_af"] = df["voldaan_af"].replace({"J": 0, "N": 1})
 
     return df
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+
+def laatste_gebeurtenissen(patientnr, moment, gebeurtenissen):
+    """
+    Doel: zoek voor elke rij per soort gebeurtenis de laatste gebeurtenis van dezelfde patient op of voor
+            een moment (zoals een backward merge_asof), voor alle soorten tegelijk. Alle gebeurtenissen
+            komen in 1 gesorteerde stroom per patient, per soort wordt de positie van de laatste
+            gebeurtenis doorgeschoven en met 1 searchsorted wordt per rij de plek in de stroom bepaald.
+    Input:
+        - patientnr: array met het patientnr per rij
+        - moment: datetime64 array met per rij het moment waarop of waarvoor de gebeurtenis moet liggen
+        - gebeurtenissen: dict met per soort (naam) een tuple (patientnr, tijd, waarde, volgorde):
+                - patientnr en tijd (datetime64) van de gebeurtenissen
+                - waarde: Series met de waarde die teruggegeven wordt
+                - volgorde: optioneel, tijden of gehele getallen. Bij gelijke tijd wint de gebeurtenis
+                        met de hoogste volgorde
+    Output:
+        - dict met per soort een Series (zelfde lengte als moment) met de waarde van de laatste
+            gebeurtenis, leeg (NaN/NaT) als er geen gebeurtenis is
+    """
+    namen = list(gebeurtenissen)
+    aantallen = [len(gebeurtenissen[naam][0]) for naam in namen]
+    n_rijen = len(moment)
+
+    # Patientnummers en tijden van rijen en gebeurtenissen samen coderen
+    groep, _ = pd.factorize(
+        np.concatenate(
+            [np.asarray(patientnr)]
+            + [np.asarray(gebeurtenissen[naam][0]) for naam in namen]
+        )
+    )
+    tijden = np.concatenate(
+        [np.asarray(moment, dtype="datetime64[ns]")]
+        + [
+            np.asarray(gebeurtenissen[naam][1], dtype="datetime64[ns]")
+            for naam in namen
+        ]
+    ).view("int64")
+    volgorde = np.concatenate(
+        [np.zeros(n_rijen, dtype="int64")]
+        + [
+            als_int64(gebeurtenissen[naam][3], aantal)
+            for naam, aantal in zip(namen, aantallen)
+        ]
+    )
+    soort = np.repeat(np.arange(-1, len(namen)), [n_rijen] + aantallen)
+    bron = np.concatenate([np.arange(n_rijen)] + [np.arange(a) for a in aantallen])
+
+    # Combineer patient en tijd tot 1 oplopende sleutel (zie rolling_vensters.venster_starts)
+    uniek = np.unique(tijden)
+    n_rang = len(uniek) + 1
+    sleutel = groep * n_rang + np.searchsorted(uniek, tijden)
+
+    # Sorteer alleen de gebeurtenissen, op patient, tijd en volgorde
+    is_gebeurtenis = soort >= 0
+    positie = np.flatnonzero(is_gebeurtenis)
+    positie = positie[np.lexsort((volgorde[positie], sleutel[positie]))]
+    stroom_sleutel = sleutel[positie]
+    stroom_soort = soort[positie]
+    stroom_bron = bron[positie]
+
+    # Voor elke rij: de laatste gebeurtenis op of voor het moment, en de eerste gebeurtenis van de patient
+    rij_sleutel = sleutel[:n_rijen]
+    rij_groep = groep[:n_rijen]
+    eind = np.searchsorted(stroom_sleutel, rij_sleutel, side="right") - 1
+    begin = np.searchsorted(stroom_sleutel, rij_groep * n_rang, side="left")
+
+    resultaat = {}
+    for i, naam in enumerate(namen):
+        # Positie van de laatste gebeurtenis van deze soort tot en met elke plek in de stroom,
+        # met een -1 achteraan voor rijen zonder gebeurtenis ervoor
+        laatste = np.maximum.accumulate(
+            np.where(stroom_soort == i, np.arange(len(stroom_soort)), -1)
+        )
+        gevonden = np.append(laatste, -1)[eind]
+        geldig = (gevonden >= 0) & (gevonden >= begin)
+        rijen = np.where(geldig, np.append(stroom_bron, -1)[gevonden], -1)
+        # Met reindex worden rijen zonder gebeurtenis leeg, met behoud van het datatype
+        resultaat[naam] = (
+            gebeurtenissen[naam][2].reset_index(drop=True).reindex(rijen)
+        ).reset_index(drop=True)
+    return resultaat
+
+
+def als_int64(waardes, aantal):
+    """
+    Doel: zet tijden of gehele getallen om in int64 voor het sorteren, zonder waardes alleen nullen
+    """
+    if waardes is None:
+        return np.zeros(aantal, dtype="int64")
+    waardes = np.asarray(waardes)
+    if waardes.dtype.kind == "M":
+        waardes = waardes.astype("datetime64[ns]").view("int64")
+    return waardes.astype("int64")
@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+from pandas.api.indexers import BaseIndexer
+
+# Hoeveel dagen er, afhankelijk van de weekdag van de afspraak (maandag = 0), tussen het bellen
+# en de afspraak zitten. Informatie van na de beldag mag niet meegenomen worden
+BEL_VERTRAGING = {0: 5, 1: 5, 2: 5, 3: 3, 4: 3, 5: 3, 6: 4}
+
+
+def venster_starts(groep, tijden, ondergrens):
+    """
+    Doel: bepaal voor elke rij de eerste rij van dezelfde groep met een tijd na de ondergrens
+    Input:
+        - groep: array met groepscodes (int)
+        - tijden: array met tijden (int64), gesorteerd op groep en dan tijd
+        - ondergrens: array met per rij de ondergrens van het venster (int64)
+    Output:
+        - array met posities. Omdat de tijd van een rij zelf altijd na de ondergrens ligt, valt de
+            start nooit na de rij zelf
+    """
+    # Combineer groep en tijd tot 1 oplopende sleutel: de groepscode keer het aantal verschillende
+    # tijden plus de rang van de tijd. Dan is 1 searchsorted genoeg voor alle groepen tegelijk
+    uniek = np.unique(tijden)
+    n_rang = len(uniek) + 1
+    sleutel = groep * n_rang + np.searchsorted(uniek, tijden)
+    rang_grens = np.searchsorted(uniek, ondergrens, side="right")
+    return np.searchsorted(sleutel, groep * n_rang + rang_grens, side="left")
+
+
+def rolling_sommen(groep, tijden, waardes, vensters, vertraging=None):
+    """
+    Doel: tel per rij de waardes op van eerdere rijen van dezelfde groep binnen een aantal tijdsvensters,
+            voor alle vensters tegelijk via prefix sommen
+    Input:
+        - groep: array met groepscodes (int)
+        - tijden: datetime64 array, gesorteerd op groep en dan tijd
+        - waardes: 2d array (rijen x kolommen) met de op te tellen waardes
+        - vensters: lijst met venstergroottes in dagen
+        - vertraging: optioneel, array met per rij het aantal dagen dat uitgesloten wordt. Zonder
+                vertraging telt een rij tot en met zichzelf mee (net als DataFrame.rolling), met
+                vertraging alleen rijen met een tijd tot en met tijd - vertraging
+    Output:
+        - dict met per venster een 2d array (rijen x kolommen) met de sommen
+    """
+    tijden = np.asarray(tijden, dtype="datetime64[ns]").view("int64")
+    dag = np.int64(pd.Timedelta(1, "D").value)
+    prefix = np.zeros((len(tijden) + 1, waardes.shape[1]), dtype=waardes.dtype)
+    np.cumsum(waardes, axis=0, out=prefix[1:])
+
+    if vertraging is None:
+        eind = np.arange(1, len(tijden) + 1)
+    else:
+        eind = venster_starts(groep, tijden, tijden - np.asarray(vertraging) * dag)
+
+    sommen = {}
+    for venster in vensters:
+        start = venster_starts(groep, tijden, tijden - np.int64(venster) * dag)
+        # Bij een vertraging die groter is dan het venster valt er niks in het venster
+        sommen[venster] = prefix[np.maximum(eind, start)] - prefix[start]
+    return sommen
+
+
+class VasteVensters(BaseIndexer):
+    """
+    Vensters met vooraf bepaalde start en eind posities (eind exclusief), zodat DataFrame.rolling
+    over alle groepen tegelijk kan rekenen in plaats van per groep
+    """
+
+    def get_window_bounds(
+        self, num_values=0, min_periods=None, center=None, closed=None, step=None
+    ):
+        return self.start, self.eind
+
+
+def rolling_kwantielen(groep, tijden, waardes, venster, kwantielen=(0.5,)):
+    """
+    Doel: bepaal per rij kwantielen (bijv. de mediaan) van de waardes binnen een tijdsvenster, zoals die
+            bij de vorige rij van dezelfde groep waren. Dat is hetzelfde als een rolling median per groep
+            gevolgd door een shift binnen de groep, maar in 1 keer voor alle groepen
+    Input:
+        - groep: array met groepscodes (int)
+        - tijden: datetime64 array, gesorteerd op groep en dan tijd
+        - waardes: array met waardes, lege waardes (NaN) tellen niet mee
+        - venster: venstergrootte in dagen
+        - kwantielen: lijst met kwantielen tussen 0 en 1
+    Output:
+        - dict met per kwantiel een array, NaN als er geen waardes in het venster vallen
+    """
+    tijden = np.asarray(tijden, dtype="datetime64[ns]").view("int64")
+    dag = np.int64(pd.Timedelta(1, "D").value)
+    starts = venster_starts(groep, tijden, tijden - np.int64(venster) * dag)
+
+    # Het venster van rij i is het venster van rij i - 1: van de start van de vorige rij tot
+    # en met de vorige rij. Voor de eerste rij van een groep is het venster leeg
+    n = len(tijden)
+    eind = np.arange(n, dtype="int64")
+    start = eind.copy()
+    zelfde_groep = np.zeros(n, dtype=bool)
+    zelfde_groep[1:] = groep[1:] == groep[:-1]
+    start[zelfde_groep] = starts[np.flatnonzero(zelfde_groep) - 1]
+
+    rolling = pd.Series(waardes, dtype=float).rolling(
+        VasteVensters(start=start, eind=eind), min_periods=1
+    )
+    return {
+        kwantiel: (
+            rolling.median() if kwantiel == 0.5 else rolling.quantile(kwantiel)
+        ).to_numpy()
+        for kwantiel in kwantielen
+    }
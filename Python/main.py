@@ -1,3 +1,4 @@
+import atexit
 import warnings
 import logsetup
 import logging
@@ -6,9 +7,16 @@ from init_modelsettings import init_modelsettings
 from init_serversettings import init_serversettings
 
 from readwrite import create_dataset, load_dataset, radiologie_verplaatsreden
+from preprocess.ingest_afspraken import ingest_afspraken, als_kolom_dtype
 from preprocess.preprocess_afspraken import preprocess_afspraken
+from preprocess.preprocess_incrementeel import preprocess_incrementeel
 from featurebuilding.feature_afspraken import feature_afspraken
-from featurebuilding.filter_afspraken import filter_afspraken
+from featurebuilding.feature_state import (
+    feature_afspraken_met_state,
+    feature_state_pad,
+    state_laadbereik,
+)
+from featurebuilding.filter_afspraken import compileer_regels, filter_afspraken
 from modelling.voorspel import (
     gebelde_patienten_afgelopen_week,
     momenteel_opgenomen_patienten,
@@ -16,6 +24,9 @@ from modelling.voorspel import (
     patienten_nietbellen,
 )
 from modelling.train import train_all_models
+from utilities.sharding import verwerk_per_patient
+from utilities.datum_chunks import datum_vensters, verwerk_in_chunks
+from utilities.instrumentatie import meet_stap, schrijf_rapport
 
 from DSPackage.write_data.check_db import check_voorspellingen_vandaag
 from DSPackage.write_data.write import write_to_db
@@ -32,6 +43,8 @@ logger = logging.getLogger()
 pipeline_env = get_pipeline_env()
 server_settings = init_serversettings()
 model_settings = init_modelsettings()
+# Tijden en aantallen rijen per stap, aan het eind van de run weggeschreven als json rapport
+atexit.register(schrijf_rapport, modus=model_settings["modus"])
 # update_package('ds_package', model_settings['package_buildid'], pipeline_env)
 # Op de data is al preprocessing en feature building gedaan, haal alle data op uit de relevante noshow tabel
 
@@ -63,35 +76,207 @@ if model_settings["modus"] in ("create_train", "create_holdout", "voorspel"):
     else:
         vandaag_al_voorspeld = False
 
-    if not vandaag_al_voorspeld:
-        # Vuur query af op database om dataset in te laden
-        df = create_dataset(
-            server=server_settings["readserver"],
-            database=server_settings["readdatabase"],
-            schema=server_settings["readschema"],
-            models=model_settings["models"],
-            poliklinieken=model_settings["poliklinieken"],
-            datum_range=dates,
-            afspr_gesch=model_settings["afspr_gesch"],
+    chunks = model_settings.get("chunks", {})
+    if submodus in ("train", "holdout") and chunks.get("actief", False):
+        # Bouw de dataset per datum venster op, elk venster met zijn eigen afspraakgeschiedenis. Het
+        # geheugengebruik hangt dan af van de grootte van een venster in plaats van de hele datum range
+        regels = compileer_regels(
+            model_settings["afspraakcodes"], model_settings["subagendas_exclude"]
         )
 
-        # Omdat de verwijderreden voor de radiologie afspraken in een los onderdeel van HiX terecht komt
-        # halen we die hier apart op. Dit doen we los omdat het anders een hoop dubbele regels oplevert
-        # in de hoofdquery
-        if "Radiologie" in model_settings["models"]:
-            df = radiologie_verplaatsreden(
-                df=df,
+        def laad_chunk(venster):
+            df = create_dataset(
                 server=server_settings["readserver"],
                 database=server_settings["readdatabase"],
                 schema=server_settings["readschema"],
-                datum_range=dates,
+                models=model_settings["models"],
+                poliklinieken=model_settings["poliklinieken"],
+                datum_range=venster,
                 afspr_gesch=model_settings["afspr_gesch"],
             )
+            if "Radiologie" in model_settings["models"]:
+                df = radiologie_verplaatsreden(
+                    df=df,
+                    server=server_settings["readserver"],
+                    database=server_settings["readdatabase"],
+                    schema=server_settings["readschema"],
+                    datum_range=venster,
+                    afspr_gesch=model_settings["afspr_gesch"],
+                )
+            return df
+
+        def verwerk_chunk(df, venster):
+            df = ingest_afspraken(df)
+            # Alleen de afspraken in dit venster krijgen alle features, de rest is geschiedenis
+            doelen = {
+                "datum_range": venster,
+                "polis": model_settings["models"],
+                "afspraakcodes": model_settings["afspraakcodes"],
+                "subagendas_exclude": model_settings["subagendas_exclude"],
+                "regels": regels,
+            }
+            df = verwerk_per_patient(
+                df,
+                stappen=[
+                    (preprocess_afspraken, {}),
+                    (
+                        feature_afspraken,
+                        {
+                            "afspr_gesch": model_settings["afspr_gesch"],
+                            "locaties": model_settings.get("locaties"),
+                            "features": model_settings.get("feature_list"),
+                            "doelen": doelen,
+                        },
+                    ),
+                ],
+                n_workers=model_settings.get("n_workers", 1),
+            )
+            return filter_afspraken(df, **doelen)
+
+        def schrijf_chunk(df, eerste):
+            # Het eerste venster vervangt de tabel, de volgende vensters worden toegevoegd
+            with meet_stap("write_to_db", df):
+                write_to_db(
+                    df,
+                    table=f"noshow_{submodus}",
+                    server=server_settings["writeserver"],
+                    database=server_settings["writedatabase"],
+                    schema=server_settings["writeschema"],
+                    replace=eerste,
+                    pipeline_env=pipeline_env,
+                    make_system_versioned=False,
+                )
+
+        verwerk_in_chunks(
+            datum_vensters(dates, chunks.get("dagen", 90)),
+            laad=laad_chunk,
+            verwerk=verwerk_chunk,
+            schrijf=schrijf_chunk,
+            # verwerk_per_patient start processen met fork, dan mag er geen laad thread draaien
+            vooruit_laden=model_settings.get("n_workers", 1) == 1,
+        )
+    elif not vandaag_al_voorspeld:
+        # Met een bruikbare feature state hoeven voor de voorspelling alleen de recente mutaties
+        # ingeladen te worden, de rest van de geschiedenis zit in de state
+        feature_state = model_settings.get("feature_state", {})
+        state_actief = submodus == "voorspel" and feature_state.get("actief", False)
+        dates_laden = dates
+        afspr_gesch_laden = model_settings["afspr_gesch"]
+        if state_actief:
+            dates_laden, afspr_gesch_laden = state_laadbereik(
+                model_settings["afspr_gesch"],
+                feature_state.get("bijwerk_dagen", 14),
+                dates,
+                pad=feature_state_pad(submodus),
+            )
+            logger.info(
+                f"Feature state bijwerken, afspraken van {dates_laden} met {afspr_gesch_laden} dagen geschiedenis inladen"
+            )
+
+        def laad_mutaties(datum_range, afspr_gesch):
+            # Vuur query af op database om dataset in te laden
+            with meet_stap("create_dataset") as stap:
+                df = create_dataset(
+                    server=server_settings["readserver"],
+                    database=server_settings["readdatabase"],
+                    schema=server_settings["readschema"],
+                    models=model_settings["models"],
+                    poliklinieken=model_settings["poliklinieken"],
+                    datum_range=datum_range,
+                    afspr_gesch=afspr_gesch,
+                )
+                stap["rijen_uit"] = len(df)
+
+            # Omdat de verwijderreden voor de radiologie afspraken in een los onderdeel van HiX terecht komt
+            # halen we die hier apart op. Dit doen we los omdat het anders een hoop dubbele regels oplevert
+            # in de hoofdquery
+            if "Radiologie" in model_settings["models"]:
+                df = radiologie_verplaatsreden(
+                    df=df,
+                    server=server_settings["readserver"],
+                    database=server_settings["readdatabase"],
+                    schema=server_settings["readschema"],
+                    datum_range=datum_range,
+                    afspr_gesch=afspr_gesch,
+                )
+            return df
+
+        df = laad_mutaties(dates_laden, afspr_gesch_laden)
         if not df.empty:
-            # Preprocessing
-            df = preprocess_afspraken(df)
-            # Feature building
-            df = feature_afspraken(df=df, afspr_gesch=model_settings["afspr_gesch"])
+            # Compacte datatypes, zodat de rest van de pipeline niet op strings hoeft te werken
+            df = ingest_afspraken(df)
+            # De afspraken die na filter_afspraken overblijven, alleen die krijgen alle features. De
+            # rest van de afspraken is alleen geschiedenis voor de historische features
+            doelen = {
+                "datum_range": dates,
+                "polis": model_settings["models"],
+                "afspraakcodes": model_settings["afspraakcodes"],
+                "subagendas_exclude": model_settings["subagendas_exclude"],
+            }
+            incrementeel = model_settings.get("preprocess_incrementeel", {})
+            n_workers = model_settings.get("n_workers", 1)
+            if (
+                submodus in ("train", "holdout")
+                and n_workers != 1
+                and not incrementeel.get("actief", False)
+            ):
+                # Preprocessing en feature building zijn per patient onafhankelijk, doe dat parallel
+                df = verwerk_per_patient(
+                    df,
+                    stappen=[
+                        (preprocess_afspraken, {}),
+                        (
+                            feature_afspraken,
+                            {
+                                "afspr_gesch": model_settings["afspr_gesch"],
+                                "locaties": model_settings.get("locaties"),
+                                "features": model_settings.get("feature_list"),
+                                "doelen": doelen,
+                            },
+                        ),
+                    ],
+                    n_workers=n_workers,
+                )
+            else:
+                # Preprocessing, incrementeel alleen voor afspraken met nieuwe mutaties als dat aan staat
+                if incrementeel.get("actief", False):
+                    df = preprocess_incrementeel(
+                        df,
+                        submodus=submodus,
+                        datum_range=dates_laden,
+                        afspr_gesch=model_settings["afspr_gesch"],
+                        verifieer=incrementeel.get("verifieer", False),
+                    )
+                else:
+                    df = preprocess_afspraken(df)
+                # Feature building, voor de voorspelling eventueel met de feature state
+                if state_actief:
+                    volledig = None
+                    if feature_state.get("verifieer", False):
+                        # Ter controle ook de volledige geschiedenis inladen, zoals zonder feature state
+                        volledig = preprocess_afspraken(
+                            ingest_afspraken(
+                                laad_mutaties(dates, model_settings["afspr_gesch"])
+                            )
+                        )
+                    df = feature_afspraken_met_state(
+                        df,
+                        afspr_gesch=model_settings["afspr_gesch"],
+                        datum_range=dates,
+                        locaties=model_settings.get("locaties"),
+                        features=model_settings.get("feature_list"),
+                        volledig=volledig,
+                        pad=feature_state_pad(submodus),
+                        doelen=doelen,
+                    )
+                else:
+                    df = feature_afspraken(
+                        df=df,
+                        afspr_gesch=model_settings["afspr_gesch"],
+                        locaties=model_settings.get("locaties"),
+                        features=model_settings.get("feature_list"),
+                        doelen=doelen,
+                    )
             # Filter op datum en poli, afspraakgeschiedenis kan nu weg
             df = filter_afspraken(
                 df == df,
@@ -110,17 +295,35 @@ if model_settings["modus"] in ("create_train", "create_holdout", "voorspel"):
                     gebelde_patienten = gebelde_patienten_afgelopen_week(
                         DBA_server_settings=server_settings["DBA_server"]
                     )
-                    df = df[~df["patientnr"].isin(gebelde_patienten)]
+                    with meet_stap("filter_gebelde_patienten", df) as stap:
+                        df = df[
+                            ~df["patientnr"].isin(
+                                als_kolom_dtype(gebelde_patienten, df["patientnr"])
+                            )
+                        ]
+                        stap["rijen_uit"] = len(df)
 
                     # Opgenomen patienten hoeven niet gebeld te worden
                     opgenomen_patienten = momenteel_opgenomen_patienten(
                         server_settings=server_settings
                     )
-                    df = df[~df["patientnr"].isin(opgenomen_patienten)]
+                    with meet_stap("filter_opgenomen_patienten", df) as stap:
+                        df = df[
+                            ~df["patientnr"].isin(
+                                als_kolom_dtype(opgenomen_patienten, df["patientnr"])
+                            )
+                        ]
+                        stap["rijen_uit"] = len(df)
 
                     # Patienten die niet gebeld willen worden kunnen eruit
                     nietbellen = patienten_nietbellen("patienten_nietbellen.json")
-                    df = df[~df["patientnr"].isin(nietbellen)]
+                    with meet_stap("filter_patienten_nietbellen", df) as stap:
+                        df = df[
+                            ~df["patientnr"].isin(
+                                als_kolom_dtype(nietbellen, df["patientnr"])
+                            )
+                        ]
+                        stap["rijen_uit"] = len(df)
 
                     df = voorspelling_voor_bellijst(
                         df=df,
@@ -129,6 +332,8 @@ if model_settings["modus"] in ("create_train", "create_holdout", "voorspel"):
                         models=model_settings["models"],
                         feature_list=model_settings["feature_list"],
                         beldienst_param=model_settings["beldienst_param"],
+                        native=model_settings.get("native_inferentie", False),
+                        n_workers=model_settings.get("n_workers_voorspel", 1),
                     )
                     replace = False
                     system_versioned = False
@@ -138,16 +343,17 @@ if model_settings["modus"] in ("create_train", "create_holdout", "voorspel"):
                     replace = True
                     system_versioned = False
 
-                write_to_db(
-                    df,
-                    table=write_table,
-                    server=server_settings["writeserver"],
-                    database=server_settings["writedatabase"],
-                    schema=server_settings["writeschema"],
-                    replace=replace,
-                    pipeline_env=pipeline_env,
-                    make_system_versioned=system_versioned,
-                )
+                with meet_stap("write_to_db", df):
+                    write_to_db(
+                        df,
+                        table=write_table,
+                        server=server_settings["writeserver"],
+                        database=server_settings["writedatabase"],
+                        schema=server_settings["writeschema"],
+                        replace=replace,
+                        pipeline_env=pipeline_env,
+                        make_system_versioned=system_versioned,
+                    )
             else:
                 logger.info("Geen afspraken gepland voor de beldag")
 elif model_settings["modus"] in ("train"):
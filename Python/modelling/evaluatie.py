@@ -0,0 +1,215 @@
+import numpy as np
+import pandas as pd
+
+from utilities.instrumentatie import gemeten
+
+
+def patient_dagen(df):
+    """
+    Doel: codeer per rij de patient-dag (patientnr en DATUM) en de dag, net als bij de bellijst telt
+            een patient per dag 1 keer mee
+    Output:
+        - patient_dag: array met per rij de code van de patient-dag
+        - dag: array met per patient-dag de code van de dag
+        - n_dagen: aantal dagen
+    """
+    patient_dag = df.groupby(["patientnr", "DATUM"], sort=True).ngroup().to_numpy()
+    dag_rij = df.groupby("DATUM", sort=True).ngroup().to_numpy()
+    dag = np.zeros(patient_dag.max() + 1, dtype=np.int64)
+    dag[patient_dag] = dag_rij
+    return patient_dag, dag, dag_rij.max() + 1
+
+
+def treffers_per_dag(score, aantallen, dag, n_dagen, ks):
+    """
+    Doel: bereken per dag en per k hoeveel er verwacht op de bellijst komt als per dag de hoogste k van
+            de patient-dagen gebeld wordt (zie pos_labels_per_groep): de hele patient-dagen boven de
+            grens en van de patient-dagen op de grens het deel dat nog nodig is. Bij gelijke scores op
+            de grens telt het gemiddelde van die patient-dagen
+    Input:
+        - score: array met per patient-dag de score (de hoogste predict_proba van die dag)
+        - aantallen: 2d array met per patient-dag de aantallen om op te tellen (bijv. afspraken en
+                no-shows), patient-dagen x soorten
+        - dag: array met per patient-dag de code van de dag
+        - n_dagen: aantal dagen
+        - ks: array met de proporties die gebeld worden
+    Output:
+        - 3d array met de verwachte aantallen op de bellijst, dagen x ks x soorten
+    """
+    ks = np.asarray(ks, dtype=float)
+    volgorde = np.lexsort((-score, dag))
+    dag = dag[volgorde]
+    score = score[volgorde]
+    aantallen = aantallen[volgorde]
+    n = len(score)
+
+    per_dag = np.bincount(dag, minlength=n_dagen)
+    dag_start = np.concatenate([[0], np.cumsum(per_dag)[:-1]])
+    cumulatief = np.vstack([np.zeros((1, aantallen.shape[1])), np.cumsum(aantallen, 0)])
+
+    # Blokken met dezelfde dag en score, op de grens telt het gemiddelde van een blok
+    nieuw_blok = np.ones(n, dtype=bool)
+    nieuw_blok[1:] = (dag[1:] != dag[:-1]) | (score[1:] != score[:-1])
+    blok = np.cumsum(nieuw_blok) - 1
+    blok_start = np.flatnonzero(nieuw_blok)
+    blok_lengte = np.diff(np.append(blok_start, n))
+    blok_gemiddelde = (
+        cumulatief[np.append(blok_start[1:], n)] - cumulatief[blok_start]
+    ) / (blok_lengte[:, None])
+
+    # Per dag en k het aantal patient-dagen dat gebeld wordt, en het blok waar de grens in valt
+    nodig = per_dag[:, None] * ks[None, :]
+    positie = np.minimum(dag_start[:, None] + np.floor(nodig).astype(np.int64), n - 1)
+    grens_blok = blok[positie]
+    start = blok_start[grens_blok]
+    verwacht = (cumulatief[start] - cumulatief[dag_start][:, None, :]) + (
+        nodig - (start - dag_start[:, None])
+    )[:, :, None] * blok_gemiddelde[grens_blok]
+
+    # Als de hele dag gebeld wordt tellen alle patient-dagen van die dag
+    heel = nodig >= per_dag[:, None]
+    totaal = cumulatief[dag_start + per_dag] - cumulatief[dag_start]
+    return np.where(heel[:, :, None], totaal[:, None, :], verwacht)
+
+
+def auc_paren(score, label, dag, n_dagen):
+    """
+    Doel: tel per combinatie van dagen de paren (no-show, show) waarbij de no-show de hoogste score
+            heeft, gelijke scores tellen voor de helft. Met deze matrix is de AUC voor elke weging van
+            de dagen een matrixvermenigvuldiging (zie evalueer_set)
+    Output:
+        - paren: 2d array, dagen (van de no-show) x dagen (van de show)
+    """
+    positief = label == 1
+    # Gesorteerde no-shows, dat maakt het zoeken per dag veel sneller
+    volgorde = np.argsort(score[positief], kind="stable")
+    score_pos = score[positief][volgorde]
+    dag_pos = dag[positief][volgorde]
+    score_neg = score[~positief]
+    dag_neg = dag[~positief]
+
+    paren = np.zeros((n_dagen, n_dagen))
+    volgorde = np.lexsort((score_neg, dag_neg))
+    score_neg = score_neg[volgorde]
+    grenzen = np.searchsorted(dag_neg[volgorde], np.arange(n_dagen + 1))
+    for d in range(n_dagen):
+        neg = score_neg[grenzen[d] : grenzen[d + 1]]
+        if len(neg) == 0:
+            continue
+        lager = np.searchsorted(neg, score_pos, side="left")
+        gelijk = np.searchsorted(neg, score_pos, side="right") - lager
+        paren[:, d] = np.bincount(
+            dag_pos, weights=lager + 0.5 * gelijk, minlength=n_dagen
+        )
+    return paren
+
+
+def evalueer_set(df, ks, n_bootstrap, alpha, rng):
+    """
+    Doel: bereken recall@k, precisie@k en de AUC met betrouwbaarheidsintervallen voor 1 set afspraken
+            (alle polis of 1 poli), zie evalueer_holdout
+    Output:
+        - dataframe met per k een rij
+    """
+    label = df["voldaan_af"].to_numpy(dtype=float)
+    proba = df["predict_proba"].to_numpy(dtype=float)
+    patient_dag, dag, n_dagen = patient_dagen(df)
+
+    # Per patient-dag de hoogste score, het aantal afspraken en het aantal no-shows
+    n_patient_dagen = len(dag)
+    score = np.full(n_patient_dagen, -np.inf)
+    np.maximum.at(score, patient_dag, proba)
+    aantallen = np.column_stack(
+        [
+            np.bincount(patient_dag, minlength=n_patient_dagen),
+            np.bincount(patient_dag, weights=label, minlength=n_patient_dagen),
+        ]
+    )
+    gebeld = treffers_per_dag(score, aantallen, dag, n_dagen, ks)
+    afspraken_dag = np.bincount(dag, weights=aantallen[:, 0], minlength=n_dagen)
+    no_shows_dag = np.bincount(dag, weights=aantallen[:, 1], minlength=n_dagen)
+
+    dag_rij = dag[patient_dag]
+    paren = auc_paren(proba, label, dag_rij, n_dagen)
+    shows_dag = afspraken_dag - no_shows_dag
+
+    # Bootstrap over de dagen: elke resample is een weging van de dagen (Poisson(1) per dag), alle
+    # resamples samen zijn dus matrixvermenigvuldigingen. De eerste rij is de puntschatting
+    gewichten = np.vstack(
+        [np.ones(n_dagen), rng.poisson(1.0, size=(n_bootstrap, n_dagen))]
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        recall = (gewichten @ gebeld[:, :, 1]) / (gewichten @ no_shows_dag)[:, None]
+        precisie = (gewichten @ gebeld[:, :, 1]) / (gewichten @ gebeld[:, :, 0])
+        auc = ((gewichten @ paren) * gewichten).sum(axis=1) / (
+            (gewichten @ no_shows_dag) * (gewichten @ shows_dag)
+        )
+
+    resultaat = pd.DataFrame(
+        {
+            "k": ks,
+            "dagen": n_dagen,
+            "afspraken": len(df),
+            "no_shows": int(label.sum()),
+        }
+    )
+    for naam, waardes in (
+        ("recall", recall),
+        ("precisie", precisie),
+        ("auc", np.repeat(auc[:, None], len(ks), axis=1)),
+    ):
+        resultaat[naam] = waardes[0]
+        if n_bootstrap > 0:
+            resultaat[f"{naam}_laag"] = np.nanquantile(waardes[1:], alpha / 2, axis=0)
+            resultaat[f"{naam}_hoog"] = np.nanquantile(
+                waardes[1:], 1 - alpha / 2, axis=0
+            )
+    return resultaat
+
+
+@gemeten()
+def evalueer_holdout(
+    df, ks=(0.2,), per_poli=True, n_bootstrap=1000, alpha=0.05, seed=0
+):
+    """
+    Doel: evalueer een model op voorspelde holdout afspraken. De belangrijkste metric is de recall als
+            per dag de 20% patienten met de hoogste predict_proba gebeld wordt (zie README)
+    Input:
+        - df: dataframe met per afspraak patientnr, DATUM, polikliniek, voldaan_af (1 is no-show) en
+                predict_proba. Afspraken zonder voldaan_af tellen niet mee
+        - ks: de proporties van de patienten per dag die gebeld worden, alle k in 1 keer
+        - per_poli: ook per poli evalueren, met de bellijst per dag per poli
+        - n_bootstrap: aantal bootstrap resamples voor de betrouwbaarheidsintervallen, 0 voor geen
+        - alpha: 1 - de betrouwbaarheid van de intervallen
+        - seed: seed voor de bootstrap
+    Output:
+        - dataframe met per polikliniek ("Alles" voor alle polis samen) en k:
+                - dagen, afspraken, no_shows: de omvang van de set
+                - recall: aandeel no-shows dat op de bellijst komt
+                - precisie: aandeel afspraken op de bellijst dat een no-show is
+                - auc: de AUC op afspraakniveau (gelijk voor elke k)
+                - (metric)_laag en (metric)_hoog: het bootstrap betrouwbaarheidsinterval
+    Een patient telt per dag 1 keer mee, met de hoogste predict_proba van die dag, net als bij
+    voorspel_per_dag. In plaats van de loting op de grens wordt de verwachte waarde gebruikt, de
+    uitkomst is dus niet willekeurig. De bootstrap resamplet dagen in plaats van afspraken, omdat
+    de bellijst per dag bepaald wordt.
+    """
+    df = df.loc[
+        df["voldaan_af"].notna(),
+        ["patientnr", "DATUM", "polikliniek", "voldaan_af", "predict_proba"],
+    ]
+    ks = np.atleast_1d(np.asarray(ks, dtype=float))
+    rng = np.random.default_rng(seed)
+
+    sets = [("Alles", df)]
+    if per_poli:
+        sets += list(df.groupby("polikliniek", sort=True, observed=True))
+
+    resultaten = []
+    for poli, df_set in sets:
+        if len(df_set) == 0:
+            continue
+        resultaat = evalueer_set(df_set, ks, n_bootstrap, alpha, rng)
+        resultaat.insert(0, "polikliniek", poli)
+        resultaten.append(resultaat)
+    return pd.concat(resultaten, ignore_index=True)
@@ -0,0 +1,309 @@
+import logsetup
+import logging
+
+import hashlib
+import json
+import os
+import shutil
+import pickle
+import platform
+import tempfile
+import threading
+from datetime import datetime
+from importlib import metadata as importlib_metadata
+from pathlib import Path
+
+from modelling.native_model import (
+    exporteer_native,
+    laad_native,
+    native_map,
+)
+from utilities.referentie_cache import bestand_hash
+from utilities.unify_cwd import unify_cwd
+
+# De bibliotheken waarvan de versie bij een model opgeslagen wordt. Een model dat met een andere
+# versie getraind is geeft een waarschuwing bij het laden
+MODEL_BIBLIOTHEKEN = ["scikit-learn", "xgboost", "pandas", "numpy"]
+
+# De geladen modellen in dit proces, per pad de bestandsversie, metadata en het model zelf
+GELADEN_MODELLEN = {}
+# Lock op GELADEN_MODELLEN, zodat een model ook bij gelijktijdig voorspellen maar 1 keer geladen wordt
+REGISTER_LOCK = threading.Lock()
+
+
+def model_map():
+    """
+    Doel: de map waar de getrainde modellen staan
+    """
+    cwd = Path.cwd()
+    cwd = unify_cwd(cwd)
+    return cwd / "Python" / "models"
+
+
+def model_pad(naam):
+    """
+    Doel: het pad van het model voor een poli of cluster
+    """
+    return model_map() / f"trained_model_{naam}.pkl"
+
+
+def metadata_pad(pad):
+    """
+    Doel: het pad van de metadata naast een model (trained_model_(naam).json)
+    """
+    return Path(pad).with_suffix(".json")
+
+
+def bibliotheek_versies():
+    """
+    Doel: de versies van python en van MODEL_BIBLIOTHEKEN, None voor een bibliotheek die niet
+            geinstalleerd is
+    """
+    versies = {"python": platform.python_version()}
+    for bibliotheek in MODEL_BIBLIOTHEKEN:
+        try:
+            versies[bibliotheek] = importlib_metadata.version(bibliotheek)
+        except importlib_metadata.PackageNotFoundError:
+            versies[bibliotheek] = None
+    return versies
+
+
+def lees_metadata(naam):
+    """
+    Doel: lees de metadata van een model zonder het model zelf te laden
+    Output:
+        - dict met feature_list, trainingsperiode, versies, sha1 en getraind, of None als er
+            (nog) geen metadata bij het model staat
+    """
+    pad = metadata_pad(model_pad(naam))
+    if not pad.is_file():
+        return None
+    with open(pad, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def controleer_metadata(model_metadata, feature_list=None):
+    """
+    Doel: controleer of een model bruikbaar is in deze omgeving, op basis van de metadata
+    Input:
+        - model_metadata: output van lees_metadata
+        - feature_list: optioneel, de features waarmee voorspeld gaat worden
+    Output:
+        - fouten: lijst met redenen waarom het model niet bruikbaar is
+        - waarschuwingen: lijst met verschillen die het resultaat kunnen beinvloeden
+    """
+    fouten = []
+    waarschuwingen = []
+    if feature_list is not None and list(model_metadata["feature_list"]) != list(
+        feature_list
+    ):
+        fouten.append(
+            f"model getraind op features {model_metadata['feature_list']}, voorspelling met {list(feature_list)}"
+        )
+    huidig = bibliotheek_versies()
+    for bibliotheek, versie in model_metadata.get("versies", {}).items():
+        if huidig.get(bibliotheek) != versie:
+            waarschuwingen.append(
+                f"{bibliotheek} {versie} bij het trainen, nu {huidig.get(bibliotheek)}"
+            )
+    return fouten, waarschuwingen
+
+
+def schrijf_atomair(pad, schrijf):
+    """
+    Doel: schrijf een bestand via een tijdelijk bestand in dezelfde map en vervang het daarna in 1 keer,
+            zodat een lopende voorspelling nooit een half geschreven bestand leest
+    Input:
+        - pad: het uiteindelijke pad
+        - schrijf: functie die het bestand schrijft, schrijf(f) met f een open binair bestand
+    """
+    fd, tijdelijk = tempfile.mkstemp(
+        prefix=f"{Path(pad).name}.", suffix=".tmp", dir=Path(pad).parent
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            schrijf(f)
+        os.replace(tijdelijk, pad)
+    except BaseException:
+        if os.path.exists(tijdelijk):
+            os.remove(tijdelijk)
+        raise
+
+
+def sla_model_op(
+    model, naam, feature_list, trainingsperiode=None, extra=None, native=True
+):
+    """
+    Doel: sla een getraind model op met de metadata ernaast. Het model en de metadata worden elk in
+            1 keer vervangen, een lopende voorspelling gebruikt dus het oude of het nieuwe model
+    Input:
+        - model: getrainde pipeline
+        - naam: poli of cluster
+        - feature_list: de features waarop het model getraind is
+        - trainingsperiode: optioneel, [eerste, laatste] datum van de trainingsdata
+        - extra: optioneel, dict met extra metadata (bijv. de hyperparameters)
+        - native: exporteer het model ook zonder pickle (zie native_model.exporteer_native)
+    Output:
+        - pad van het model
+    """
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    pad = model_pad(naam)
+    pad.parent.mkdir(parents=True, exist_ok=True)
+
+    schrijf_atomair(pad, lambda f: pickle.dump(model, f))
+    sha1 = bestand_hash(pad)
+
+    # De native export komt in een eigen map per sha1, de metadata verwijst ernaar. Met het vervangen
+    # van de metadata wordt dus ook in 1 keer op de nieuwe export overgestapt
+    map_native = None
+    if native:
+        try:
+            map_native = exporteer_native(model, native_map(pad, sha1)).name
+        except (AttributeError, KeyError, TypeError, ImportError) as fout:
+            logger.warning(f"Geen native export voor het model voor {naam}: {fout}")
+
+    model_metadata = {
+        "naam": naam,
+        "feature_list": list(feature_list),
+        "trainingsperiode": trainingsperiode,
+        "versies": bibliotheek_versies(),
+        "sha1": sha1,
+        "native": map_native,
+        "getraind": datetime.now().isoformat(),
+        **(extra or {}),
+    }
+    schrijf_atomair(
+        metadata_pad(pad),
+        lambda f: f.write(
+            json.dumps(model_metadata, indent=4, default=str).encode("utf-8")
+        ),
+    )
+
+    # Oude native exports van dit model zijn niet meer nodig
+    for oud in pad.parent.glob(f"{native_map(pad, '').name}*"):
+        if oud.is_dir() and oud.name != map_native:
+            shutil.rmtree(oud, ignore_errors=True)
+    return pad
+
+
+def laad_native_model(naam):
+    """
+    Doel: laad de native export van een model (zie native_model), zonder het gepickelde model in te
+            lezen. De export hoort bij de metadata, dus zolang de metadata niet verandert komt het
+            model daarna uit het geheugen
+    Output:
+        - dict met de versie, metadata en het model (zie native_model.laad_native), of None als er
+            geen bruikbare native export is
+    """
+    logger = logging.getLogger()
+
+    pad = metadata_pad(model_pad(naam))
+    sleutel = f"{model_pad(naam)}#native"
+    with REGISTER_LOCK:
+        if not pad.is_file():
+            return None
+        status = pad.stat()
+        versie = (status.st_mtime_ns, status.st_size)
+        geladen = GELADEN_MODELLEN.get(sleutel)
+        if geladen is None or geladen["versie"] != versie:
+            model_metadata = lees_metadata(naam)
+            if not model_metadata.get("native"):
+                return None
+            map_native = model_pad(naam).parent / model_metadata["native"]
+            if not map_native.is_dir():
+                logger.warning(f"Native export {map_native} niet gevonden")
+                return None
+            try:
+                model = laad_native(map_native)
+            except ImportError as fout:
+                logger.warning(f"Native export niet te laden: {fout}")
+                return None
+            logger.info(f"Native model geladen voor {naam}")
+            geladen = {"versie": versie, "metadata": model_metadata, "model": model}
+            GELADEN_MODELLEN[sleutel] = geladen
+            for waarschuwing in controleer_metadata(model_metadata)[1]:
+                logger.warning(f"Model voor {naam}: {waarschuwing}")
+    return geladen
+
+
+def laad_model(naam, feature_list=None, native=False):
+    """
+    Doel: laad het model voor een poli of cluster. Elk model wordt per proces maar 1 keer ingelezen,
+            zolang het bestand niet verandert (wijzigingsdatum, grootte en anders de sha1 van de inhoud)
+            komt het daarna uit het geheugen. Polis die via modelmapping_voorspel hetzelfde
+            clustermodel gebruiken laden het model dus maar 1 keer
+    Input:
+        - naam: poli of cluster
+        - feature_list: optioneel, de features waarmee voorspeld gaat worden. Als die niet gelijk zijn
+                aan de features uit de metadata geeft dat een ValueError
+        - native: gebruik de native export als die er is (zie laad_native_model), anders het
+                gepickelde model
+    Output:
+        - het model: de pipeline, of met native een dict (zie native_model.laad_native)
+    Bij het inlezen wordt de sha1 van het bestand vergeleken met die uit de metadata. Voor modellen
+    zonder metadata (getraind voor het model register) wordt alleen een waarschuwing gelogd.
+    """
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    geladen = laad_native_model(naam) if native else None
+    if native and geladen is None:
+        logger.info(
+            f"Geen native export voor {naam}, het gepickelde model wordt gebruikt"
+        )
+
+    pad = model_pad(naam)
+    with REGISTER_LOCK:
+        if geladen is None:
+            geladen = laad_gepickeld_model(naam, pad)
+
+    if geladen["metadata"] is not None:
+        fouten, _ = controleer_metadata(geladen["metadata"], feature_list)
+        if fouten:
+            raise ValueError(f"Model voor {naam} niet bruikbaar: {'; '.join(fouten)}")
+
+    return geladen["model"]
+
+
+def laad_gepickeld_model(naam, pad):
+    """
+    Doel: lees het gepickelde model in als het nog niet (in deze versie) geladen is, zie laad_model.
+            Moet aangeroepen worden met REGISTER_LOCK
+    """
+    logger = logging.getLogger()
+
+    status = pad.stat()
+    versie = (status.st_mtime_ns, status.st_size)
+    geladen = GELADEN_MODELLEN.get(str(pad))
+    if geladen is not None and geladen["versie"] != versie:
+        # Een bestand met een andere wijzigingsdatum maar dezelfde inhoud hoeft niet opnieuw
+        # ingelezen te worden
+        if bestand_hash(pad) == geladen["sha1"]:
+            geladen["versie"] = versie
+    if geladen is None or geladen["versie"] != versie:
+        logger.info(f"Model laden voor {naam}")
+        model_metadata = lees_metadata(naam)
+        # Het bestand 1 keer lezen, zodat de sha1 zeker bij het ingelezen model hoort
+        inhoud = pad.read_bytes()
+        sha1 = hashlib.sha1(inhoud).hexdigest()
+        if model_metadata is None:
+            logger.warning(f"Geen metadata gevonden bij het model voor {naam}")
+        elif model_metadata.get("sha1") != sha1:
+            logger.warning(
+                f"De metadata bij het model voor {naam} hoort bij een ander modelbestand"
+            )
+        model = pickle.loads(inhoud)
+        geladen = {
+            "versie": versie,
+            "sha1": sha1,
+            "metadata": model_metadata,
+            "model": model,
+        }
+        GELADEN_MODELLEN[str(pad)] = geladen
+        # Verschillen in versies alleen bij het inlezen melden, niet bij elke poli opnieuw
+        if model_metadata is not None:
+            for waarschuwing in controleer_metadata(model_metadata)[1]:
+                logger.warning(f"Model voor {naam}: {waarschuwing}")
+    return geladen
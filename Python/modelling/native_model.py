@@ -0,0 +1,207 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Bestanden van een native export, in de map native_(naam)_(sha1) naast het gepickelde model
+BOOSTER_BESTAND = "booster.ubj"
+NUMERIEK_BESTAND = "numeriek.npy"
+PREPROCESSOR_BESTAND = "preprocessor.json"
+
+
+def native_map(model_pad, sha1):
+    """
+    Doel: de map met de native export van een model (zie exporteer_native). De sha1 van het gepickelde
+            model zit in de naam, zodat een nieuwe export nooit over een export heen geschreven wordt
+            die een lopende voorspelling nog gebruikt
+    """
+    model_pad = Path(model_pad)
+    naam = model_pad.stem.replace("trained_model_", "native_", 1)
+    return model_pad.parent / f"{naam}_{sha1[:12]}"
+
+
+def exporteer_native(pipeline, map_native):
+    """
+    Doel: exporteer een getrainde pipeline (zie define_pipeline) zonder pickle: de booster in het UBJ
+            formaat van XGBoost en de parameters van de imputers, scaler en encoder als gewone arrays.
+            Daarmee kan voorspeld worden zonder sklearn pipeline (zie native_predict_proba)
+    Input:
+        - pipeline: getrainde pipeline uit define_pipeline
+        - map_native: map waar de export in komt
+    Output:
+        - map_native
+    In de map komen:
+        - booster.ubj: de booster
+        - numeriek.npy: per numerieke kolom de mediaan, het centrum en de schaal (3 x kolommen), met
+                np.load(mmap_mode="r") te delen tussen processen
+        - preprocessor.json: de kolommen, de meest voorkomende waarde en de categorieen van de
+                categorische kolommen, de klassen en het aantal bomen
+    """
+    map_native = Path(map_native)
+    map_native.mkdir(parents=True, exist_ok=True)
+
+    transformers = dict(
+        (naam, (transformer, kolommen))
+        for naam, transformer, kolommen in pipeline.named_steps[
+            "transform"
+        ].transformers_
+    )
+
+    # Numeriek: mediaan imputatie en de RobustScaler. Kolommen die bij het trainen helemaal leeg
+    # waren laat de imputer weg, die doen dus niet mee
+    num_pipeline, num_kolommen = transformers["num"]
+    num_imputer = num_pipeline.named_steps["imputer"]
+    scaler = num_pipeline.named_steps["scaler"]
+    num_geldig = np.isin(num_kolommen, num_imputer.get_feature_names_out(num_kolommen))
+    num_kolommen = list(np.asarray(num_kolommen)[num_geldig])
+    n_num = len(num_kolommen)
+    center = scaler.center_ if scaler.center_ is not None else np.zeros(n_num)
+    scale = scaler.scale_ if scaler.scale_ is not None else np.ones(n_num)
+    numeriek = np.vstack(
+        [num_imputer.statistics_[num_geldig].astype(float), center, scale]
+    )
+    np.save(map_native / NUMERIEK_BESTAND, numeriek.astype(np.float64))
+
+    # Categorisch: meest voorkomende waarde en de one-hot encoding. Per kolom eerst de categorieen die
+    # vaak genoeg voorkomen en daarna (als die er zijn) 1 kolom voor alle weinig voorkomende categorieen
+    cat_pipeline, cat_kolommen = transformers.get("cat", (None, []))
+    categorisch = []
+    if len(cat_kolommen) > 0:
+        cat_imputer = cat_pipeline.named_steps["imputer"]
+        encoder = cat_pipeline.named_steps["encoder"]
+        cat_geldig = np.isin(
+            cat_kolommen, cat_imputer.get_feature_names_out(cat_kolommen)
+        )
+        cat_kolommen = list(np.asarray(cat_kolommen)[cat_geldig])
+        weinig = getattr(encoder, "infrequent_categories_", None) or [None] * len(
+            cat_kolommen
+        )
+        for kolom, meest, categorieen, weinig_kolom in zip(
+            cat_kolommen,
+            cat_imputer.statistics_[cat_geldig],
+            encoder.categories_,
+            weinig,
+        ):
+            weinig_kolom = [] if weinig_kolom is None else list(weinig_kolom)
+            vaak = [c for c in categorieen if c not in weinig_kolom]
+            categorisch.append(
+                {
+                    "kolom": kolom,
+                    "meest_voorkomend": meest,
+                    "categorieen": vaak,
+                    "weinig_voorkomend": weinig_kolom,
+                }
+            )
+
+    classifier = pipeline.named_steps["classifier"]
+    # Met early stopping voorspelt de classifier alleen met de bomen tot en met de beste iteratie
+    try:
+        n_bomen = int(classifier.best_iteration) + 1
+    except AttributeError:
+        n_bomen = None
+    classifier.get_booster().save_model(str(map_native / BOOSTER_BESTAND))
+
+    with open(map_native / PREPROCESSOR_BESTAND, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "numeriek": num_kolommen,
+                "categorisch": categorisch,
+                "klassen": np.asarray(classifier.classes_).tolist(),
+                "n_bomen": n_bomen,
+            },
+            f,
+            indent=4,
+            default=lambda waarde: waarde.item(),
+        )
+    return map_native
+
+
+def laad_native(map_native):
+    """
+    Doel: laad een native export (zie exporteer_native). De numerieke parameters worden via een memory
+            map ingelezen, zodat processen die hetzelfde model laden die delen
+    Output:
+        - model: dict met de booster, de preprocessor parameters en de klassen (classes_)
+    """
+    import xgboost as xgb
+
+    map_native = Path(map_native)
+    with open(map_native / PREPROCESSOR_BESTAND, "r", encoding="utf-8") as f:
+        preprocessor = json.load(f)
+    booster = xgb.Booster()
+    booster.load_model(str(map_native / BOOSTER_BESTAND))
+
+    # Per categorische kolom een opzoektabel van de positie in alle categorieen naar de output kolom,
+    # -1 voor een onbekende categorie (die krijgt net als bij handle_unknown="ignore" alleen nullen)
+    for kolom in preprocessor["categorisch"]:
+        kolom["alle"] = pd.Index(
+            kolom["categorieen"] + kolom["weinig_voorkomend"], dtype=object
+        )
+        kolom["output"] = np.array(
+            list(range(len(kolom["categorieen"])))
+            + [len(kolom["categorieen"])] * len(kolom["weinig_voorkomend"])
+            + [-1]
+        )
+        kolom["breedte"] = len(kolom["categorieen"]) + bool(kolom["weinig_voorkomend"])
+
+    return {
+        "booster": booster,
+        "numeriek": np.load(map_native / NUMERIEK_BESTAND, mmap_mode="r"),
+        "preprocessor": preprocessor,
+        "classes_": np.array(preprocessor["klassen"]),
+    }
+
+
+def native_transform(model, X):
+    """
+    Doel: doe de preprocessing van de pipeline (imputeren, schalen en one-hot encoding) op NumPy arrays
+    Input:
+        - model: output van laad_native
+        - X: dataframe met de features
+    Output:
+        - 2d float32 array in dezelfde kolomvolgorde als de ColumnTransformer
+    """
+    preprocessor = model["preprocessor"]
+    mediaan, center, scale = model["numeriek"]
+    delen = []
+
+    if preprocessor["numeriek"]:
+        numeriek = X[preprocessor["numeriek"]].to_numpy(
+            dtype=np.float64, na_value=np.nan
+        )
+        numeriek = np.where(np.isnan(numeriek), mediaan, numeriek)
+        delen.append((numeriek - center) / scale)
+
+    for kolom in preprocessor["categorisch"]:
+        waardes = X[kolom["kolom"]].astype(object)
+        # Net als in de SimpleImputer is alleen NaN een ontbrekende waarde, None is een eigen categorie
+        ontbrekend = waardes.isna() & waardes.map(
+            lambda waarde: isinstance(waarde, float)
+        )
+        waardes = waardes.where(~ontbrekend, kolom["meest_voorkomend"])
+        codes = kolom["alle"].get_indexer(waardes)
+        output = kolom["output"][codes]
+        one_hot = np.zeros((len(X), kolom["breedte"]))
+        bekend = output >= 0
+        one_hot[np.flatnonzero(bekend), output[bekend]] = 1
+        delen.append(one_hot)
+
+    if not delen:
+        return np.zeros((len(X), 0), dtype=np.float32)
+    return np.hstack(delen).astype(np.float32)
+
+
+def native_predict_proba(model, X):
+    """
+    Doel: voorspel de kansen met een native export, zoals predict_proba van de pipeline
+    Output:
+        - 2d array met per klasse de kans (rijen x 2)
+    """
+    n_bomen = model["preprocessor"]["n_bomen"]
+    kans = model["booster"].inplace_predict(
+        native_transform(model, X),
+        iteration_range=(0, n_bomen) if n_bomen else (0, 0),
+        validate_features=False,
+    )
+    return np.column_stack([1 - kans, kans])
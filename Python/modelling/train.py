@@ -1,10 +1,7 @@
 import traceback
-from pathlib import Path
 from D_modelling.define_pipeline import define_pipeline
-import os
-import pickle
 import logging
-from Z_utilities.unify_cwd import unify_cwd
+from modelling.model_register import sla_model_op
 
 
 def train_model(df, poli, feature_list, model_hyperparameters):
@@ -29,22 +26,20 @@ def train_model(df, poli, feature_list, model_hyperparameters):
         pipeline.fit(X, y, classifier__sample_weight=df["weights"])
     except:
         pipeline.fit(X, y)
-    cwd = Path.cwd()
-    cwd = unify_cwd(cwd)
-
-    path = cwd / "Python" / "models"
-    # Check whether the specified path exists or not
-    isExist = os.path.exists(path)
-
-    if not isExist:
-        # Create a new directory because it does not exist
-        os.makedirs(path)
-        logger.info(f"Map {path.as_posix()} aangemaakt")
 
     logger.info(f"Model opslaan voor {poli}")
     logger.info(f"Model hyperparameters voor {poli}: {model_hyperparameters}")
-    filename = cwd / "Python" / "models" / ("trained_model_" + poli + ".pkl")
-    pickle.dump(pipeline, open(filename, "wb"))
+    # Het model wordt in 1 keer vervangen, met de metadata ernaast voor de controle bij het voorspellen
+    trainingsperiode = None
+    if "DATUM" in df.columns and len(df) > 0:
+        trainingsperiode = [df["DATUM"].min(), df["DATUM"].max()]
+    sla_model_op(
+        pipeline,
+        poli,
+        feature_list,
+        trainingsperiode=trainingsperiode,
+        extra={"hyperparameters": model_hyperparameters, "rijen": len(df)},
+    )
 
 
 def train_all_models(df, polis, model_hyperparameters, feature_list, modelclusters):
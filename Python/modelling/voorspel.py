@@ -1,5 +1,6 @@
-import pickle
 from pathlib import Path
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 import json
@@ -7,6 +8,32 @@ import logging
 
 from A_readwrite.load_data import load_dataset
 from A_readwrite.read_data import execute_query_text
+from utilities.referentie_cache import haal_referentie, bron_versie, bestand_versie
+from utilities.instrumentatie import gemeten
+from modelling.model_register import laad_model
+from modelling.native_model import native_predict_proba
+
+
+def voorspel_model(pipeline, X):
+    """
+    Doel: voorspel met een getraind model, met 1 keer de pipeline door. De voorspelde klasse wordt
+            uit dezelfde kansen bepaald, net als predict van de classifier (de klasse met de hoogste
+            kans, bij gelijke kansen de eerste)
+    Input:
+        - pipeline: getraind model, of een native export (zie native_model.laad_native)
+        - X: dataframe met de features
+    Output:
+        - predict: array met de voorspelde klasse (0 of 1)
+        - predict_proba: array met de kans op de positieve klasse
+    """
+    if isinstance(pipeline, dict):
+        kansen = native_predict_proba(pipeline, X)
+        klassen = pipeline["classes_"]
+    else:
+        kansen = pipeline.predict_proba(X)
+        klassen = pipeline.classes_
+    predict = np.asarray(klassen)[np.argmax(kansen, axis=1)].astype(int)
+    return predict, kansen[:, 1]
 
 
 def voorspel(df, poli, feature_list):
@@ -25,88 +52,135 @@ def voorspel(df, poli, feature_list):
     """
     X = df[feature_list]
 
-    cwd = Path.cwd()
+    # Elk model wordt per run maar 1 keer ingelezen, ook als meerdere polis hetzelfde model gebruiken
+    pipeline = laad_model(poli, feature_list)
 
-    logger = logging.getLogger()
-    logger.info(f"Model laden voor {poli}")
-    filename = cwd / "Python" / "models" / (f"trained_model_{poli}.pkl")
+    df.loc[:, "predict"], df.loc[:, "predict_proba"] = voorspel_model(pipeline, X)
 
-    pipeline = pickle.load(open(filename, "rb"))
+    return df
 
-    df.loc[:, "predict"] = pipeline.predict(X).astype(int)
-    df.loc[:, "predict_proba"] = pipeline.predict_proba(X)[:, 1]
 
-    return df
+# Constanten van splitmix64, zie willekeurig_uniform
+SPLITMIX_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+SPLITMIX_MUL1 = np.uint64(0xBF58476D1CE4E5B9)
+SPLITMIX_MUL2 = np.uint64(0x94D049BB133111EB)
 
 
-def get_pos_labels(y_pred, prop_pos=0.35):
+def splitmix64(x):
     """
-    Doel: de hoogste prop_pos van y_pred omzetten naar een positief label
-    Input:
-        - y_pred: predicties
-        - prop_pos: de proportie van de voorspellingen die in een positief label (1) omgezet moet worden
-    Output:
-        - y_pred_labels: de labels (0 of 1)
+    Doel: meng een array uint64 waardes met splitmix64. Gelijke input geeft altijd dezelfde output,
+            onafhankelijk van de volgorde van de rijen, het proces of de numpy random state
     """
+    with np.errstate(over="ignore"):
+        z = np.asarray(x, dtype=np.uint64) + SPLITMIX_GAMMA
+        z = (z ^ (z >> np.uint64(30))) * SPLITMIX_MUL1
+        z = (z ^ (z >> np.uint64(27))) * SPLITMIX_MUL2
+    return z ^ (z >> np.uint64(31))
 
-    # de bovenste 35% selecteren op basis van een grens uit quantile vereist wat moeite.
-    # zo is bij len(y_pred) == 2 een andere berekening van het quantile nodig dan bij len(y_pred) == 6
-    bovengrens = np.quantile(y_pred, 1 - prop_pos, interpolation="higher")
-    ondergrens = np.quantile(y_pred, 1 - prop_pos, interpolation="lower")
-
-    bovengrens_gebruiken = (y_pred > ondergrens).mean() > prop_pos
-
-    grens_quantile = bovengrens if bovengrens_gebruiken else ondergrens
 
-    # de positieve labels als er groter dan de grens gebruikt wordt
-    pos_klein = y_pred > grens_quantile
-    # de positieve labels als er groter dan of gelijk aan de grens gebruikt wordt
-    pos_groot = y_pred >= grens_quantile
-
-    # meestal heeft pos_klein te weinig gevallen en pos_groot te veel.
-    # dan krijgt pos_klein dus sowieso het positieve label,
-    # en van de voorspellingen die wel in pos_groot zitten maar niet in pos_klein
-    # wordt de benodigde fractie geselecteerd om op de gewenste prop_pos uit te komen.
+def willekeurig_uniform(x):
+    """
+    Doel: een pseudo-random getal in [0, 1) per uint64 waarde, zie splitmix64
+    """
+    return (splitmix64(x) >> np.uint64(11)) * 2.0**-53
 
-    # reken uit hoeveel patienten er gewenst zijn gegeven de prop_pos
-    nodig = len(y_pred) * prop_pos
 
-    # aantal voorspellingen in de kleine en grote groepen
-    klein = pos_klein.sum()
-    groot = pos_groot.sum()
+def pos_labels_per_groep(scores, groepen=None, prop_pos=0.35, seed=None):
+    """
+    Doel: geef per groep de hoogste prop_pos van de scores een positief label, voor alle groepen in
+            1 keer. Een groep krijgt gemiddeld precies len(groep) * prop_pos positieve labels: het
+            naar beneden afgeronde aantal, plus 1 met als kans het deel achter de komma. Bij gelijke scores op de grens wordt willekeurig gekozen
+    Input:
+        - scores: array met de predicties
+        - groepen: optioneel, dataframe of Series met per rij de groep (bijv. DATUM en polikliniek),
+                zonder groepen is alles 1 groep
+        - prop_pos: de proportie van elke groep die een positief label (1) krijgt
+        - seed: optioneel, seed voor de willekeurige keuzes. Zonder seed wordt die uit de numpy random
+                state getrokken
+    Output:
+        - array met de labels (0 of 1), in de volgorde van scores
+    De willekeurige getallen hangen alleen af van de seed, de waardes van de groep en de volgorde van
+    de rijen binnen de groep. Met dezelfde seed geeft een groep dus hetzelfde resultaat, ook als de
+    groepen over meerdere runs of processen verdeeld worden.
+    """
+    scores = np.asarray(scores, dtype=float)
+    n = len(scores)
+    if n == 0:
+        return np.zeros(0, dtype=int)
+    if seed is None:
+        seed = np.random.randint(np.iinfo(np.int64).max, dtype=np.int64)
+
+    # Per rij een sleutel van de groep, op basis van de waardes zelf (niet de volgorde van de groepen)
+    if groepen is None:
+        groep_hash = np.zeros(n, dtype=np.uint64)
+    else:
+        groep_hash = pd.util.hash_pandas_object(groepen, index=False).to_numpy()
+    groep_sleutel = splitmix64(groep_hash ^ splitmix64(np.uint64(seed)))
+    codes, uniek = pd.factorize(groep_sleutel)
+    groep_grootte = np.bincount(codes)
+    groep_start = np.concatenate([[0], np.cumsum(groep_grootte)[:-1]])
+
+    # De positie van elke rij binnen zijn groep, in de volgorde van de input
+    volgorde = np.argsort(codes, kind="stable")
+    positie = np.empty(n, dtype=np.int64)
+    positie[volgorde] = np.arange(n) - groep_start[codes[volgorde]]
+
+    # Aantal positieve labels per groep, met afronding naar boven met als kans het deel achter de komma
+    nodig = groep_grootte * prop_pos
+    aantal = np.floor(nodig)
+    aantal += willekeurig_uniform(uniek) < (nodig - aantal)
+
+    # Sorteer per groep op aflopende score, gelijke scores in willekeurige volgorde
+    with np.errstate(over="ignore"):
+        loting = willekeurig_uniform(
+            groep_sleutel + (positie.astype(np.uint64) + np.uint64(1)) * SPLITMIX_GAMMA
+        )
+    volgorde = np.lexsort((loting, -scores, codes))
+    rang = np.arange(n) - groep_start[codes[volgorde]]
 
-    # hoe groot is de groep met extra patienten waar we er een aantal uit kunnen selecteren?
-    extra = (groot - klein).astype(int)
+    labels = np.empty(n, dtype=int)
+    labels[volgorde] = rang < aantal[codes[volgorde]]
+    return labels
 
-    # hoeveel moeten er geselecteerd worden?
-    tekort = nodig - klein
 
-    # wat moet de kans zijn per patient uit de 'extra-groep' dat ze geselecteerd worden?
-    if tekort > 0:
-        kans_extra = tekort / extra
-    else:
-        kans_extra = 0
-
-    kans = np.select(
-        condlist=[
-            pos_klein == True,
-            (pos_groot == True) & (pos_klein == False),
-            (pos_groot == False) & (pos_klein == False),
-        ],
-        choicelist=[1, kans_extra, 0],
-    )
+def get_pos_labels(y_pred, prop_pos=0.35, seed=None):
+    """
+    Doel: de hoogste prop_pos van y_pred omzetten naar een positief label
+    Input:
+        - y_pred: predicties
+        - prop_pos: de proportie van de voorspellingen die in een positief label (1) omgezet moet worden
+        - seed: optioneel, seed voor de keuze tussen gelijke predicties (zie pos_labels_per_groep)
+    Output:
+        - y_pred_labels: de labels (0 of 1)
+    Voor veel groepen tegelijk: gebruik pos_labels_per_groep in plaats van een groupby met transform.
+    """
+    return pos_labels_per_groep(y_pred, prop_pos=prop_pos, seed=seed)
 
-    y_pred_labels = np.random.binomial(n=1, p=kans)
 
-    return y_pred_labels
+def loting_seed(seed=None, run_datum=None):
+    """
+    Doel: de seed voor de loting van een run, uit de seed van de beldienst en de datum van de run. Met
+            dezelfde seed en run datum is de loting dus achteraf na te doen
+    Input:
+        - seed: optioneel, seed uit de beldienst_param, standaard 0
+        - run_datum: optioneel, datum van de run, standaard vandaag
+    Output:
+        - seed als int
+    """
+    run_datum = pd.Timestamp.today() if run_datum is None else pd.Timestamp(run_datum)
+    basis = np.uint64(int(seed or 0) % 2**64)
+    return int(splitmix64(basis ^ np.uint64(run_datum.toordinal())))
 
 
+@gemeten()
 def test_controle_split(
     df,
     prop_pos=0.35,
     test_group_fraction=0.5,
     callcenter_fraction=0.5,
     sampling_per_poli_fraction=0.5,
+    seed=None,
+    run_datum=None,
 ):
     """
     Doel: doe de test controle split op patient niveau
@@ -115,95 +189,106 @@ def test_controle_split(
         - prop_pos: percentage van de patienten dat gebeld moet worden
         - test_group_fraction: percentage van de bellijst dat de testgroep wordt
         - callcenter_fraction: percentage van de testgroep dat de callcentergroep wordt
+        - sampling_per_poli_fraction: percentage van de patienten waarvoor de bellijst per dag per poli
+                gekozen wordt in plaats van per dag
+        - seed: optioneel, seed voor de loting (zie loting_seed)
+        - run_datum: optioneel, datum van de run voor de loting (zie loting_seed), standaard vandaag
     Output:
-        - df: originele dataframe met 2 extra kolommen
+        - df: originele dataframe (met een nieuwe index) met 4 extra kolommen
+                - predict_bellijst: 0 of 1 of de patient op de bellijst komt
                 - bellijst_testgroep: 0 of 1 of de afspraak in testgroep komt
                 - bellijst_testgroep_callcenter: 0 of 1 of de afspraak in de callcenter testgroep komt
+                - predict_bellijst_sample_per_poli: 0 of 1 of de bellijst per dag per poli gekozen is
+    De loting gebeurt in 1 keer voor alle patient-dagen (patientnr en DATUM). Elke patient-dag krijgt
+    een eigen reeks willekeurige getallen op basis van het patientnr, de DATUM en de seed van de run,
+    zodat de indeling niet afhangt van de volgorde van de rijen of van de numpy random state. Alle
+    afspraken van een patient op een dag krijgen dezelfde indeling.
     """
-    if len(df) > 0:
-        patienten = (
-            df[["patientnr", "polikliniek", "DATUM", "predict_proba"]]
-            .sort_values(["patientnr", "DATUM", "predict_proba"])
-            .drop_duplicates(subset=["patientnr", "DATUM"], keep="last")
-            .reset_index(drop=True)
-        )
+    kolommen = [
+        "predict_bellijst",
+        "bellijst_testgroep",
+        "bellijst_testgroep_callcenter",
+        "predict_bellijst_sample_per_poli",
+    ]
+    df = df.drop(columns=kolommen, errors="ignore").reset_index(drop=True)
+    if len(df) == 0:
+        df[kolommen] = 0
+        return df
+    seed = loting_seed(seed, run_datum)
+
+    # Per rij de patient-dag, gesorteerd op patientnr en DATUM
+    patient_dag = df.groupby(["patientnr", "DATUM"], sort=True, dropna=False).ngroup()
+    patient_dag = patient_dag.to_numpy()
+    # Per patient-dag telt de afspraak met de hoogste predict_proba (bij gelijke kansen de laatste)
+    volgorde = np.lexsort((df["predict_proba"].to_numpy(), patient_dag))
+    laatste = np.append(patient_dag[volgorde][1:] != patient_dag[volgorde][:-1], True)
+    patienten = df.iloc[volgorde[laatste]][["patientnr", "polikliniek", "DATUM"]]
+    predict_proba = df["predict_proba"].to_numpy()[volgorde[laatste]]
+
+    # De willekeurige getallen per patient-dag, een aparte reeks voor elke loting
+    patient_hash = pd.util.hash_pandas_object(
+        patienten[["patientnr", "DATUM"]], index=False
+    ).to_numpy()
+    sleutel = splitmix64(patient_hash ^ splitmix64(np.uint64(seed)))
+
+    def loting(reeks):
+        with np.errstate(over="ignore"):
+            return willekeurig_uniform(sleutel + np.uint64(reeks) * SPLITMIX_GAMMA)
+
+    # A/B test op sampling strategie. A krijgt oude strategie (sample per dag per poli) en B krijgt
+    # nieuwe (per dag). De A groep is gelijkmatig verdeeld over alle polis
+    if sampling_per_poli_fraction > 0:
+        sample_per_poli = pos_labels_per_groep(
+            loting(1),
+            patienten[["DATUM", "polikliniek"]],
+            prop_pos=sampling_per_poli_fraction,
+            seed=seed,
+        ).astype(bool)
+    else:
+        sample_per_poli = np.zeros(len(patienten), dtype=bool)
+
+    # De bellijst voor beide groepen in 1 keer: voor A per dag en poli, voor B per dag
+    predict_bellijst = pos_labels_per_groep(
+        predict_proba,
+        pd.DataFrame(
+            {
+                "DATUM": patienten["DATUM"].to_numpy(),
+                "polikliniek": patienten["polikliniek"]
+                .where(sample_per_poli)
+                .to_numpy(),
+            }
+        ),
+        prop_pos=prop_pos,
+        seed=seed,
+    )
 
-        if sampling_per_poli_fraction > 0:
-            # Splits in 2 groepen, gelijkmatig verdeeeld over alle polis
-            patienten_A = patienten.groupby(["DATUM", "polikliniek"]).sample(
-                frac=sampling_per_poli_fraction
-            )
-            patienten_B = patienten.drop(patienten_A.index)
-
-            # A/B test op sampling strategie. A krijgt oude strategie (sample per dag per poli) en B krijgt nieuwe (per dag)
-            patienten_A["predict_bellijst"] = patienten_A.groupby(
-                ["DATUM", "polikliniek"]
-            )["predict_proba"].transform(get_pos_labels, prop_pos=prop_pos)
-            patienten_B["predict_bellijst"] = patienten_B.groupby(["DATUM"])[
-                "predict_proba"
-            ].transform(get_pos_labels, prop_pos=prop_pos)
-
-            # Voeg alleen een kolom toe welke sampling strategie is gebruikt, dan merk je er aan de voorkant niks van maar dan kunnen we wel onze analyse doen
-            patienten_A["predict_bellijst_sample_per_poli"] = 1
-
-            patienten = pd.concat([patienten_A, patienten_B])
-            patienten["predict_bellijst_sample_per_poli"] = patienten[
-                "predict_bellijst_sample_per_poli"
-            ].fillna(0)
-        else:
-            patienten["predict_bellijst"] = patienten.groupby(["DATUM"])[
-                "predict_proba"
-            ].transform(get_pos_labels, prop_pos=prop_pos)
-            patienten["predict_bellijst_sample_per_poli"] = 0
-
-        if patienten["predict_bellijst"].sum() > 0:
-            # een gedeelte van de predict_bellijst gaat gebeld worden, de rest is controlegroep
-            patienten["bellijst_testgroep"] = np.random.binomial(
-                n=1, p=test_group_fraction * patienten["predict_bellijst"]
-            )
-
-            # een gedeelte van de bellijst_testgroep gaat door het callcenter gebeld worden, de rest door het studententeam
-            patienten["bellijst_testgroep_callcenter"] = np.random.binomial(
-                n=1, p=callcenter_fraction * patienten["bellijst_testgroep"]
-            )
-
-            df = df.drop(
-                columns=[
-                    "predict_bellijst",
-                    "bellijst_testgroep",
-                    "bellijst_testgroep_callcenter",
-                ],
-                errors="ignore",
-            )
-            df = df.merge(
-                patienten[
-                    [
-                        "patientnr",
-                        "DATUM",
-                        "predict_bellijst",
-                        "bellijst_testgroep",
-                        "bellijst_testgroep_callcenter",
-                        "predict_bellijst_sample_per_poli",
-                    ]
-                ],
-                how="left",
-                on=["patientnr", "DATUM"],
-            )
-
-        else:
-            df[
-                [
-                    "predict_bellijst",
-                    "bellijst_testgroep",
-                    "bellijst_testgroep_callcenter",
-                    "predict_bellijst_sample_per_poli",
-                ]
-            ] = 0
+    # een gedeelte van de predict_bellijst gaat gebeld worden, de rest is controlegroep
+    testgroep = predict_bellijst & (loting(2) < test_group_fraction)
+    # een gedeelte van de bellijst_testgroep gaat door het callcenter gebeld worden, de rest door het studententeam
+    callcenter = testgroep & (loting(3) < callcenter_fraction)
+    if not predict_bellijst.any():
+        sample_per_poli[:] = False
 
-        return df
+    # Terug naar de afspraken op positie, via de patient-dag van elke rij
+    df["predict_bellijst"] = predict_bellijst[patient_dag]
+    df["bellijst_testgroep"] = testgroep.astype(int)[patient_dag]
+    df["bellijst_testgroep_callcenter"] = callcenter.astype(int)[patient_dag]
+    # Voeg alleen een kolom toe welke sampling strategie is gebruikt, dan merk je er aan de voorkant niks van maar dan kunnen we wel onze analyse doen
+    df["predict_bellijst_sample_per_poli"] = sample_per_poli.astype(int)[patient_dag]
 
+    return df
 
-def voorspel_clusters(df, polis, modelmapping_voorspel, modelclusters, feature_list):
+
+@gemeten()
+def voorspel_clusters(
+    df,
+    polis,
+    modelmapping_voorspel,
+    modelclusters,
+    feature_list,
+    native=False,
+    n_workers=1,
+):
     """
     Doel: gebruik de getrainde modellen om voor elke poli volgende de aangegeven mapping een voorspelling te doen
     Input:
@@ -212,22 +297,63 @@ def voorspel_clusters(df, polis, modelmapping_voorspel, modelclusters, feature_l
         - modelmapping_voorspel: dict met welk model voor elke poli gebruikt moet worden
         - modelclusters: mapping met welke polis onder welk cluster vallen
         - feature_list: lijst met features om het model op te trainen, uit model_settings
+        - native: voorspel met de native export van de modellen (zie model_register.laad_model)
+        - n_workers: aantal threads om de modellen tegelijk mee te laten voorspellen, None voor het
+                aantal cores
     Output:
         - df: originele dataframe met 3 extra kolommen
                 - predict: basis voorspelling van model (0 of 1)
                 - predict_proba: proba voorspelling van het model (getal tussen 0 en 1)
                 - predict_bellijst: voorspelling als we prop_pos van de patienten een 1 geven (0 of 1)
+    Alleen de rijen van polis in polis, in de originele volgorde. Het aantal keer dat een model
+    voorspelt hangt af van het aantal verschillende modellen, niet van het aantal polis.
+    XGBoost geeft tijdens het voorspellen de GIL vrij, dus met meerdere threads voorspellen de
+    modellen echt tegelijk. Elk model schrijft zijn eigen posities in de resultaten, de uitkomst is
+    dus gelijk aan die met 1 thread.
     """
-    df_temp = []
+    # Per poli het model: het clustermodel uit de mapping, of anders het model van de poli zelf
+    model_per_poli = {}
     for poli in polis:
-        voorspel_model = modelmapping_voorspel[poli]
-        df_poli = df.loc[df["polikliniek"] == poli, :].copy()
-        if len(df_poli) > 0:
-            if voorspel_model in modelclusters.keys():
-                df_temp.append(voorspel(df_poli, voorspel_model, feature_list))
-            else:
-                df_temp.append(voorspel(df_poli, poli, feature_list))
-    df = pd.concat(df_temp)
+        model_naam = modelmapping_voorspel[poli]
+        model_per_poli[poli] = (
+            model_naam if model_naam in modelclusters.keys() else poli
+        )
+
+    # Verdeel de rijen 1 keer over de modellen, elk model voorspelt al zijn rijen in 1 keer. Rijen
+    # van polis die niet in polis staan krijgen geen voorspelling
+    modellen = df["polikliniek"].map(model_per_poli).astype(object)
+    df = df[modellen.notna().to_numpy()].copy()
+    codes, namen = pd.factorize(modellen.dropna())
+    volgorde = np.argsort(codes, kind="stable")
+    grenzen = np.searchsorted(codes[volgorde], np.arange(len(namen) + 1))
+
+    X = df[feature_list]
+    predict = np.zeros(len(df), dtype=int)
+    predict_proba = np.zeros(len(df))
+
+    def voorspel_rijen(i):
+        rijen = volgorde[grenzen[i] : grenzen[i + 1]]
+        # Elk model wordt per run maar 1 keer ingelezen (zie model_register)
+        pipeline = laad_model(namen[i], feature_list, native=native)
+        predict[rijen], predict_proba[rijen] = voorspel_model(pipeline, X.iloc[rijen])
+
+    n_workers = min(n_workers or os.cpu_count(), len(namen))
+    if n_workers <= 1:
+        for i in range(len(namen)):
+            voorspel_rijen(i)
+    else:
+        # De grootste modellen eerst, dan bepaalt het grootste model hoe lang het duurt
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            futures = [
+                pool.submit(voorspel_rijen, i)
+                for i in np.argsort(-np.diff(grenzen), kind="stable")
+            ]
+            # result() geeft een exceptie uit een thread door aan de hoofdthread
+            for future in futures:
+                future.result()
+
+    df["predict"] = predict
+    df["predict_proba"] = predict_proba
     return df
 
 
@@ -248,20 +374,35 @@ def gebelde_patienten_afgelopen_week(DBA_server_settings):
     # Haal de patienten op die gebeld zijn de afgelopen 7 dagen.
     # Er staat -8 dagen in de dateadd omdat Beldatum een datum veld is maar GETDATE() geeft ook een tijd terug
     where_statement = "Beldatum > DATEADD(day, -8, GETDATE())"
-    bellijst_df = load_dataset(
-        readserver=readserver_bellijstapp,
-        database=database_bellijstapp,
-        schema=schema_bellijstapp,
-        table="Bellijst",
-        where=where_statement,
+    # De lijsten veranderen alleen door het bellen zelf, binnen een uur opnieuw ophalen kan uit de cache.
+    # Het zijn patientnummers, dus alleen in het geheugen bewaren
+    bron = bron_versie(readserver_bellijstapp, database_bellijstapp, schema_bellijstapp)
+    bellijst_df = haal_referentie(
+        "bellijst",
+        lambda: load_dataset(
+            readserver=readserver_bellijstapp,
+            database=database_bellijstapp,
+            schema=schema_bellijstapp,
+            table="Bellijst",
+            where=where_statement,
+        ),
+        bron=bron_versie(bron, where_statement),
+        ttl_uren=1,
+        op_schijf=False,
     )
     bellijst_df["Beldatum"] = pd.to_datetime(bellijst_df["Beldatum"])
 
-    patienten_df = load_dataset(
-        readserver=readserver_bellijstapp,
-        database=database_bellijstapp,
-        schema=schema_bellijstapp,
-        table="Bellijst_patienten",
+    patienten_df = haal_referentie(
+        "bellijst_patienten",
+        lambda: load_dataset(
+            readserver=readserver_bellijstapp,
+            database=database_bellijstapp,
+            schema=schema_bellijstapp,
+            table="Bellijst_patienten",
+        ),
+        bron=bron,
+        ttl_uren=1,
+        op_schijf=False,
     )
     bellijst_df = bellijst_df.merge(
         patienten_df[["ID", "Patientnummer"]],
@@ -290,13 +431,27 @@ def momenteel_opgenomen_patienten(server_settings):
     cwd = Path.cwd()
     query_bestand = cwd / "Python" / "sql_queries" / ("opgenomen_patienten.sql")
 
-    query = query_bestand.as_posix()
-    with open(query_bestand, "r", encoding="utf-8") as f:
-        query = f.read()
+    def laad():
+        with open(query_bestand, "r", encoding="utf-8") as f:
+            query = f.read()
 
-    query = query.replace("@schema", server_settings["readschema"])
-    df_patienten = execute_query_text(
-        query, server_settings["readserver"], server_settings["readdatabase"]
+        query = query.replace("@schema", server_settings["readschema"])
+        return execute_query_text(
+            query, server_settings["readserver"], server_settings["readdatabase"]
+        )
+
+    # Opnames veranderen gedurende de dag, dus maar kort en alleen in het geheugen bewaren
+    df_patienten = haal_referentie(
+        "opgenomen_patienten",
+        laad,
+        bron=bron_versie(
+            bestand_versie(query_bestand),
+            server_settings["readserver"],
+            server_settings["readdatabase"],
+            server_settings["readschema"],
+        ),
+        ttl_uren=1,
+        op_schijf=False,
     )
 
     return df_patienten["patientnr"].values.tolist()
@@ -315,10 +470,21 @@ def patienten_nietbellen(bestandnaam):
     cwd = Path.cwd()
 
     path = cwd / "Python" / f"{bestandnaam}"
-    with open(path) as f:
-        patienten_nietbellen = json.load(f)
 
-    return patienten_nietbellen["patientnrs"]
+    def laad():
+        with open(path) as f:
+            patienten_nietbellen = json.load(f)
+        # Als string opslaan, de lijst kan zowel getallen als strings bevatten
+        return pd.DataFrame(
+            {"patientnr": [str(x) for x in patienten_nietbellen["patientnrs"]]}
+        )
+
+    # Het bestand wordt alleen opnieuw gelezen als het gewijzigd is, niet naar de cache map kopieren
+    df_nietbellen = haal_referentie(
+        "patienten_nietbellen", laad, bron=bestand_versie(path), op_schijf=False
+    )
+
+    return df_nietbellen["patientnr"].tolist()
 
 
 def voorspelling_voor_bellijst(
@@ -328,6 +494,8 @@ def voorspelling_voor_bellijst(
     poliklinieken,
     feature_list,
     beldienst_param,
+    native=False,
+    n_workers=1,
 ):
     """
     Doel: Genereer de voorspelling voor de bellijst
@@ -337,6 +505,8 @@ def voorspelling_voor_bellijst(
         - poliklinieken: poliklinieken waar een voorspelling voor gedaan moet worden
         - feature_list: lijst met features om het model op te trainen, uit model_settings
         - beldienst_param: dict met de beldienst parameters
+        - native: voorspel met de native export van de modellen (zie model_register.laad_model)
+        - n_workers: aantal threads voor het voorspellen (zie voorspel_clusters)
     Output:
         - df: originele dataframe met de voorspelling
 
@@ -349,7 +519,13 @@ def voorspelling_voor_bellijst(
     df = df[df["voldaan_af"].isna()]
 
     df = voorspel_clusters(
-        df, poliklinieken, modelmapping_voorspel, modelclusters, feature_list
+        df,
+        poliklinieken,
+        modelmapping_voorspel,
+        modelclusters,
+        feature_list,
+        native=native,
+        n_workers=n_workers,
     )
 
     df = test_controle_split(
@@ -358,21 +534,15 @@ def voorspelling_voor_bellijst(
         beldienst_param.get("test_group_fraction"),
         beldienst_param.get("callcenter_fraction"),
         beldienst_param.get("sampling_per_poli_fraction"),
+        seed=beldienst_param.get("seed"),
     )
-
-    patienten = (
-        df[["patientnr", "DATUM", "predict_bellijst", "bellijst_testgroep"]]
-        .sort_values(["patientnr", "DATUM", "predict_bellijst", "bellijst_testgroep"])
-        .drop_duplicates(subset=["patientnr", "DATUM"], keep="last")
-        .copy()
-    )
-    df = df.drop(columns=["predict_bellijst", "bellijst_testgroep"])
-    df = df.merge(patienten, how="left", on=["patientnr", "DATUM"])
+    # test_controle_split deelt per patient-dag in, alle afspraken van een patient op een dag hebben
+    # dus al dezelfde predict_bellijst en bellijst_testgroep
 
     return df
 
 
-def voorspel_per_dag(df, poli, feature_list, prop_pos=0.35):
+def voorspel_per_dag(df, poli, feature_list, prop_pos=0.35, seed=None):
     """
     Doel: gebruik een getraind model voor een poli om een voorspelling te doen op de manier zoals dat
             bij de bellijst gaat, namelijk 35% per dag
@@ -381,53 +551,40 @@ def voorspel_per_dag(df, poli, feature_list, prop_pos=0.35):
         - poli: polikliniek waar het model voor getrain moet worden, uit model_settings
         - feature_list: lijst met features om het model op te trainen, uit model_settings
         - prop_pos: proportie van patienten die we op de bellijst willen hebben (de hoogste x procent)
+        - seed: optioneel, seed voor de keuze van de bellijst (zie pos_labels_per_groep)
     Output:
         - df: originele dataframe met 3 extra kolommen
                 - predict: basis voorspelling van model (0 of 1)
                 - predict_proba: proba voorspelling van het model (getal tussen 0 en 1)
                 - predict_bellijst: voorspelling als we prop_pos van de patienten een 1 geven (0 of 1)
+            De rijen staan per dag bij elkaar, de dagen in de volgorde waarin ze in df voorkomen
     """
     X = df[feature_list]
 
-    cwd = Path.cwd()
+    # Elk model wordt per run maar 1 keer ingelezen, ook als meerdere polis hetzelfde model gebruiken
+    pipeline = laad_model(poli, feature_list)
+
+    df.loc[:, "predict"], df.loc[:, "predict_proba"] = voorspel_model(pipeline, X)
 
-    logger = logging.getLogger()
-    logger.info(f"Model laden voor {poli}")
-    filename = cwd / "Python" / "models" / (f"trained_model_{poli}.pkl")
-
-    pipeline = pickle.load(open(filename, "rb"))
-
-    df.loc[:, "predict"] = pipeline.predict(X).astype(int)
-    df.loc[:, "predict_proba"] = pipeline.predict_proba(X)[:, 1]
-
-    # Alle datums die in de dataframe voorkomen
-    datums = df["DATUM"].unique()
-    # Loop over alle dagen, maak de voorspelling zoals die ingesteld is voor de bellijst en
-    # verzamel alle voorspellingen
-    df_pred = []
-    for datum in datums:
-        df_datum = df[df["DATUM"] == datum]
-        if len(df_datum) > 0:
-            # We willen een percantage van het aantal patienten hebben ipv een percentage van het aantal afspraken
-            patienten = (
-                df_datum[["patientnr", "polikliniek", "DATUM", "predict_proba"]]
-                .sort_values(["patientnr", "DATUM", "predict_proba"])
-                .drop_duplicates(subset=["patientnr", "DATUM"], keep="last")
-            )
-            # van de predict_proba krijgt de bovenste prop_pos het voorspelde label 1
-            patienten["predict_bellijst"] = patienten.groupby(["DATUM"])[
-                "predict_proba"
-            ].transform(get_pos_labels, prop_pos=prop_pos)
-
-            df_datum = df_datum.merge(
-                patienten[["patientnr", "DATUM", "predict_bellijst"]],
-                how="left",
-                on=["patientnr", "DATUM"],
-            )
-        else:
-            df_datum[["predict_bellijst"]] = 0
-        df_pred.append(df_datum)
-
-    df_pred = pd.concat(df_pred)
+    # We willen een percantage van het aantal patienten hebben ipv een percentage van het aantal afspraken
+    patienten = (
+        df[["patientnr", "polikliniek", "DATUM", "predict_proba"]]
+        .sort_values(["patientnr", "DATUM", "predict_proba"])
+        .drop_duplicates(subset=["patientnr", "DATUM"], keep="last")
+    )
+    # van de predict_proba krijgt per dag de bovenste prop_pos het voorspelde label 1, alle dagen
+    # in 1 keer
+    patienten["predict_bellijst"] = pos_labels_per_groep(
+        patienten["predict_proba"], patienten["DATUM"], prop_pos=prop_pos, seed=seed
+    )
+
+    # De rijen per dag bij elkaar, in de volgorde waarin de dagen voorkomen
+    dagen = pd.factorize(df["DATUM"])[0]
+    volgorde = np.argsort(dagen, kind="stable")
+    df_pred = df.iloc[volgorde[dagen[volgorde] >= 0]].merge(
+        patienten[["patientnr", "DATUM", "predict_bellijst"]],
+        how="left",
+        on=["patientnr", "DATUM"],
+    )
 
     return df_pred
@@ -0,0 +1,122 @@
+import logsetup
+import logging
+
+import numpy as np
+import pandas as pd
+
+# Identificatienummers, die worden omgezet in integers. Het datatype ligt vast (nullable, lege waardes
+# worden NA), zodat de stores, de chunks in noshow_train en isin niet van de data van een run afhangen
+ID_KOLOMMEN = ["patientnr", "afspraaknr", "volgnummer"]
+ID_DTYPE = "Int64"
+# Codes met maar een handvol verschillende waardes, die worden een category
+CODE_KOLOMMEN = ["CODE", "verplreden", "MUTATIETYPE", "contacttype", "voldaan_af"]
+# Datum velden die als string of object uit de database kunnen komen
+DATUM_KOLOMMEN = ["DATUM", "datum_am", "datum_tijd_am", "mutatie_moment", "INVOERDAT"]
+
+
+def naar_integer(kolom):
+    """
+    Doel: zet een kolom met identificatienummers om in ID_DTYPE
+    Input:
+        - kolom: Series met nummers, als getal of als string
+    Output:
+        - Series met ID_DTYPE, lege waardes worden NA
+    Een nummer dat niet zonder verlies een integer kan worden (voorloopnullen of tekens die geen cijfer
+    zijn) geeft een ValueError, in plaats van dat het datatype van de kolom per run verschilt
+    """
+    kolom = kolom.replace("", np.nan)
+    getallen = pd.to_numeric(kolom, errors="coerce", dtype_backend="numpy_nullable")
+    fout = kolom.notna() & (getallen.isna() | (getallen % 1 != 0)).fillna(True)
+    getallen = getallen.mask(fout | kolom.isna()).astype(ID_DTYPE)
+    # Een string als "00123" moet niet stilletjes 123 worden
+    if kolom.dtype == object:
+        fout |= kolom.notna() & (
+            getallen.astype(str).to_numpy() != kolom.astype(str).to_numpy()
+        )
+    if fout.any():
+        raise ValueError(
+            f"Kolom {kolom.name}: {int(fout.sum())} nummers kunnen niet zonder verlies naar "
+            f"{ID_DTYPE}, bijv. {kolom[fout].unique()[:5].tolist()}"
+        )
+    return getallen
+
+
+def id_dtypes(df):
+    """
+    Doel: de datatypes van de identificatienummers, om op te slaan bij een store. Een store met andere
+            datatypes (bijv. van een run zonder ingest_afspraken) past niet bij de data van deze run
+    """
+    return {kolom: str(df[kolom].dtype) for kolom in ID_KOLOMMEN if kolom in df.columns}
+
+
+def ingest_afspraken(df):
+    """
+    Doel: zet de kolommen van de mutaties uit de SQL query om in compacte datatypes, zodat ontdubbelen,
+            sorteren, mergen en groupby's in de rest van de pipeline niet meer op Python strings werken.
+            Lege strings worden daarbij gelijk NaN/NaT.
+    Input:
+        - df: output van create_dataset
+    Output:
+        - df: dezelfde mutaties, met identificatienummers als ID_DTYPE, codes als category en
+                datum velden als datetime. Het geheugengebruik per kolom voor en na de omzetting
+                wordt gelogd
+    """
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    logger.info("Begin omzetten datatypes mutaties")
+    geheugen_voor = df.memory_usage(index=False, deep=True)
+    dtypes_voor = df.dtypes
+
+    df = df.copy()
+    for kolom in df.columns:
+        if kolom in ID_KOLOMMEN:
+            try:
+                df[kolom] = naar_integer(df[kolom])
+            except ValueError as fout:
+                logger.error(str(fout))
+                raise
+        elif kolom in CODE_KOLOMMEN:
+            df[kolom] = df[kolom].replace("", np.nan).astype("category")
+        elif kolom in DATUM_KOLOMMEN:
+            if df[kolom].dtype == object:
+                df[kolom] = df[kolom].replace("", np.nan)
+            df[kolom] = pd.to_datetime(df[kolom], errors="coerce")
+        elif df[kolom].dtype == object:
+            # Overige string kolommen, zoals TIJD, aankomst en postcode
+            df[kolom] = df[kolom].replace("", np.nan)
+
+    geheugen_na = df.memory_usage(index=False, deep=True)
+    rapport = pd.DataFrame(
+        {
+            "dtype_voor": dtypes_voor.astype(str),
+            "dtype_na": df.dtypes.astype(str),
+            "MB_voor": geheugen_voor / 2**20,
+            "MB_na": geheugen_na / 2**20,
+        }
+    )
+    for kolom, rij in rapport.iterrows():
+        logger.info(
+            f"{kolom}: {rij['MB_voor']:.1f} MB ({rij['dtype_voor']}) -> {rij['MB_na']:.1f} MB ({rij['dtype_na']})"
+        )
+    logger.info(
+        f"Geheugengebruik mutaties: {rapport['MB_voor'].sum():.1f} MB -> {rapport['MB_na'].sum():.1f} MB"
+    )
+
+    return df
+
+
+def als_kolom_dtype(waarden, kolom):
+    """
+    Doel: zet een lijst met waardes (bijv. patientnummers uit een andere database) om naar het
+            datatype van kolom, zodat isin na ingest_afspraken nog steeds matcht
+    Input:
+        - waarden: lijst of array met waardes
+        - kolom: de Series waar de waardes in opgezocht gaan worden
+    Output:
+        - array met waardes in het datatype van kolom
+    """
+    if pd.api.types.is_integer_dtype(kolom.dtype):
+        getallen = pd.to_numeric(pd.Series(waarden, dtype=object), errors="coerce")
+        return getallen.dropna().astype("int64").to_numpy()
+    return waarden
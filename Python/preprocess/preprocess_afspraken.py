@@ -5,26 +5,72 @@ import numpy as np
 import pandas as pd
 from datetime import date, timedelta
 
-
-def preprocess_afspraken(df):
+from preprocess.tijdvelden import normaliseer_tijden, datum_plus_minuten
+from utilities.instrumentatie import gemeten
+
+# Lijst met codes die duidelijk staan voor dat de patient de oorzaak is
+# Als er geen code staat opgegeven, ga er dan vauit dat de patient de reden is
+DOOR_PAT = [
+    "CS00000002",  # Verzoek patient
+    "N",  # Patient niet verschenen / te laat gemeld (<24 uur)
+    "CS00000003",  # Patient niet bereikbaar (telefonisch consult)
+    "Q",  # Patient niet bereikbaar (telefonisch consult)
+    "NF",  # No show (geen factuur)
+    "P",  # Verzoek patient (>24 uur van tevoren afgemeld)
+    "Z",  # Ik ben ziek
+    "",  # Geen reden opgegeven, default is door patient?
+]
+
+# De soorten rijen die de classificatie oplevert, in de volgorde waarin ze in de output komen
+SHOW, NOSHOW, VERPLAATSING, ANNULERING, TOEKOMSTIG = range(5)
+
+
+def groep_codes(kolom):
     """
-    Doel: voorverwerking data zodat feature enginering gedaan kan worden. Er moet wat met kolommen geschoven worden omdat HiX veel data overschrijft. Zo willen we bijv voor
-            verplaatsingen niet de datum waar het naartoe verplaatst is, maar waar het vandaan verplaatst is. Ook kunnen we hier al filteren op de juiste verplaatsredenen en
-            makkelijk een paar eerste features aanmaken zoals dagen tussen maken van afspraak en plaatsvinden afspraak
+    Doel: geef elke waarde in een (gesorteerde) kolom een groepscode. Lege waardes krijgen
+            allemaal code -1, net als drop_duplicates ze als 1 groep ziet
+    """
+    codes, _ = pd.factorize(kolom)
+    return codes
 
-    Input:
-        - df: output van de SQL query met alle benodigde mutaties van de afspraken die we willen analyseren
+
+def groepsgrenzen(codes):
+    """
+    Doel: bepaal voor een gesorteerde array met groepscodes welke rijen de eerste en
+            welke de laatste van hun groep zijn
     Output:
-        - df: Afspraken voorverwerkt en klaar voor verdere feature enginering. Elke rij van deze df representeert een 'gereserveerd tijdslot', een afspraak waarvoor
-                op de DATUMTIJD kolom een tijd voor gereserveerd was, en uiteindelijk is geresulteerd in een show, no show, verplaatsing of annulering.
+        - eerste, laatste: boolean arrays
     """
-    logsetup.setup_logging()
-    logger = logging.getLogger()
+    eerste = np.ones(len(codes), dtype=bool)
+    eerste[1:] = codes[1:] != codes[:-1]
+    laatste = np.ones(len(codes), dtype=bool)
+    laatste[:-1] = eerste[1:]
+    return eerste, laatste
 
-    logger.info("Begin preprocessing afspraken")
-    # NaN werken fijner dan lege strings
-    df = df.replace("", np.nan)
 
+def laatste_in_groep(codes, mask):
+    """
+    Doel: bepaal binnen de rijen van mask welke de laatste van hun groep is. Dit is
+            hetzelfde als df[mask].drop_duplicates(groep, keep="last") op een gesorteerde df,
+            maar dan zonder tussentijdse kopie
+    """
+    posities = np.flatnonzero(mask)
+    laatste = np.ones(len(posities), dtype=bool)
+    laatste[:-1] = codes[posities[1:]] != codes[posities[:-1]]
+    resultaat = np.zeros(len(codes), dtype=bool)
+    resultaat[posities[laatste]] = True
+    return resultaat
+
+
+def selecteer_mutaties(df):
+    """
+    Doel: houd van alle mutaties alleen de relevante over: de eerste en laatste mutatie van elke
+            afspraak en alle verplaatsingen
+    Input:
+        - df: output van de SQL query met alle mutaties
+    Output:
+        - df: de relevante mutaties, gesorteerd op afspraaknr/volgnummer
+    """
     # Soms staan er 2 adressen op iemands naam geregistreerd, bijv een officieel en een verblijf adres.
     # In de query is rekening gehouden met een aantal zaken (zoals alleen adressen in NL), maar
     # als laatste redmiddel doen we hier een hard coded ontdubbeling
@@ -37,54 +83,54 @@ def preprocess_afspraken(df):
     # Sorteer op afspraaknummer/volgnummer, de eerste is hoe de afspraak aangemaakt is, de laatste is hoe die afgesloten is.
     # Als daar alle verplaatsingen aan toegevoegd worden hebben we alle relevantie acties
     df = df.sort_values(["afspraaknr", "volgnummer"])
-    eerste = df.drop_duplicates(subset=["afspraaknr"], keep="first")
-    laatste = df.drop_duplicates(subset=["afspraaknr"], keep="last")
-    verplaatsing = df[df["MUTATIETYPE"] == "Verplaatst"]
-
-    df = pd.concat([verplaatsing, eerste, laatste], ignore_index=True)
-
-    # Als de laatste afspraak een verplaatsing is (voor afspraken in de toekomst), krijg je dubbele regels die verwijderd moeten worden
-    df = df.drop_duplicates(subset=["volgnummer"])
-
-    # Zet de datum velden om in datetime variabelen
-    df["datum_tijd_am"] = pd.to_datetime(df["datum_tijd_am"], errors="coerce")
-    df["datum_am"] = pd.to_datetime(df["datum_am"], errors="coerce")
-    # Als de DATUM kolom leeg is (bij annuleringen), vul dan datum_am in
-    df["DATUM"] = df["DATUM"].fillna(df["datum_am"])
-    df["TIJD"] = df["TIJD"].fillna(df["tijd_am"])
-
-    # Combineer tot een datum_tijd kolom
-    df["DATUMTIJD"] = pd.to_datetime(df["DATUM"], errors="coerce") + pd.to_timedelta(
-        df["TIJD"] + ":00", errors="coerce"
-    )
-
-    # Lijst met codes die duidelijk staan voor dat de patient de oorzaak is
-    # Als er geen code staat opgegeven, ga er dan vauit dat de patient de reden is
-    door_pat = [
-        "CS00000002",  # Verzoek patient
-        "N",  # Patient niet verschenen / te laat gemeld (<24 uur)
-        "CS00000003",  # Patient niet bereikbaar (telefonisch consult)
-        "Q",  # Patient niet bereikbaar (telefonisch consult)
-        "NF",  # No show (geen factuur)
-        "P",  # Verzoek patient (>24 uur van tevoren afgemeld)
-        "Z",  # Ik ben ziek
-        "",  # Geen reden opgegeven, default is door patient?
-    ]
-
-    ############################################################################
-    # Voorverwerking verplaatsingen
-    ############################################################################
+    eerste, laatste = groepsgrenzen(groep_codes(df["afspraaknr"]))
+    verplaatsing = (df["MUTATIETYPE"] == "Verplaatst").to_numpy()
+    selectie = verplaatsing | eerste | laatste
+
+    # Als de laatste afspraak een verplaatsing is (voor afspraken in de toekomst), zit een mutatie
+    # in meerdere van de selecties, maar die nemen we maar 1 keer mee. Alleen als een volgnummer
+    # bij verschillende mutaties voorkomt moet bepaald worden welke bewaard blijft: dan wint
+    # (net als voorheen) een verplaatsing van de eerste, en de eerste van de laatste mutatie
+    volgnummers = df["volgnummer"].to_numpy()[selectie]
+    if pd.Series(volgnummers).duplicated().any():
+        posities = np.flatnonzero(selectie)
+        prioriteit = np.select([verplaatsing, eerste], [0, 1], 2)[selectie]
+        volgorde = np.lexsort((posities, prioriteit))
+        dubbel = pd.Series(volgnummers[volgorde]).duplicated().to_numpy()
+        selectie = np.zeros(len(df), dtype=bool)
+        selectie[posities[volgorde[~dubbel]]] = True
+
+    return df[selectie]
+
+
+def verrijk_mutaties(df):
+    """
+    Doel: zet de informatie van de vorige mutatie van dezelfde afspraak op de rij zelf, zodat
+            bijv. bij verplaatsingen bekend is waar de afspraak vandaan verplaatst is
+    Input:
+        - df: output van selecteer_mutaties, gesorteerd op afspraaknr/volgnummer
+    Output:
+        - df: fysieke afspraakmutaties met de genormaliseerde tijdvelden, de lag_ kolommen, uren_voor_mut
+                en dagen_tot_afspraak erbij
+    """
+    # Parse alle datum en tijd velden in 1 keer
+    df = normaliseer_tijden(df)
 
-    logger.info("Verplaatsingen verwerken")
     # Bij verplaatsingen staat alleen de nieuwe data in de rij, waar het naar toe verplaatst is.
     # Voor de preprocessing willen we echter ook weten waar het vandaag verplaatst is,
-    # die informatie moet eerst op dezelfde rij gezet worden.
-    df = df.sort_values(["afspraaknr", "volgnummer"])
-    df_group = df.groupby("afspraaknr")
-    df["lag_duur"] = df_group["DUUR"].transform("shift")
-    df["lag_code"] = df_group["CODE"].transform("shift")
-    df["lag_datum_tijd_am"] = df_group["datum_tijd_am"].transform("shift")
-    df["lag_datum_am"] = df_group["datum_am"].transform("shift")
+    # die informatie moet eerst op dezelfde rij gezet worden. De df is al gesorteerd op
+    # afspraaknr/volgnummer, dus de vorige rij is de vorige mutatie, behalve op de grens van
+    # een afspraak (of als er geen afspraaknr is)
+    codes = groep_codes(df["afspraaknr"])
+    eerste, _ = groepsgrenzen(codes)
+    geen_vorige = eerste | (codes == -1)
+    for kolom, lag_kolom in [
+        ("DUUR", "lag_duur"),
+        ("CODE", "lag_code"),
+        ("datum_tijd_am", "lag_datum_tijd_am"),
+        ("datum_am", "lag_datum_am"),
+    ]:
+        df[lag_kolom] = df[kolom].shift().mask(geen_vorige)
     # toevoeging i.v.m. een error over het datatype
     df["lag_datum_tijd_am"] = df["lag_datum_tijd_am"].fillna(value=np.datetime64("nat"))
 
@@ -103,9 +149,7 @@ def preprocess_afspraken(df):
     df["dagen_vooruit"] = df["datum_tijd_am"] - df["mutatie_moment"]
     # Schuif deze informatie 1 rij naar beneden zodat we per rij weten hoeveel dagen
     # er zitten tussen het maken van de afspraak en het plaatsvinden ervan.
-    df["dagen_tot_afspraak"] = df.groupby("afspraaknr")["dagen_vooruit"].transform(
-        "shift"
-    )
+    df["dagen_tot_afspraak"] = df["dagen_vooruit"].shift().mask(geen_vorige)
     # Alleen bij de eerste mutatie moet de dagen_vooruit gepakt worden
     df["dagen_tot_afspraak"] = df["dagen_tot_afspraak"].fillna(df["dagen_vooruit"])
     # en bij verplaatsingen hebben we wel de dagen_vooruit kolom nodig
@@ -117,149 +161,134 @@ def preprocess_afspraken(df):
     # Dit is relevant voor bijv afspraken die zijn omgezet van fysiek naar telefonisch of andersom
     df = df[(df["contacttype"] == "F") & (df["zonder_patient"] == 0)]
 
-    # Er zijn nu 5 verschillende soorten rijen die elk op een eigen manier gewerkt
-    # moeten worden, (i) afspraken die nog niet hebben plaatsgevonden (ii) shows
-    # (iii) no-shows (iv) verplaatsingen en (v) annuleringen
-    logger.info("Verwerking verschillende afspraakmutaties")
+    return df
 
-    ############################################################################
-    # Toekomstige afspraken
-    ############################################################################
 
-    # De afspraak zoals die gepland staat is de laatste mutatie van de afspraak
-    K = df.sort_values(["afspraaknr", "volgnummer"]).drop_duplicates(
-        subset=["afspraaknr"], keep="last"
-    )
-    # De geplande afspraken zijn degene met de datum na vandaag
-    vandaag = date.today()
-    K = K[
-        (K["DATUM"] >= (pd.to_datetime(vandaag)))
-        & (K["DATUM"] <= (pd.to_datetime(vandaag) + timedelta(30)))
+def classificeer_mutaties(df, vandaag=None):
+    """
+    Doel: bepaal in 1 keer voor elke mutatie of die als show, no-show, verplaatsing, annulering en/of
+            toekomstige afspraak meegenomen moet worden
+    Input:
+        - df: output van verrijk_mutaties, gesorteerd op afspraaknr/volgnummer
+        - vandaag: optioneel, de datum van vandaag (voor reproduceerbare runs), standaard date.today()
+    Output:
+        - posities: de posities van de rijen in df die in de output komen, in de volgorde
+                show, no-show, verplaatsing, annulering, toekomstig
+        - soort: per positie de soort rij (SHOW, NOSHOW, VERPLAATSING, ANNULERING of TOEKOMSTIG)
+    Een mutatie kan in meerdere soorten vallen (bijv een show van vandaag is ook een toekomstige
+    afspraak), die komt dan ook meerdere keren in de output.
+    """
+    codes = groep_codes(df["afspraaknr"])
+    _, laatste = groepsgrenzen(codes)
+
+    vandaag = pd.to_datetime(vandaag or date.today()).normalize()
+    verleden = (df["DATUM"] <= vandaag).to_numpy()
+
+    soorten = [
+        # Shows: alle benodigde informatie voor de afspraak zit in de laatste rij van elke groep
+        laatste_in_groep(codes, (df["voldaan_af"] == "J").to_numpy() & verleden),
+        # No-shows: ook hier de laatste mutatie
+        laatste_in_groep(codes, (df["voldaan_af"] == "N").to_numpy() & verleden),
+        # Verplaatsingen, we kijken niet naar verplaatsingen naar een andere tijd op dezelfde dag
+        (df["MUTATIETYPE"] == "Verplaatst").to_numpy()
+        & verleden
+        & (df["verpl_zelfde_dag"] == False).to_numpy(),
+        # Annuleringen
+        laatste_in_groep(
+            codes, (df["MUTATIETYPE"] == "Geannuleerd").to_numpy() & verleden
+        ),
+        # Toekomstige afspraken: de afspraak zoals die gepland staat is de laatste mutatie
+        # van de afspraak, met een datum vanaf vandaag
+        laatste
+        & (df["DATUM"] >= vandaag).to_numpy()
+        & (df["DATUM"] <= vandaag + timedelta(30)).to_numpy(),
     ]
-    # Voor een afspraak die nog moet plaatsvinden is het actie moment het moment van plannen, dus de mutatie tijd van laatste mutatie
-    K["actie_moment"] = K["DATUMTIJD"]
 
-    ############################################################################
-    # Shows
-    ############################################################################
+    posities = np.concatenate([np.flatnonzero(mask) for mask in soorten])
+    soort = np.repeat(np.arange(len(soorten)), [mask.sum() for mask in soorten])
 
-    # Voor de shows zit alle benodigde informatie voor de afspraak zit in de laatste rij van elke groep
-    S = df[(df["voldaan_af"] == "J") & (df["DATUM"] <= pd.to_datetime(vandaag))].copy()
-    S = S.sort_values(["afspraaknr", "volgnummer"]).drop_duplicates(
-        subset=["afspraaknr"], keep="last"
-    )
-    # Voor een afspraak die is afgerond is het actie moment het moment dat de afspraak heeft plaatsgevonden
-    S["actie_moment"] = S["DATUMTIJD"]
+    return posities, soort
 
-    ############################################################################
-    # No-shows
-    ############################################################################
 
-    # Voor de no-shows zit alle benodigde informatie voor de afspraak zit in de laatste rij van elke groep
-    NS = df[(df["voldaan_af"] == "N") & (df["DATUM"] <= pd.to_datetime(vandaag))].copy()
-    # Pak ook bij no shows de laatste mutatie
-    NS = NS.sort_values(["afspraaknr", "volgnummer"]).drop_duplicates(
-        subset=["afspraaknr"], keep="last"
-    )
-
-    # Als er een andere code staat dan in door_pat, dan komt het door het ziekenhuis
-    NS["voldaan_af"] = "Door Arts"
-    NS.loc[
-        (NS["verplreden"].isna()) | (NS["verplreden"].isin(door_pat)), "voldaan_af"
-    ] = "N"
+def verwerk_mutaties(df, vandaag=None):
+    """
+    Doel: verwerk de verrijkte mutaties tot 'gereserveerde tijdsloten': shows, no-shows,
+            verplaatsingen, annuleringen en toekomstige afspraken, elk op hun eigen manier
+    Input:
+        - df: output van verrijk_mutaties
+        - vandaag: optioneel, zie classificeer_mutaties
+    Output:
+        - df_preproc: zie preprocess_afspraken
+    Dit deel hangt af van de datum van vandaag, de stappen ervoor niet.
+    """
+    # Er zijn nu 5 verschillende soorten rijen die elk op een eigen manier gewerkt
+    # moeten worden, (i) afspraken die nog niet hebben plaatsgevonden (ii) shows
+    # (iii) no-shows (iv) verplaatsingen en (v) annuleringen
+    posities, soort = classificeer_mutaties(df, vandaag=vandaag)
+    df_preproc = df.take(posities).reset_index(drop=True)
 
-    # De verplaats reden P betekent dat de patient de afspraak op tijd heeft geannuleerd, dus dat is effectief een show
-    NS.loc[NS["verplreden"] == "P", "voldaan_af"] = "J"
-    # Voor een afspraak die is afgerond is het actie moment het moment dat de afspraak heeft plaatsgevonden
-    NS["actie_moment"] = NS["DATUMTIJD"]
+    noshow = soort == NOSHOW
+    verplaatsing = soort == VERPLAATSING
+    verpl_annul = verplaatsing | (soort == ANNULERING)
 
     ############################################################################
-    # Verplaatsingen
+    # No-shows, verplaatsingen en annuleringen
     ############################################################################
 
-    # De verplaatsingen die we willen meenemen als show/no-show
-    V = df[
-        (df["MUTATIETYPE"] == "Verplaatst") & (df["DATUM"] <= pd.to_datetime(vandaag))
-    ].copy()
-    # We kijken niet naar verplaatsingen naar een andere tijd op dezelfde dag
-    V = V[V["verpl_zelfde_dag"] == False]
-
-    # Alleen een no-show als die verplaatst is minder dan 24 uur van de tevoren
-    # op initiatief van de patient. Anders is het ziekenhuis de oorzaak
-    V["voldaan_af"] = "Door Arts"
-    V.loc[
-        ((V["verplreden"].isna()) | (V["verplreden"].isin(door_pat)))
-        & (V["uren_voor_mut"] < 24),
-        "voldaan_af",
-    ] = "N"
-    V.loc[
-        ((V["verplreden"].isna()) | (V["verplreden"].isin(door_pat)))
-        & (V["uren_voor_mut"] >= 24),
-        "voldaan_af",
-    ] = "J"
-
-    V.loc[V["verplreden"] == "P", "voldaan_af"] = "J"
-
-    # Bij een verplaatsing willen we weten waar het vandaan verplaatst is, en dus ook
-    # wat de duur en de afspraakcode waren (voor de verplaatsing)
-    V["DATUMTIJD"] = V["lag_datum_tijd_am"]
-    V["DATUM"] = V["lag_datum_am"]
-    V["DUUR"] = V["lag_duur"]
-    V["CODE"] = V["lag_code"]
-
-    # Bij een verplaatsing is de aankomst kolom leeg (komt nu uit een latere mutatie)
-    V["aankomst"] = np.nan
-    # Voor een verplaatsing is het actie moment wanneer de afspraak verplaatst is
-    V["actie_moment"] = V["mutatie_moment"]
-
-    ############################################################################
-    # Annuleringen
-    ############################################################################
+    # Bij een no-show komt het door het ziekenhuis als er een andere code staat dan in DOOR_PAT.
+    # Een verplaatsing of annulering is alleen een no-show als die minder dan 24 uur van de tevoren
+    # is gedaan op initiatief van de patient. Anders is het ziekenhuis de oorzaak
+    door_pat = (
+        df_preproc["verplreden"].isna() | df_preproc["verplreden"].isin(DOOR_PAT)
+    ).to_numpy()
+    uren_voor_mut = df_preproc["uren_voor_mut"].to_numpy()
+    uitkomst = np.select(
+        [
+            # De verplaats reden P betekent dat de patient de afspraak op tijd heeft geannuleerd, dus dat is effectief een show
+            (df_preproc["verplreden"] == "P").to_numpy(),
+            door_pat & noshow,
+            door_pat & (uren_voor_mut < 24),
+            door_pat & (uren_voor_mut >= 24),
+        ],
+        ["J", "N", "N", "J"],
+        "Door Arts",
+    )
+    df_preproc["voldaan_af"] = np.where(
+        noshow | verpl_annul, uitkomst, df_preproc["voldaan_af"].to_numpy(dtype=object)
+    )
 
-    # Als laatste de annuleringen die op een net iets andere manier dan de verplaatsingen
-    # verwerkt moeten worden
-    A = df[
-        (df["MUTATIETYPE"] == "Geannuleerd") & (df["DATUM"] <= pd.to_datetime(vandaag))
-    ].copy()
-    A = A.sort_values(["afspraaknr", "volgnummer"]).drop_duplicates(
-        subset=["afspraaknr"], keep="last"
+    # Voor een afspraak die is afgerond (of nog moet plaatsvinden) is het actie moment het moment dat
+    # de afspraak plaatsvindt, voor een verplaatsing of annulering wanneer de afspraak verplaatst is
+    df_preproc["actie_moment"] = df_preproc["DATUMTIJD"].where(
+        ~verpl_annul, df_preproc["mutatie_moment"]
     )
 
-    # Alleen een no-show als die verplaatst is minder dan 24 uur van de tevoren
-    # op initiatief van de patient. Anders is het ziekenhuis de oorzaak
-
-    A["voldaan_af"] = "Door Arts"
-    A.loc[
-        ((A["verplreden"].isna()) | (A["verplreden"].isin(door_pat)))
-        & (A["uren_voor_mut"] < 24),
-        "voldaan_af",
-    ] = "N"
-    A.loc[
-        ((A["verplreden"].isna()) | (A["verplreden"].isin(door_pat)))
-        & (A["uren_voor_mut"] >= 24),
-        "voldaan_af",
-    ] = "J"
-    # De verplaats reden P betekent dat de patient de afspraak op tijd heeft geannuleerd, dus dat is effectief een show
-    A.loc[A["verplreden"] == "P", "voldaan_af"] = "J"
-
-    # Bij een annulering is de aankomst kolom leeg (komt nu uit een latere mutatie)
-    A["aankomst"] = np.nan
-    # Voor een verplaatsing is het actie moment wanneer de afspraak verplaatst is
-    A["actie_moment"] = A["mutatie_moment"]
+    # Bij een verplaatsing willen we weten waar het vandaan verplaatst is, en dus ook
+    # wat de duur en de afspraakcode waren (voor de verplaatsing). Begin vanuit de lag_ kolom,
+    # zodat het datatype hetzelfde wordt als bij het samenvoegen van losse dataframes
+    for kolom, lag_kolom in [
+        ("DATUMTIJD", "lag_datum_tijd_am"),
+        ("DATUM", "lag_datum_am"),
+        ("DUUR", "lag_duur"),
+        ("CODE", "lag_code"),
+    ]:
+        df_preproc[kolom] = df_preproc[lag_kolom].where(verplaatsing, df_preproc[kolom])
+
+    # Bij een verplaatsing of annulering is de aankomst kolom leeg (komt nu uit een latere mutatie)
+    df_preproc["aankomst"] = df_preproc["aankomst"].where(~verpl_annul)
+    df_preproc["aankomst_minuut"] = df_preproc["aankomst_minuut"].where(~verpl_annul)
 
     ############################################################################
     # Hercombineren
     ############################################################################
 
-    # Combineer nu de shows, no-shows en verplaatsingen. Check nu weer op afspraken die te ver vooruit zijn gepland (of achteraf zijn ingevoerd)
-    # en afspraken die buiten de regulieren uren vallen
-    df_preproc = pd.concat([S, NS, V, A, K], ignore_index=True)
-
     # Gooi wat lag_ kolommen weg die niet meer nodig zijn
     df_preproc = df_preproc.drop(
         columns=["lag_duur", "lag_code", "lag_datum_am", "lag_datum_tijd_am"]
     )
 
+    # Check nu weer op afspraken die te ver vooruit zijn gepland (of achteraf zijn ingevoerd)
+    # en afspraken die buiten de regulieren uren vallen
     df_preproc = df_preproc[~df_preproc["actie_moment"].isna()]
     ############################################################################
     # Afronden en overig
@@ -267,9 +296,9 @@ def preprocess_afspraken(df):
 
     df_preproc["DATUM"] = pd.to_datetime(df_preproc["DATUM"])
     # Combineer tot een datum_tijd kolom
-    df_preproc["DATUMTIJD"] = pd.to_datetime(
-        df_preproc["DATUM"], errors="coerce"
-    ) + pd.to_timedelta(df_preproc["TIJD"] + ":00", errors="coerce")
+    df_preproc["DATUMTIJD"] = datum_plus_minuten(
+        df_preproc["DATUM"], df_preproc["tijd_minuut"]
+    )
 
     # Tijdelijke voor backwards compatability
     df_preproc["TIJDMIN"] = df_preproc["TIJD"]
@@ -286,6 +315,42 @@ def preprocess_afspraken(df):
         subset=["patientnr", "DATUMTIJD"], keep="first"
     )
 
+    return df_preproc
+
+
+@gemeten()
+def preprocess_afspraken(df, vandaag=None):
+    """
+    Doel: voorverwerking data zodat feature enginering gedaan kan worden. Er moet wat met kolommen geschoven worden omdat HiX veel data overschrijft. Zo willen we bijv voor
+            verplaatsingen niet de datum waar het naartoe verplaatst is, maar waar het vandaan verplaatst is. Ook kunnen we hier al filteren op de juiste verplaatsredenen en
+            makkelijk een paar eerste features aanmaken zoals dagen tussen maken van afspraak en plaatsvinden afspraak
+
+    Input:
+        - df: output van de SQL query met alle benodigde mutaties van de afspraken die we willen analyseren
+        - vandaag: optioneel, de datum die als vandaag gebruikt wordt (bijv. voor de benchmark), standaard date.today()
+    Output:
+        - df: Afspraken voorverwerkt en klaar voor verdere feature enginering. Elke rij van deze df representeert een 'gereserveerd tijdslot', een afspraak waarvoor
+                op de DATUMTIJD kolom een tijd voor gereserveerd was, en uiteindelijk is geresulteerd in een show, no show, verplaatsing of annulering.
+    """
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    logger.info("Begin preprocessing afspraken")
+    # NaN werken fijner dan lege strings
+    df = df.replace("", np.nan)
+
+    df = selecteer_mutaties(df)
+
+    ############################################################################
+    # Voorverwerking verplaatsingen
+    ############################################################################
+
+    logger.info("Verplaatsingen verwerken")
+    df = verrijk_mutaties(df)
+
+    logger.info("Verwerking verschillende afspraakmutaties")
+    df_preproc = verwerk_mutaties(df, vandaag=vandaag)
+
     logger.info("Eind preprocessing afspraken")
 
     return df_preproc
@@ -0,0 +1,479 @@
+import logsetup
+import logging
+
+import json
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from preprocess.ingest_afspraken import id_dtypes
+from preprocess.preprocess_afspraken import (
+    preprocess_afspraken,
+    selecteer_mutaties,
+    verrijk_mutaties,
+    verwerk_mutaties,
+)
+from utilities.unify_cwd import unify_cwd
+from utilities.instrumentatie import gemeten
+
+# Verhoog bij een wijziging in de kolommen van de opgeslagen mutaties of in de indeling van de store,
+# een store met een andere versie wordt dan opnieuw opgebouwd
+STORE_VERSIE = 3
+
+# Aantal rijen per row group in de partities, zodat bij het inlezen met een filter op patientnr
+# alleen de row groups met die patienten gelezen worden
+RIJEN_PER_GROEP = 20_000
+
+# Partitie voor afspraken zonder datum
+GEEN_DATUM = "geen_datum"
+
+
+def store_pad(submodus):
+    """
+    Doel: de map waar de voorbewerkte afspraken voor een submodus (train/holdout/voorspel) bewaard worden
+    """
+    cwd = Path.cwd()
+    cwd = unify_cwd(cwd)
+    return cwd / "Python" / "cache" / f"preprocess_{submodus}"
+
+
+def lees_manifest(store):
+    """
+    Doel: lees het manifest van de store: de watermark (het mutatie_moment tot waar de mutaties
+            verwerkt zijn), de index en de bestanden van de partities
+    Output:
+        - dict met versie, mutatie_moment, bijgewerkt, index en partities, of None als er nog geen
+            store met de huidige versie is
+    """
+    pad = Path(store) / "manifest.json"
+    if not pad.is_file():
+        return None
+    with open(pad, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("versie") != STORE_VERSIE:
+        return None
+    return manifest
+
+
+def schrijf_parquet(df, pad, **kwargs):
+    """
+    Doel: schrijf een dataframe weg via een tijdelijk bestand, zodat een afgebroken run nooit
+            een half geschreven bestand achterlaat. kwargs gaan naar to_parquet
+    """
+    tijdelijk = pad.with_suffix(".tmp")
+    df.to_parquet(tijdelijk, index=False, **kwargs)
+    os.replace(tijdelijk, pad)
+
+
+def lees_parquet(pad, filters=None):
+    """
+    Doel: lees een dataframe uit de store, lege waardes in string kolommen komen als None terug en
+            worden weer NaN zoals in preprocess_afspraken
+    Input:
+        - filters: optioneel, filters voor read_parquet, bijv. [("patientnr", "in", patienten)]
+    """
+    df = pd.read_parquet(pad, filters=filters)
+    for kolom in df.columns[df.dtypes == object]:
+        df[kolom] = df[kolom].mask(df[kolom].isna(), np.nan)
+    return df
+
+
+def herstel_categories(df, voorbeeld):
+    """
+    Doel: na een concat met verschillende categories wordt een category kolom object, zet die terug
+    """
+    for kolom in df.columns:
+        if (
+            kolom in voorbeeld.columns
+            and isinstance(voorbeeld[kolom].dtype, pd.CategoricalDtype)
+            and not isinstance(df[kolom].dtype, pd.CategoricalDtype)
+        ):
+            df[kolom] = df[kolom].astype("category")
+    return df
+
+
+def laatste_datums(mutaties):
+    """
+    Doel: de laatste geplande datum per afspraaknr, daarop wordt de store opgeruimd en gepartitioneerd
+    """
+    datum = pd.to_datetime(
+        mutaties["DATUM"].fillna(mutaties["datum_am"]), errors="coerce"
+    )
+    return datum.groupby(mutaties["afspraaknr"]).max()
+
+
+def verwijder_oude_afspraken(mutaties, verrijkt, datum_range, afspr_gesch):
+    """
+    Doel: gooi afspraken weg die niet meer nodig zijn voor de afspraakgeschiedenis, oftewel
+            waarvan de laatste geplande datum meer dan afspr_gesch dagen voor de datum range ligt
+    """
+    ondergrens = pd.to_datetime(datum_range[0], errors="coerce")
+    if pd.isna(ondergrens):
+        return mutaties, verrijkt
+    laatste_datum = laatste_datums(mutaties)
+    oud = laatste_datum.index[laatste_datum < ondergrens - timedelta(afspr_gesch)]
+
+    return (
+        mutaties[~mutaties["afspraaknr"].isin(oud)],
+        verrijkt[~verrijkt["afspraaknr"].isin(oud)],
+    )
+
+
+def afspraak_index(mutaties, verrijkt):
+    """
+    Doel: maak de index van de store voor een aantal afspraken
+    Input:
+        - mutaties: geselecteerde mutaties van de afspraken (zie selecteer_mutaties)
+        - verrijkt: verrijkte mutaties van dezelfde afspraken (zie verrijk_mutaties)
+    Output:
+        - dataframe met per afspraaknr het patientnr, het laatste verwerkte mutatie_moment, de laatste
+            datum (voor het opruimen), de eerste en laatste DATUM van de verrijkte mutaties (voor het
+            zoeken van de patienten in de datum range) en de partitie: de maand van de laatste datum
+    """
+    index = mutaties.groupby("afspraaknr", sort=False, observed=True)[
+        ["patientnr"]
+    ].first()
+    index["verwerkt_tot"] = mutaties.groupby("afspraaknr", observed=True)[
+        "mutatie_moment"
+    ].max()
+    index["laatste_datum"] = laatste_datums(mutaties)
+    datums = verrijkt.groupby("afspraaknr", observed=True)["DATUM"]
+    index["min_datum"] = datums.min()
+    index["max_datum"] = datums.max()
+    index["partitie"] = (
+        index["laatste_datum"].dt.strftime("%Y-%m").fillna(GEEN_DATUM).astype(str)
+    )
+    return index.reset_index()
+
+
+def lees_partities(store, manifest, namen, soort, cache, patienten=None):
+    """
+    Doel: lees een aantal partities van de store als 1 dataframe
+    Input:
+        - namen: namen van de partities (maanden)
+        - soort: "mutaties" of "verrijkt"
+        - cache: dict met de partities die in deze run al gelezen of geschreven zijn
+        - patienten: optioneel, alleen de rijen van deze patienten inlezen
+    Output:
+        - dataframe, of None als geen van de partities bestaat
+    """
+    delen = []
+    for naam in sorted(namen):
+        if (naam, soort) in cache:
+            deel = cache[(naam, soort)]
+            if patienten is not None:
+                deel = deel[deel["patientnr"].isin(patienten)]
+        elif naam in manifest["partities"]:
+            pad = Path(store) / f"{manifest['partities'][naam]}_{soort}.parquet"
+            if patienten is None:
+                deel = lees_parquet(pad)
+                cache[(naam, soort)] = deel
+            else:
+                deel = lees_parquet(pad, filters=[("patientnr", "in", list(patienten))])
+        else:
+            continue
+        delen.append(deel)
+    if not delen:
+        return None
+    return pd.concat(delen, ignore_index=True)
+
+
+def patienten_in_range(df, datum_range):
+    """
+    Doel: alleen de patienten met een afspraak in de datum range, met hun hele afspraakgeschiedenis
+    """
+    in_range = df["DATUM"].between(
+        pd.to_datetime(datum_range[0], errors="coerce"),
+        pd.to_datetime(datum_range[1], errors="coerce"),
+    )
+    return df[df["patientnr"].isin(df.loc[in_range, "patientnr"].unique())]
+
+
+def vergelijk_met_volledig(df_preproc, df_volledig):
+    """
+    Doel: vergelijk de output van de incrementele preprocessing met die van een volledige preprocessing
+    Output:
+        - None als de twee gelijk zijn, anders een beschrijving van het verschil
+    Eerst moeten dezelfde (patientnr, afspraaknr) paren in beide outputs zitten, anders vallen
+    afspraken die de incrementele preprocessing ten onrechte weglaat of toevoegt niet op.
+    """
+    paren = ["patientnr", "afspraaknr"]
+    paren_preproc = pd.MultiIndex.from_frame(df_preproc[paren].drop_duplicates())
+    paren_volledig = pd.MultiIndex.from_frame(df_volledig[paren].drop_duplicates())
+    alleen_preproc = paren_preproc.difference(paren_volledig)
+    alleen_volledig = paren_volledig.difference(paren_preproc)
+    if len(alleen_preproc) or len(alleen_volledig):
+        return (
+            f"{len(alleen_preproc)} afspraken alleen in de incrementele preprocessing "
+            f"(bijv. {list(alleen_preproc[:5])}), {len(alleen_volledig)} alleen in de "
+            f"volledige preprocessing (bijv. {list(alleen_volledig[:5])})"
+        )
+
+    sleutel = ["afspraaknr", "actie_moment", "volgnummer"]
+    links = df_preproc.sort_values(sleutel).reset_index(drop=True)
+    rechts = df_volledig[links.columns].sort_values(sleutel).reset_index(drop=True)
+    try:
+        pd.testing.assert_frame_equal(
+            links, rechts, check_dtype=False, check_categorical=False
+        )
+    except AssertionError as verschil:
+        return str(verschil)
+    return None
+
+
+@gemeten()
+def preprocess_incrementeel(
+    df,
+    submodus,
+    datum_range=None,
+    afspr_gesch=None,
+    verifieer=False,
+    store=None,
+    vandaag=None,
+):
+    """
+    Doel: incrementele variant van preprocess_afspraken. De relevante mutaties en de verrijkte mutaties
+            (de stappen van de preprocessing die niet van de datum van vandaag afhangen) worden per
+            afspraaknr lokaal bewaard, samen met het laatst verwerkte mutatie_moment per afspraak en
+            een watermark op mutatie_moment. Alleen afspraken met mutaties die nog niet verwerkt zijn en
+            afspraken die nog niet in de store zitten worden opnieuw verwerkt en in de opgeslagen state
+            samengevoegd.
+    Input:
+        - df: mutaties uit create_dataset. Mutaties van afspraken in de store die al verwerkt zijn
+                worden genegeerd
+        - submodus: train/holdout/voorspel, elke submodus heeft een eigen store
+        - datum_range: datum range van de run. Als opgegeven worden alleen patienten met een afspraak
+                in deze range teruggegeven, net als in create_dataset
+        - afspr_gesch: aantal dagen afspraakgeschiedenis. Als opgegeven (met datum_range) worden afspraken
+                die daarbuiten vallen uit de store verwijderd
+        - verifieer: vergelijk het resultaat met een volledige preprocess_afspraken op df. Dit heeft alleen
+                zin als df de volledige geschiedenis bevat. Bij een verschil wordt het resultaat van de
+                volledige preprocessing teruggegeven
+        - store: map van de store, standaard Python/cache/preprocess_{submodus}
+        - vandaag: optioneel, zie preprocess_afspraken
+    Output:
+        - df_preproc: zie preprocess_afspraken
+    De store is gepartitioneerd op de maand van de laatste datum van een afspraak, met een index
+    (zie afspraak_index) en een manifest met de watermark. Alleen de partities waar gewijzigde
+    afspraken uit komen of in terecht komen worden herschreven, en alleen de rijen van de patienten
+    in de datum range worden ingelezen en verwerkt. De kosten van een run hangen dus af van de
+    mutaties van die dag en de geschiedenis van de patienten in de datum range, niet van de hele
+    store. Het manifest wordt als laatste geschreven, een afgebroken run laat de vorige store intact.
+    Hierbij wordt aangenomen dat volgnummers uniek zijn over afspraken heen.
+    """
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    logger.info("Begin incrementele preprocessing afspraken")
+    store = Path(store) if store else store_pad(submodus)
+    store.mkdir(parents=True, exist_ok=True)
+
+    manifest = lees_manifest(store)
+    if manifest is not None and manifest.get("id_dtypes") != id_dtypes(df):
+        # Bij andere datatypes matcht isin niet meer en past de store niet in een concat
+        logger.warning(
+            f"Datatypes van de identificatienummers in de store ({manifest.get('id_dtypes')}) wijken af van deze run ({id_dtypes(df)}), store wordt opnieuw opgebouwd"
+        )
+        manifest = None
+    if manifest is None:
+        logger.info(
+            f"Geen (actuele) store gevonden in {store.as_posix()}, volledige preprocessing"
+        )
+        manifest = {"partities": {}}
+        watermark = None
+        nieuw = df
+        index = None
+    else:
+        watermark = pd.Timestamp(manifest["mutatie_moment"])
+        index = lees_parquet(store / manifest["index"])
+        # Per afspraak de mutaties na het laatst verwerkte mutatie_moment. Een patient die een paar dagen
+        # buiten de datum range viel zit niet in df, diens mutaties van die dagen liggen dan voor de
+        # watermark maar zijn nog niet verwerkt. Afspraken die nog niet in de store zitten zijn helemaal
+        # nieuw. Mutaties op precies de watermark kunnen na de vorige run nog zijn binnengekomen, die
+        # nemen we opnieuw mee, dubbele mutaties worden in selecteer_mutaties weggehaald
+        verwerkt_tot = df["afspraaknr"].map(
+            index.set_index("afspraaknr")["verwerkt_tot"]
+        )
+        nieuw = df[
+            (df["mutatie_moment"] >= watermark)
+            | ~(df["mutatie_moment"] <= verwerkt_tot)
+        ]
+
+    # NaN werken fijner dan lege strings
+    nieuw = nieuw.replace("", np.nan)
+    gewijzigd = nieuw["afspraaknr"].unique()
+    logger.info(
+        f"{len(nieuw)} nieuwe mutaties voor {len(gewijzigd)} afspraken sinds {watermark}"
+    )
+
+    cache = {}
+    herschrijven = set()
+    if len(gewijzigd):
+        oude_partities = (
+            set(index.loc[index["afspraaknr"].isin(gewijzigd), "partitie"])
+            if index is not None
+            else set()
+        )
+        # Voor de gewijzigde afspraken zijn de eerder geselecteerde mutaties samen met de nieuwe mutaties
+        # genoeg: de eerste mutatie en de verplaatsingen blijven hetzelfde, de laatste komt uit de nieuwe
+        mutaties_oud = lees_partities(
+            store, manifest, oude_partities, "mutaties", cache
+        )
+        if mutaties_oud is not None:
+            mutaties_oud = mutaties_oud[mutaties_oud["afspraaknr"].isin(gewijzigd)]
+        mutaties_gewijzigd = selecteer_mutaties(
+            herstel_categories(pd.concat([mutaties_oud, nieuw], ignore_index=True), df)
+        )
+        verrijkt_gewijzigd = verrijk_mutaties(mutaties_gewijzigd.copy())
+        index_gewijzigd = afspraak_index(mutaties_gewijzigd, verrijkt_gewijzigd)
+        if index is not None:
+            index = pd.concat(
+                [index[~index["afspraaknr"].isin(gewijzigd)], index_gewijzigd],
+                ignore_index=True,
+            )
+        else:
+            index = index_gewijzigd
+        herschrijven = oude_partities | set(index_gewijzigd["partitie"])
+        watermark = (
+            max(watermark, nieuw["mutatie_moment"].max())
+            if watermark is not None
+            else nieuw["mutatie_moment"].max()
+        )
+    elif index is None:
+        index = afspraak_index(nieuw, nieuw)
+
+    # Afspraken die buiten de afspraakgeschiedenis vallen zijn niet meer nodig. Die gaan uit de index,
+    # de rijen blijven in de partitie staan tot die herschreven wordt of helemaal verlopen is
+    if datum_range is not None and afspr_gesch is not None:
+        ondergrens = pd.to_datetime(datum_range[0], errors="coerce")
+        if not pd.isna(ondergrens):
+            oud = index["laatste_datum"] < ondergrens - timedelta(afspr_gesch)
+            index = index[~oud]
+            logger.info(f"{int(oud.sum())} verlopen afspraken uit de store verwijderd")
+
+    run = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    partities = {
+        naam: bestand
+        for naam, bestand in manifest["partities"].items()
+        if naam in set(index["partitie"])
+    }
+    for naam in sorted(herschrijven):
+        afspraken = index.loc[index["partitie"] == naam, "afspraaknr"]
+        if len(afspraken) == 0:
+            partities.pop(naam, None)
+            continue
+        for soort, deel_gewijzigd in (
+            ("mutaties", mutaties_gewijzigd),
+            ("verrijkt", verrijkt_gewijzigd),
+        ):
+            deel = lees_partities(store, manifest, [naam], soort, cache)
+            if deel is not None:
+                deel = deel[~deel["afspraaknr"].isin(gewijzigd)]
+            deel = herstel_categories(
+                pd.concat([deel, deel_gewijzigd], ignore_index=True), df
+            )
+            # Gesorteerd op patientnr, zodat het filter op patientnr hele row groups overslaat
+            deel = deel[deel["afspraaknr"].isin(afspraken)].sort_values(
+                ["patientnr", "afspraaknr", "volgnummer"]
+            )
+            schrijf_parquet(
+                deel,
+                store / f"{naam}_{run}_{soort}.parquet",
+                row_group_size=RIJEN_PER_GROEP,
+            )
+            cache[(naam, soort)] = deel
+        partities[naam] = f"{naam}_{run}"
+    logger.info(f"{len(herschrijven)} van de {len(partities)} partities herschreven")
+
+    # Het manifest als laatste, zodat een afgebroken run de mutaties opnieuw verwerkt
+    if watermark is None or pd.isna(watermark):
+        watermark = df["mutatie_moment"].max()
+    schrijf_parquet(index, store / f"index_{run}.parquet")
+    manifest = {
+        "versie": STORE_VERSIE,
+        "id_dtypes": id_dtypes(df),
+        "mutatie_moment": pd.Timestamp(watermark).isoformat(),
+        "bijgewerkt": datetime.now().isoformat(),
+        "index": f"index_{run}.parquet",
+        "partities": partities,
+    }
+    tijdelijk = store / "manifest.json.tmp"
+    with open(tijdelijk, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tijdelijk, store / "manifest.json")
+    # Bestanden die niet meer in het manifest staan (ook van een oudere versie van de store) kunnen weg
+    in_gebruik = {manifest["index"]} | {
+        f"{bestand}_{soort}.parquet"
+        for bestand in partities.values()
+        for soort in ("mutaties", "verrijkt")
+    }
+    for pad in store.iterdir():
+        if pad.name != "manifest.json" and pad.name not in in_gebruik:
+            pad.unlink(missing_ok=True)
+    logger.info(f"Store bijgewerkt tot mutatie_moment {watermark}")
+
+    # Alleen patienten met een afspraak in de datum range (en hun afspraakgeschiedenis). Eerst de
+    # patienten met een afspraak die in de datum range kan vallen, de precieze selectie volgt na het inlezen
+    if datum_range is not None:
+        in_range = (
+            index["min_datum"] <= pd.to_datetime(datum_range[1], errors="coerce")
+        ) & (index["max_datum"] >= pd.to_datetime(datum_range[0], errors="coerce"))
+        index = index[index["patientnr"].isin(index.loc[in_range, "patientnr"])]
+    verrijkt = lees_partities(
+        store,
+        manifest,
+        set(index["partitie"]),
+        "verrijkt",
+        cache,
+        patienten=index["patientnr"].unique() if datum_range is not None else None,
+    )
+    if verrijkt is None:
+        verrijkt = verrijk_mutaties(selecteer_mutaties(nieuw.iloc[:0]))
+    verrijkt = herstel_categories(
+        verrijkt[verrijkt["afspraaknr"].isin(index["afspraaknr"])], df
+    )
+    if datum_range is not None:
+        verrijkt = patienten_in_range(verrijkt, datum_range)
+    logger.info(
+        f"{verrijkt['patientnr'].nunique()} patienten met {len(verrijkt)} verrijkte mutaties verwerken"
+    )
+
+    # verwerk_mutaties verwacht de mutaties gesorteerd op afspraaknr/volgnummer
+    df_preproc = verwerk_mutaties(
+        verrijkt.sort_values(["afspraaknr", "volgnummer"]), vandaag=vandaag
+    )
+
+    if verifieer:
+        logger.info(
+            "Incrementele preprocessing vergelijken met volledige preprocessing"
+        )
+        # Dezelfde selectie van afspraken en patienten als voor de store, maar dan op de mutaties
+        # van deze run. Zo vallen afspraken die de incrementele preprocessing mist of te veel
+        # heeft op als verschil
+        df_volledig = df.replace("", np.nan)
+        if datum_range is not None and afspr_gesch is not None:
+            df_volledig, _ = verwijder_oude_afspraken(
+                df_volledig, df_volledig, datum_range, afspr_gesch
+            )
+        if datum_range is not None:
+            # Net als bij de store op basis van de verrijkte mutaties
+            patienten = patienten_in_range(
+                verrijk_mutaties(selecteer_mutaties(df_volledig)), datum_range
+            )["patientnr"].unique()
+            df_volledig = df_volledig[df_volledig["patientnr"].isin(patienten)]
+        df_volledig = preprocess_afspraken(df_volledig, vandaag=vandaag)
+        verschil = vergelijk_met_volledig(df_preproc, df_volledig)
+        if verschil is None:
+            logger.info("Incrementele preprocessing gelijk aan volledige preprocessing")
+        else:
+            logger.warning(
+                f"Incrementele preprocessing wijkt af van volledige preprocessing, volledige wordt gebruikt: {verschil}"
+            )
+            df_preproc = df_volledig
+
+    logger.info("Eind incrementele preprocessing afspraken")
+
+    return df_preproc
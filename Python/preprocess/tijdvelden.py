@@ -0,0 +1,74 @@
+import logsetup
+import logging
+
+import numpy as np
+import pandas as pd
+
+# Kolommen die alleen binnen de pipeline gebruikt worden en aan het eind van de feature building weer weg kunnen
+HULPKOLOMMEN = ["tijd_minuut", "aankomst_minuut"]
+
+
+def minuut_van_dag(tijden):
+    """
+    Doel: zet tijden als "HH:MM" of "HH:MM:SS" string om in het aantal minuten sinds middernacht.
+            Er zijn maar een paar honderd verschillende tijden, dus alleen de unieke waardes worden
+            geparsed
+    Input:
+        - tijden: Series met tijden als string
+    Output:
+        - array (float) met minuten, NaN als de tijd leeg of ongeldig is. Het aantal ingevulde
+            tijden dat niet geparsed kon worden wordt gelogd
+    """
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    codes, uniek = pd.factorize(tijden)
+    tekst = pd.Series(uniek, dtype=object).astype(str).str.strip()
+    # Alleen bij "HH:MM" ontbreken de seconden
+    tekst = tekst.where(tekst.str.count(":") != 1, tekst + ":00")
+    minuten = (pd.to_timedelta(tekst, errors="coerce") / pd.Timedelta(1, "m")).to_numpy(
+        dtype=float
+    )
+
+    ongeldig = np.isnan(minuten) & (tekst != "").to_numpy()
+    if ongeldig.any():
+        aantal = np.bincount(codes[codes >= 0], minlength=len(uniek))[ongeldig].sum()
+        logger.warning(
+            f"{aantal} tijden in {tijden.name} konden niet geparsed worden, bijv. {tekst[ongeldig].head(5).tolist()}"
+        )
+    # Lege waardes hebben code -1, die wijzen zo naar de NaN achteraan
+    return np.append(minuten, np.nan)[codes]
+
+
+def normaliseer_tijden(df):
+    """
+    Doel: parse alle datum en tijd velden van de mutaties in 1 keer, zodat de rest van de pipeline
+            geen strings meer hoeft te parsen
+    Input:
+        - df: mutaties
+    Output:
+        - df: met datum_am en datum_tijd_am als datetime, lege DATUM/TIJD aangevuld vanuit
+                datum_am/tijd_am, DATUMTIJD, en de minuut van de dag van TIJD en aankomst in
+                tijd_minuut en aankomst_minuut
+    """
+    # Zet de datum velden om in datetime variabelen
+    df["datum_tijd_am"] = pd.to_datetime(df["datum_tijd_am"], errors="coerce")
+    df["datum_am"] = pd.to_datetime(df["datum_am"], errors="coerce")
+    # Als de DATUM kolom leeg is (bij annuleringen), vul dan datum_am in
+    df["DATUM"] = df["DATUM"].fillna(df["datum_am"])
+    df["TIJD"] = df["TIJD"].fillna(df["tijd_am"])
+
+    df["tijd_minuut"] = minuut_van_dag(df["TIJD"])
+    df["aankomst_minuut"] = minuut_van_dag(df["aankomst"])
+
+    # Combineer tot een datum_tijd kolom
+    df["DATUMTIJD"] = datum_plus_minuten(df["DATUM"], df["tijd_minuut"])
+
+    return df
+
+
+def datum_plus_minuten(datum, minuten):
+    """
+    Doel: combineer een datum kolom en een kolom met minuten van de dag tot een datetime
+    """
+    return pd.to_datetime(datum, errors="coerce") + pd.to_timedelta(minuten, unit="m")
@@ -0,0 +1,101 @@
+import logsetup
+import logging
+
+import gc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import timedelta
+
+import pandas as pd
+
+from utilities.instrumentatie import meet_stap
+
+
+def datum_vensters(datum_range, chunk_dagen):
+    """
+    Doel: verdeel een datum range in aaneengesloten vensters van chunk_dagen dagen. De grenzen zijn
+            net als in filter_afspraken inclusief, de vensters overlappen dus niet
+    Input:
+        - datum_range: [ondergrens, bovengrens] als "YYYY-MM-DD" strings
+        - chunk_dagen: aantal dagen per venster
+    Output:
+        - lijst met vensters, elk als [ondergrens, bovengrens] strings
+    """
+    if chunk_dagen < 1:
+        raise ValueError("chunk_dagen moet minimaal 1 zijn")
+    ondergrens = pd.to_datetime(datum_range[0], format="%Y-%m-%d")
+    bovengrens = pd.to_datetime(datum_range[1], format="%Y-%m-%d")
+    vensters = []
+    start = ondergrens
+    while start <= bovengrens:
+        eind = min(start + timedelta(chunk_dagen - 1), bovengrens)
+        vensters.append([f"{start:%Y-%m-%d}", f"{eind:%Y-%m-%d}"])
+        start = eind + timedelta(1)
+    return vensters
+
+
+def verwerk_in_chunks(vensters, laad, verwerk, schrijf, vooruit_laden=True):
+    """
+    Doel: bouw een dataset venster voor venster op, zodat het geheugengebruik afhangt van de grootte
+            van een venster en niet van de lengte van de hele datum range. Het inladen van het
+            volgende venster gebeurt in een thread tijdens het verwerken van het huidige venster,
+            zodat wachten op de database en rekenen elkaar overlappen
+    Input:
+        - vensters: lijst met datum ranges (zie datum_vensters)
+        - laad: functie die een venster inlaadt, laad(venster) -> df. Draait in een aparte thread,
+                gebruik hier dus geen meet_stap
+        - verwerk: functie die een ingeladen venster verwerkt, verwerk(df, venster) -> df
+        - schrijf: functie die het resultaat van een venster wegschrijft, schrijf(df, eerste) -> None.
+                eerste is True voor het eerste resultaat dat weggeschreven wordt
+        - vooruit_laden: laad het volgende venster in een thread tijdens het verwerken. Zet dit uit als
+                verwerk processen met fork start (verwerk_per_patient met meer workers): een fork
+                terwijl de laad thread een lock vasthoudt kan het nieuwe proces laten vastlopen. De
+                vensters worden dan na elkaar in de hoofdthread ingeladen
+    Output:
+        - totaal aantal weggeschreven rijen. Bij 0 is schrijf nooit aangeroepen, een resultaat van een
+            vorige run (bijv. de tabel die het eerste venster had moeten vervangen) staat er dan nog.
+            Dat wordt als fout gelogd
+    Er zijn maximaal twee vensters tegelijk in het geheugen: het venster dat verwerkt wordt en het
+    venster dat ingeladen wordt.
+    """
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    totaal = 0
+    eerste = True
+    with ThreadPoolExecutor(max_workers=1) if vooruit_laden else nullcontext() as pool:
+        volgende = pool.submit(laad, vensters[0]) if pool and vensters else None
+        for i, venster in enumerate(vensters):
+            if pool is None:
+                df = laad(venster)
+            else:
+                # result() geeft een exceptie uit het inladen door aan de hoofdthread
+                df = volgende.result()
+                volgende = (
+                    pool.submit(laad, vensters[i + 1])
+                    if i + 1 < len(vensters)
+                    else None
+                )
+            logger.info(
+                f"Chunk {i + 1}/{len(vensters)} ({venster[0]} t/m {venster[1]}): {len(df)} rijen ingeladen"
+            )
+            if df.empty:
+                continue
+
+            with meet_stap("chunk", df) as stap:
+                df = verwerk(df, venster)
+                stap["rijen_uit"] = len(df)
+            if not df.empty:
+                schrijf(df, eerste)
+                eerste = False
+                totaal += len(df)
+            del df
+            # Geef het geheugen van dit venster vrij voordat het volgende venster verwerkt wordt
+            gc.collect()
+
+    logger.info(f"{len(vensters)} chunks verwerkt, {totaal} rijen weggeschreven")
+    if eerste:
+        logger.error(
+            f"Alle {len(vensters)} chunks zijn leeg, er is niets weggeschreven. Het resultaat van een vorige run is niet vervangen"
+        )
+    return totaal
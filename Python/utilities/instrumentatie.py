@@ -0,0 +1,263 @@
+import logsetup
+import logging
+
+import cProfile
+import functools
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from utilities.unify_cwd import unify_cwd
+
+try:
+    import resource
+except ImportError:
+    # Niet beschikbaar op Windows, het piekgeheugen wordt dan niet bijgehouden
+    resource = None
+
+# Met NOSHOW_PROFIEL=alle wordt elke stap met cProfile geprofiled, of alleen de stappen in een
+# kommagescheiden lijst (bijv. NOSHOW_PROFIEL=feature_afspraken,filter_afspraken)
+PROFIEL_VARIABELE = "NOSHOW_PROFIEL"
+
+# De metingen van deze run
+RUN = {"start": datetime.now().isoformat(), "stappen": []}
+# De namen van de stappen die nu lopen, voor geneste stappen
+ACTIEVE_STAPPEN = []
+# De metingen van de stappen die nu lopen, voor het piekgeheugen van geneste stappen
+ACTIEVE_METINGEN = []
+# Er kan maar 1 profiler tegelijk actief zijn
+PROFIEL_ACTIEF = []
+
+
+def rapport_map():
+    """
+    Doel: de map waar de rapporten (en eventuele profielen) van de runs opgeslagen worden
+    """
+    cwd = Path.cwd()
+    cwd = unify_cwd(cwd)
+    return cwd / "Python" / "cache" / "instrumentatie"
+
+
+def piek_geheugen_mb(wie="proces"):
+    """
+    Doel: het piekgeheugen (RSS) tot nu toe in MB, None als dat niet bekend is
+    Input:
+        - wie: "proces" voor dit proces, "kinderen" voor het grootste afgeronde child proces (bijv.
+                de workers van verwerk_per_patient)
+    """
+    if resource is None:
+        return None
+    bron = resource.RUSAGE_SELF if wie == "proces" else resource.RUSAGE_CHILDREN
+    # ru_maxrss is in kB, maar in bytes op macOS
+    eenheid = 2**20 if sys.platform == "darwin" else 1024
+    return round(resource.getrusage(bron).ru_maxrss / eenheid, 1)
+
+
+def cpu_kinderen_s():
+    """
+    Doel: de CPU tijd van alle afgeronde child processen tot nu toe, None als dat niet bekend is
+    """
+    if resource is None:
+        return None
+    gebruik = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return gebruik.ru_utime + gebruik.ru_stime
+
+
+def proc_status_mb(veld):
+    """
+    Doel: een geheugenveld (VmRSS of VmHWM) uit /proc/self/status in MB, None als dat niet kan
+            (bijv. buiten Linux)
+    """
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as f:
+            for regel in f:
+                if regel.startswith(veld + ":"):
+                    return round(int(regel.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+    return None
+
+
+def reset_piek_geheugen():
+    """
+    Doel: zet het piekgeheugen (VmHWM) van het proces terug naar het huidige geheugen, zodat het
+            piekgeheugen van een stap gemeten kan worden
+    Output:
+        - True als dat gelukt is, False als de kernel dat niet toestaat of het geen Linux is
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def profiel_aan(naam):
+    """
+    Doel: bepaal aan de hand van NOSHOW_PROFIEL of een stap geprofiled moet worden
+    """
+    instelling = os.environ.get(PROFIEL_VARIABELE, "").strip()
+    if not instelling or PROFIEL_ACTIEF:
+        return False
+    stappen = [stap.strip() for stap in instelling.split(",")]
+    return "alle" in stappen or naam in stappen or naam.split("/")[-1] in stappen
+
+
+def aantal_rijen(waarde):
+    """
+    Doel: aantal rijen van een dataframe, None voor iets anders
+    """
+    if isinstance(waarde, (pd.DataFrame, pd.Series)):
+        return len(waarde)
+    return None
+
+
+@contextmanager
+def meet_stap(naam, df=None):
+    """
+    Doel: meet de wandtijd, CPU tijd, het aantal rijen in en uit en het geheugen van een stap
+            in de pipeline. Geneste stappen krijgen de naam van de omliggende stap ervoor
+            (bijv. feature_afspraken/historie_features)
+    Input:
+        - naam: naam van de stap
+        - df: optioneel, de input van de stap voor het aantal rijen in
+    Output:
+        - dict met de meting, zet daar "rijen_uit" in voor het aantal rijen na de stap
+    Het geheugen is de RSS aan het begin en eind van de stap en de piek tijdens de stap. Voor die
+    piek wordt VmHWM aan het begin van de stap teruggezet (alleen op Linux, anders is de piek None).
+    De CPU tijd en het piekgeheugen van child processen (bijv. de workers van verwerk_per_patient)
+    komen apart in de meting. Het piekgeheugen van de kinderen is dat van het grootste afgeronde
+    child proces, en alleen ingevuld als dat tijdens de stap hoger werd.
+    """
+    volledige_naam = "/".join(ACTIEVE_STAPPEN + [naam])
+    meting = {
+        "naam": volledige_naam,
+        "start": datetime.now().isoformat(),
+        "rijen_in": aantal_rijen(df),
+        "rijen_uit": None,
+    }
+    profiler = None
+    if profiel_aan(volledige_naam):
+        profiler = cProfile.Profile()
+        PROFIEL_ACTIEF.append(volledige_naam)
+        profiler.enable()
+
+    # De piek tot nu toe hoort bij de omliggende stap, die wordt bewaard voor de piek teruggezet wordt
+    if ACTIEVE_METINGEN and ACTIEVE_METINGEN[-1]["_piek"] is not None:
+        ACTIEVE_METINGEN[-1]["_piek"] = max(
+            ACTIEVE_METINGEN[-1]["_piek"], proc_status_mb("VmHWM") or 0
+        )
+    meting["rss_start_mb"] = proc_status_mb("VmRSS")
+    meting["_piek"] = meting["rss_start_mb"] if reset_piek_geheugen() else None
+    start_kinderen_cpu = cpu_kinderen_s()
+    start_kinderen_piek = piek_geheugen_mb("kinderen")
+
+    ACTIEVE_STAPPEN.append(naam)
+    ACTIEVE_METINGEN.append(meting)
+    start_wand = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield meting
+    finally:
+        meting["wandtijd_s"] = round(time.perf_counter() - start_wand, 3)
+        meting["cpu_s"] = round(time.process_time() - start_cpu, 3)
+        meting["rss_eind_mb"] = proc_status_mb("VmRSS")
+        piek = meting.pop("_piek")
+        meting["piek_rss_mb"] = (
+            max(piek, proc_status_mb("VmHWM") or 0) if piek is not None else None
+        )
+        if start_kinderen_cpu is not None:
+            meting["cpu_kinderen_s"] = round(cpu_kinderen_s() - start_kinderen_cpu, 3)
+            piek_kinderen = piek_geheugen_mb("kinderen")
+            meting["piek_rss_kinderen_mb"] = (
+                piek_kinderen if piek_kinderen > start_kinderen_piek else None
+            )
+        ACTIEVE_STAPPEN.pop()
+        ACTIEVE_METINGEN.pop()
+        # De piek van deze stap telt ook voor de omliggende stap
+        if (
+            ACTIEVE_METINGEN
+            and ACTIEVE_METINGEN[-1]["_piek"] is not None
+            and meting["piek_rss_mb"] is not None
+        ):
+            ACTIEVE_METINGEN[-1]["_piek"] = max(
+                ACTIEVE_METINGEN[-1]["_piek"], meting["piek_rss_mb"]
+            )
+        if profiler is not None:
+            profiler.disable()
+            PROFIEL_ACTIEF.pop()
+            map_rapport = rapport_map()
+            map_rapport.mkdir(parents=True, exist_ok=True)
+            pad = map_rapport / (
+                f"{datetime.now():%Y%m%d_%H%M%S}_{volledige_naam.replace('/', '.')}.prof"
+            )
+            profiler.dump_stats(pad)
+            meting["profiel"] = str(pad)
+        if meting["rijen_in"] is not None and meting["rijen_uit"] is not None:
+            meting["rijen_verschil"] = meting["rijen_uit"] - meting["rijen_in"]
+        RUN["stappen"].append(meting)
+
+        logger = logging.getLogger()
+        logger.info(
+            f"Stap {volledige_naam}: {meting['wandtijd_s']} s (cpu {meting['cpu_s']} s), "
+            f"rijen {meting['rijen_in']} -> {meting['rijen_uit']}, "
+            f"geheugen {meting['rss_start_mb']} -> {meting['rss_eind_mb']} MB (piek {meting['piek_rss_mb']} MB)"
+        )
+
+
+def gemeten(naam=None):
+    """
+    Doel: decorator die een functie als stap meet (zie meet_stap). Het aantal rijen in is dat van het
+            eerste argument of het argument df, het aantal rijen uit dat van het resultaat
+    """
+
+    def decorator(functie):
+        stap_naam = naam or functie.__name__
+
+        @functools.wraps(functie)
+        def wrapper(*args, **kwargs):
+            invoer = kwargs.get("df", args[0] if args else None)
+            with meet_stap(stap_naam, df=invoer) as meting:
+                resultaat = functie(*args, **kwargs)
+                meting["rijen_uit"] = aantal_rijen(resultaat)
+            return resultaat
+
+        return wrapper
+
+    return decorator
+
+
+def schrijf_rapport(**extra):
+    """
+    Doel: schrijf de metingen van deze run als json rapport weg
+    Input:
+        - extra: optioneel, extra informatie voor in het rapport (bijv. de modus)
+    Output:
+        - pad van het rapport, None als er niks gemeten is
+    """
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    if not RUN["stappen"]:
+        return None
+    rapport = {
+        **RUN,
+        **extra,
+        "eind": datetime.now().isoformat(),
+        "piek_rss_mb": piek_geheugen_mb(),
+        "piek_rss_kinderen_mb": piek_geheugen_mb("kinderen"),
+    }
+    map_rapport = rapport_map()
+    map_rapport.mkdir(parents=True, exist_ok=True)
+    pad = map_rapport / f"run_{datetime.now():%Y%m%d_%H%M%S}_{os.getpid()}.json"
+    with open(pad, "w", encoding="utf-8") as f:
+        json.dump(rapport, f, indent=4, default=str)
+    logger.info(f"Instrumentatie rapport weggeschreven naar {pad}")
+    return pad
@@ -0,0 +1,240 @@
+import logsetup
+import logging
+
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pandas as pd
+
+from utilities.unify_cwd import unify_cwd
+
+# Aantal hits en misses van de referentie cache in deze run
+STATISTIEKEN = {"hit": 0, "miss": 0}
+
+# Entries die alleen in het geheugen bewaard worden, zie haal_uit_geheugen
+GEHEUGEN = {}
+
+
+def cache_map():
+    """
+    Doel: de map waar de referentie data opgeslagen wordt
+    """
+    cwd = Path.cwd()
+    cwd = unify_cwd(cwd)
+    return cwd / "Python" / "cache" / "referentie"
+
+
+def bestand_hash(pad):
+    """
+    Doel: sha1 van de inhoud van een bestand
+    """
+    sha1 = hashlib.sha1()
+    with open(pad, "rb") as f:
+        for blok in iter(lambda: f.read(2**20), b""):
+            sha1.update(blok)
+    return sha1.hexdigest()
+
+
+def bron_versie(*delen):
+    """
+    Doel: maak van een aantal waardes (bijv. een query, een bestandsnaam met wijzigingsdatum of een
+            lijst met jaren) een korte versie, een andere bron geeft dan een miss
+    """
+    inhoud = json.dumps(delen, default=str, sort_keys=True)
+    return hashlib.sha1(inhoud.encode("utf-8")).hexdigest()[:16]
+
+
+def bestand_versie(pad):
+    """
+    Doel: versie van een bronbestand op basis van de wijzigingsdatum en grootte, zonder het te lezen
+    """
+    status = Path(pad).stat()
+    return bron_versie(Path(pad).name, status.st_mtime_ns, status.st_size)
+
+
+@contextmanager
+def cache_slot(naam, wachttijd=300, verouderd=900):
+    """
+    Doel: lock op een cache entry met een lockfile, zodat gelijktijdige runs niet tegelijk dezelfde
+            entry vullen. Een lockfile ouder dan verouderd seconden is van een afgebroken run en wordt weggehaald
+    """
+    pad = cache_map() / f"{naam}.lock"
+    start = time.time()
+    while True:
+        try:
+            fd = os.open(pad, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd, str(os.getpid()).encode("utf-8"))
+            os.close(fd)
+            break
+        except FileExistsError:
+            try:
+                leeftijd = time.time() - pad.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if leeftijd > verouderd:
+                pad.unlink(missing_ok=True)
+                continue
+            if time.time() - start > wachttijd:
+                raise TimeoutError(f"Geen lock op referentie cache {naam} gekregen")
+            time.sleep(0.2)
+    try:
+        yield
+    finally:
+        pad.unlink(missing_ok=True)
+
+
+def referentie_metadata(naam):
+    """
+    Doel: lees de metadata van een cache entry
+    Output:
+        - dict met o.a. aangemaakt, ttl_uren, bron, inhoud_hash en dtypes, of None als die er niet is
+    """
+    pad = cache_map() / f"{naam}.json"
+    if not pad.is_file():
+        return None
+    with open(pad, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def controleer_entry(naam, bron, ttl_uren):
+    """
+    Doel: bepaal of een cache entry gebruikt kan worden
+    Output:
+        - None als de entry geldig is, anders de reden waarom niet
+    """
+    metadata = referentie_metadata(naam)
+    pad = cache_map() / f"{naam}.parquet"
+    if metadata is None or not pad.is_file():
+        return "niet aanwezig"
+    if metadata.get("bron") != bron:
+        return "bron gewijzigd"
+    if ttl_uren is not None:
+        verloopt = datetime.fromisoformat(metadata["aangemaakt"]) + timedelta(
+            hours=ttl_uren
+        )
+        if datetime.now() > verloopt:
+            return "verlopen"
+    if bestand_hash(pad) != metadata.get("inhoud_hash"):
+        return "inhoud klopt niet met hash"
+    return None
+
+
+def haal_uit_geheugen(naam, laad, bron, ttl_uren):
+    """
+    Doel: zoals haal_referentie, maar de data wordt alleen in het geheugen van deze run bewaard en
+            nooit naar schijf geschreven. Een bestand van een eerdere run met dezelfde naam wordt weggehaald
+    """
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    for pad in (
+        cache_map() / f"{naam}.parquet",
+        cache_map() / f"{naam}.json",
+    ):
+        pad.unlink(missing_ok=True)
+
+    entry = GEHEUGEN.get(naam)
+    if (
+        entry is not None
+        and entry["bron"] == bron
+        and (
+            ttl_uren is None
+            or datetime.now() <= entry["aangemaakt"] + timedelta(hours=ttl_uren)
+        )
+    ):
+        STATISTIEKEN["hit"] += 1
+        logger.info(
+            f"Referentie cache hit voor {naam} (geheugen) "
+            f"(hits: {STATISTIEKEN['hit']}, misses: {STATISTIEKEN['miss']})"
+        )
+        return entry["df"].copy()
+
+    STATISTIEKEN["miss"] += 1
+    start = time.time()
+    df = laad()
+    GEHEUGEN[naam] = {"aangemaakt": datetime.now(), "bron": bron, "df": df.copy()}
+    logger.info(
+        f"Referentie cache miss voor {naam} (geheugen), geladen in {time.time() - start:.1f} s "
+        f"(hits: {STATISTIEKEN['hit']}, misses: {STATISTIEKEN['miss']})"
+    )
+    return df
+
+
+def haal_referentie(naam, laad, bron=None, ttl_uren=None, op_schijf=True):
+    """
+    Doel: haal referentie data uit de lokale cache, of laad die opnieuw en sla die op. Entries worden
+            als parquet opgeslagen (met datatypes) met een json met metadata ernaast
+    Input:
+        - naam: naam van de entry
+        - laad: functie zonder argumenten die de data als dataframe teruggeeft
+        - bron: optioneel, versie van de bron (zie bron_versie/bestand_versie). Bij een andere bron
+                wordt de data opnieuw geladen
+        - ttl_uren: optioneel, na hoeveel uur de data opnieuw geladen moet worden
+        - op_schijf: False voor data die niet onversleuteld op schijf mag staan (bijv. lijsten met
+                patientnummers), die wordt alleen in het geheugen bewaard (zie haal_uit_geheugen)
+    Output:
+        - dataframe met de referentie data
+    Als opslaan mislukt (bijv. een object kolom met gemengde types) wordt alleen een waarschuwing
+    gelogd, de geladen data wordt dan gewoon teruggegeven.
+    """
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    if not op_schijf:
+        return haal_uit_geheugen(naam, laad, bron, ttl_uren)
+
+    map_cache = cache_map()
+    map_cache.mkdir(parents=True, exist_ok=True)
+    pad = map_cache / f"{naam}.parquet"
+
+    reden = controleer_entry(naam, bron, ttl_uren)
+    if reden is not None:
+        with cache_slot(naam):
+            # Een andere run kan de entry net gevuld hebben terwijl we op de lock wachtten
+            reden = controleer_entry(naam, bron, ttl_uren)
+            if reden is not None:
+                STATISTIEKEN["miss"] += 1
+                start = time.time()
+                df = laad()
+                tijdelijk = pad.with_name(pad.name + ".tmp")
+                try:
+                    df.to_parquet(tijdelijk, index=False)
+                except Exception as fout:
+                    tijdelijk.unlink(missing_ok=True)
+                    logger.warning(
+                        f"Referentie {naam} kon niet in de cache opgeslagen worden, "
+                        f"de data wordt zonder cache gebruikt: {fout!r}"
+                    )
+                    return df
+                os.replace(tijdelijk, pad)
+                metadata = {
+                    "naam": naam,
+                    "aangemaakt": datetime.now().isoformat(),
+                    "ttl_uren": ttl_uren,
+                    "bron": bron,
+                    "inhoud_hash": bestand_hash(pad),
+                    "rijen": len(df),
+                    "dtypes": df.dtypes.astype(str).to_dict(),
+                }
+                tijdelijk = pad.with_suffix(".json.tmp")
+                with open(tijdelijk, "w", encoding="utf-8") as f:
+                    json.dump(metadata, f, indent=4)
+                os.replace(tijdelijk, pad.with_suffix(".json"))
+                logger.info(
+                    f"Referentie cache miss voor {naam} ({reden}), geladen in {time.time() - start:.1f} s "
+                    f"(hits: {STATISTIEKEN['hit']}, misses: {STATISTIEKEN['miss']})"
+                )
+                return df
+
+    STATISTIEKEN["hit"] += 1
+    df = pd.read_parquet(pad)
+    logger.info(
+        f"Referentie cache hit voor {naam} "
+        f"(hits: {STATISTIEKEN['hit']}, misses: {STATISTIEKEN['miss']})"
+    )
+    return df
@@ -0,0 +1,169 @@
+import logsetup
+import logging
+
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utilities.instrumentatie import gemeten
+
+# Het aandeel patienten met de meeste rijen dat niet via de hash maar expliciet over de shards verdeeld wordt
+ZWARE_FRACTIE = 0.01
+
+
+def verdeel_patienten(patientnr, n_shards):
+    """
+    Doel: wijs elke patient toe aan een shard. Patienten worden op basis van een hash van het patientnr
+            verdeeld, behalve de patienten met de meeste rijen. Die worden een voor een (grootste eerst)
+            toegevoegd aan de shard met op dat moment de minste rijen, zodat een paar patienten met
+            een enorme afspraakgeschiedenis niet samen in een shard terecht komen.
+    Input:
+        - patientnr: Series met het patientnr per rij
+        - n_shards: aantal shards
+    Output:
+        - array met per rij het nummer van de shard
+    """
+    aantallen = patientnr.value_counts()
+    hashes = pd.util.hash_pandas_object(aantallen.index.to_series(), index=False)
+    shard_patient = (hashes.to_numpy() % np.uint64(n_shards)).astype(np.int64)
+
+    # value_counts sorteert al aflopend, de zware patienten staan dus vooraan
+    n_zwaar = int(np.ceil(len(aantallen) * ZWARE_FRACTIE))
+    belasting = np.bincount(
+        shard_patient[n_zwaar:],
+        weights=aantallen.to_numpy()[n_zwaar:],
+        minlength=n_shards,
+    )
+    for i, aantal in enumerate(aantallen.to_numpy()[:n_zwaar]):
+        shard = int(np.argmin(belasting))
+        shard_patient[i] = shard
+        belasting[shard] += aantal
+
+    shard_patient = pd.Series(shard_patient, index=aantallen.index)
+    return shard_patient.reindex(patientnr).to_numpy()
+
+
+def lees_feather(pad):
+    """
+    Doel: lees een shard in via een memory map (to_pandas kopieert de data wel naar het geheugen van
+            dit proces). Lege waardes in string kolommen komen als None terug uit Arrow, die worden
+            weer NaN zoals in de rest van de pipeline
+    """
+    import pyarrow.feather as feather
+
+    df = feather.read_table(pad, memory_map=True).to_pandas()
+    for kolom in df.columns[df.dtypes == object]:
+        df[kolom] = df[kolom].mask(df[kolom].isna(), np.nan)
+    return df
+
+
+def verwerk_shard(pad_in, pad_uit, stappen):
+    """
+    Doel: voer de stappen uit op een shard. Draait in een los proces, de shard wordt via een
+            Feather bestand ingelezen en weggeschreven in plaats van gepickled
+    """
+    import pyarrow.feather as feather
+
+    df = lees_feather(pad_in)
+    # to_pandas heeft de shard al gekopieerd, het bestand in /dev/shm (ook geheugen) kan dus weg
+    os.remove(pad_in)
+    for functie, kwargs in stappen:
+        df = functie(df, **kwargs)
+    feather.write_feather(
+        df.reset_index(drop=True), pad_uit, compression="uncompressed"
+    )
+    return len(df)
+
+
+@gemeten()
+def verwerk_per_patient(df, stappen, n_workers=None):
+    """
+    Doel: voer een reeks stappen (zoals preprocess_afspraken en feature_afspraken) parallel uit,
+            met de data verdeeld over shards op patientnr. Dit kan alleen voor stappen die per patient
+            onafhankelijk zijn.
+    Input:
+        - df: dataframe met een kolom patientnr
+        - stappen: lijst met (functie, kwargs). Elke functie krijgt de output van de vorige stap als
+                eerste argument en moet op het hoogste niveau van een module staan
+        - n_workers: aantal processen, standaard het aantal cores
+    Output:
+        - de output van de laatste stap voor alle shards samen. De volgorde van de rijen is per shard
+            gelijk aan die van de stappen, maar de shards staan achter elkaar
+    De shards gaan via Feather bestanden in /dev/shm (als dat bestaat) naar de processen. Dit werkt
+    alleen met fork, op platformen zonder fork (Windows) worden de stappen gewoon achter elkaar
+    uitgevoerd. Dat gebeurt ook als er naast de hoofdthread nog andere threads draaien (bijv. het
+    vooruit laden van verwerk_in_chunks): een fork terwijl een andere thread een lock vasthoudt kan
+    de processen laten vastlopen. spawn of forkserver kan hier niet, die voeren main.py opnieuw uit.
+    Het scheelt geen geheugen ten opzichte van achter elkaar uitvoeren, het kost juist meer: df blijft
+    bij de aanroeper bestaan, de shards staan daarnaast als kopie in /dev/shm (dat is ook geheugen)
+    en elk proces maakt met to_pandas nog een kopie van zijn shard. Het invoerbestand van een shard
+    wordt verwijderd zodra het proces het ingelezen heeft, het hoogste geheugengebruik is dus ongeveer
+    df + 1 kopie van df + de tussenresultaten van de stappen in de processen + de output.
+    """
+    logsetup.setup_logging()
+    logger = logging.getLogger()
+
+    n_workers = n_workers or os.cpu_count()
+    if threading.active_count() > 1 and n_workers > 1:
+        logger.warning(
+            f"Er draaien nog {threading.active_count() - 1} andere threads, fork is dan niet veilig"
+        )
+        n_workers = 1
+    if n_workers <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        logger.info("Stappen worden niet parallel uitgevoerd")
+        for functie, kwargs in stappen:
+            df = functie(df, **kwargs)
+        return df
+
+    import pyarrow.feather as feather
+
+    logger.info(f"Data verdelen over {n_workers} shards op patientnr")
+    shard = verdeel_patienten(df["patientnr"], n_workers)
+    volgorde = np.argsort(shard, kind="stable")
+    grenzen = np.searchsorted(shard[volgorde], np.arange(n_workers + 1))
+
+    shm = Path("/dev/shm")
+    with tempfile.TemporaryDirectory(
+        prefix="noshow_", dir=shm if shm.is_dir() else None
+    ) as map_tmp:
+        map_tmp = Path(map_tmp)
+        taken = []
+        for i in range(n_workers):
+            rijen = volgorde[grenzen[i] : grenzen[i + 1]]
+            if len(rijen) == 0:
+                continue
+            pad_in = map_tmp / f"shard_{i}_in.feather"
+            pad_uit = map_tmp / f"shard_{i}_uit.feather"
+            feather.write_feather(
+                df.iloc[rijen].reset_index(drop=True),
+                pad_in,
+                compression="uncompressed",
+            )
+            taken.append((pad_in, pad_uit, len(rijen)))
+        logger.info(
+            "Rijen per shard: " + ", ".join(str(aantal) for _, _, aantal in taken)
+        )
+
+        with ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=multiprocessing.get_context("fork")
+        ) as pool:
+            futures = [
+                pool.submit(verwerk_shard, pad_in, pad_uit, stappen)
+                for pad_in, pad_uit, _ in taken
+            ]
+            # result() geeft een exceptie uit een shard door aan het hoofdproces
+            for future in futures:
+                future.result()
+
+        df = pd.concat(
+            [lees_feather(pad_uit) for _, pad_uit, _ in taken],
+            ignore_index=True,
+        )
+
+    return df